@@ -3,7 +3,8 @@
 Script to add ReleaseFile objects for Python releases on the new pydotorg.
 To use (RELEASE is something like 3.3.5rc2):
 
-* Copy this script to dl-files (it needs access to all the release files).
+* Copy this script and cmdrunner.py to dl-files (it needs access to all the
+  release files).
   You could also download all files, then you need to adapt the "ftp_root"
   string below.
 
@@ -27,35 +28,12 @@ import hashlib
 import json
 import os
 import re
-import subprocess
 import sys
 from os import path
 
 import requests
 
-
-# Copied from release.py
-def error(*msgs):
-    print("**ERROR**", file=sys.stderr)
-    for msg in msgs:
-        print(msg, file=sys.stderr)
-    sys.exit(1)
-
-
-# Copied from release.py
-def run_cmd(cmd, silent=False, shell=True, **kwargs):
-    if shell:
-        cmd = " ".join(cmd)
-    if not silent:
-        print(f"Executing {cmd}")
-    try:
-        if silent:
-            subprocess.check_call(cmd, shell=shell, stdout=subprocess.PIPE, **kwargs)
-        else:
-            subprocess.check_call(cmd, shell=shell, **kwargs)
-    except subprocess.CalledProcessError:
-        error(f"{cmd} failed")
-
+from cmdrunner import error, run_cmd, run_many
 
 try:
     auth_info = os.environ["AUTH_INFO"]
@@ -98,6 +76,7 @@ def get_file_descriptions(release):
     return [
         (rx(r"\.tgz$"), ("Gzipped source tarball", 3, False, "")),
         (rx(r"\.tar\.xz$"), ("XZ compressed source tarball", 3, True, "")),
+        (rx(r"\.tar\.zst$"), ("Zstandard compressed source tarball", 3, False, "")),
         (rx(r"-webinstall\.exe$"), ("", 0, False, "")),
         (
             rx(r"-embed-amd64\.zip$"),
@@ -249,7 +228,9 @@ def list_files(release):
     for rfile in os.listdir(path.join(ftp_root, reldir)):
         if not path.isfile(path.join(ftp_root, reldir, rfile)):
             continue
-        if rfile.endswith((".asc", ".sig", ".crt", ".sigstore", ".spdx.json")):
+        if rfile.endswith(
+            (".asc", ".sig", ".crt", ".sigstore", ".spdx.json", ".index.json")
+        ):
             continue
         for prefix in ("python", "Python"):
             if rfile.startswith(prefix):
@@ -331,12 +312,18 @@ def sign_release_files_with_sigstore(release, release_files):
         print("Signing release files with Sigstore")
         run_cmd(
             ["python3", "-m", "sigstore", "sign", "--oidc-disable-ambient-providers"]
-            + unsigned_files
+            + unsigned_files,
+            # It may ask for a verification code.
+            interactive=True,
+        )
+        run_cmd(
+            ["chmod", "644"]
+            + [
+                file + suffix
+                for file in unsigned_files
+                for suffix in (".sig", ".crt", ".sigstore")
+            ]
         )
-        for file in unsigned_files:
-            run_cmd(["chmod", "644", file + ".sig"])
-            run_cmd(["chmod", "644", file + ".crt"])
-            run_cmd(["chmod", "644", file + ".sigstore"])
     else:
         print("All release files already signed with Sigstore")
 
@@ -347,7 +334,7 @@ def sign_release_files_with_sigstore(release, release_files):
             release_to_sigstore_identity_and_oidc_issuer[minor_version(release)]
         )
     except KeyError:
-        error(["No release manager defined for Python release " + release])
+        error("No release manager defined for Python release " + release)
     sigstore_identity, sigstore_oidc_issuer = sigstore_identity_and_oidc_issuer
 
     print("Verifying release files were signed correctly with Sigstore")
@@ -362,20 +349,30 @@ def sign_release_files_with_sigstore(release, release_files):
         "--cert-oidc-issuer",
         sigstore_oidc_issuer,
     ]
+    # The files are verified independently, so verify several at once.
+    verify_commands = []
     for filename in filenames:
         filename_crt = filename + ".crt"
         filename_sig = filename + ".sig"
         filename_sigstore = filename + ".sigstore"
 
         if os.path.exists(filename_sigstore):
-            run_cmd(sigstore_verify_argv + ["--bundle", filename_sigstore, filename])
+            verify_commands.append(
+                sigstore_verify_argv + ["--bundle", filename_sigstore, filename]
+            )
 
         # We use an 'or' here to error out if one of the files is missing.
         if os.path.exists(filename_sig) or os.path.exists(filename_crt):
-            run_cmd(
+            verify_commands.append(
                 sigstore_verify_argv
                 + ["--certificate", filename_crt, "--signature", filename_sig, filename]
             )
+    if verify_commands:
+        run_many(
+            verify_commands,
+            jobs=4,
+            names=[path.basename(cmd[-1]) for cmd in verify_commands],
+        )
 
 
 def main():
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+
+"""Benchmark release.export against a synthetic CPython-shaped repository.
+
+A git repository with CPython's layout and a chosen number and size of
+files is made in a work directory, with a stub "blurb" first on the PATH,
+and exported with release.export(tag, skip_docs=True).  The time of each
+phase of the export is reported, along with the peak disk usage of the
+dist directory:
+
+    extract   "git archive" piped into the extracted tree, from the command log
+    blurb     "blurb merge" and "blurb export", from the command log
+    cleanup   release.clean_tree
+    compress  release.tarball: all the tarballs and their md5 sums at once
+    verify    checking the tarballs against the git tree
+
+The compressors are then timed on their own over the exported tree:
+
+    archive   "git archive" of the tag, discarded
+    gzip      the .tgz alone
+    xz        the .tar.xz alone
+    md5       the md5 sums of the tarballs, from the files
+
+Results can be saved as named baselines, and compared with a baseline:
+
+    python bench_export.py --files 20000 --save main
+    python bench_export.py --files 20000 --compare main
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import datetime
+import functools
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Iterator, TypeVar
+
+import release
+import reprotar
+
+T = TypeVar("T")
+
+# The commit time of the synthetic tag.
+COMMIT_EPOCH = 1707250784
+TAG = "3.12.2"
+
+# The phases in the order of the report.
+PHASES = (
+    "extract",
+    "blurb",
+    "cleanup",
+    "compress",
+    "verify",
+    "archive",
+    "gzip",
+    "xz",
+    "md5",
+)
+
+DEFAULT_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+
+# Where the synthetic files go, and their share of the files, roughly as
+# in CPython.
+LAYOUT = (
+    ("Lib", ".py", 30),
+    ("Lib/test", ".py", 25),
+    ("Modules", ".c", 8),
+    ("Objects", ".c", 4),
+    ("Python", ".c", 4),
+    ("Include/internal", ".h", 4),
+    ("Doc/library", ".rst", 12),
+    ("Misc/NEWS.d/next/Library", ".rst", 5),
+    ("Tools/scripts", ".py", 4),
+    ("PCbuild", ".vcxproj", 2),
+    (".github/workflows", ".yml", 1),
+)
+
+# Files every export expects to find.
+FIXED_FILES = {
+    "README.rst": f"This is Python version {TAG}\n",
+    "LICENSE": "A. HISTORY OF THE SOFTWARE\n",
+    "Include/Python.h": "#include <patchlevel.h>\n",
+    "Include/Python-ast.h": "// generated\n",
+    "Python/Python-ast.c": "// generated\n",
+    "Lib/os.py": "import sys\n",
+    "Misc/NEWS.d/3.12.2.rst": ".. release date: 2024-02-06\n",
+    ".gitattributes": "* text=auto\n",
+    ".gitignore": "*.o\n",
+}
+
+WORDS = (
+    "self return def import from if else for in while with as try except "
+    "None True False int char static void PyObject Py_ssize_t NULL the of a "
+    "to and is be that this value object list dict str bytes error result"
+).split()
+
+BLURB = """\
+#!/bin/sh
+# Just enough of blurb for an export.
+case "$1" in
+merge) find Misc/NEWS.d -type f | LC_ALL=C sort | xargs cat > Misc/NEWS ;;
+export) rm -rf Misc/NEWS.d ;;
+esac
+"""
+
+
+@dataclass
+class Result:
+    files: int
+    file_size: int
+    jobs: int
+    phases: dict[str, float] = field(default_factory=dict)
+    total: float = 0.0
+    peak_disk: int = 0
+    tarball_sizes: dict[str, int] = field(default_factory=dict)
+    python: str = platform.python_version()
+    machine: str = platform.machine()
+    cpus: int = os.cpu_count() or 1
+    date: str = field(
+        default_factory=lambda: datetime.datetime.now(datetime.UTC).isoformat(
+            timespec="seconds"
+        )
+    )
+
+
+def synthetic_text(rng: random.Random, size: int) -> str:
+    """About `size` bytes of source-like text, compressible like code."""
+    lines = []
+    length = 0
+    while length < size:
+        indent = " " * (4 * rng.randrange(4))
+        line = indent + " ".join(rng.choices(WORDS, k=rng.randrange(3, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size] + "\n"
+
+
+def git(repo: str, *args: str) -> None:
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": "Release Manager",
+        "GIT_AUTHOR_EMAIL": "rm@python.org",
+        "GIT_AUTHOR_DATE": f"{COMMIT_EPOCH} +0000",
+        "GIT_COMMITTER_NAME": "Release Manager",
+        "GIT_COMMITTER_EMAIL": "rm@python.org",
+        "GIT_COMMITTER_DATE": f"{COMMIT_EPOCH} +0000",
+    }
+    subprocess.run(["git", *args], cwd=repo, env=env, check=True)
+
+
+def make_repository(repo: str, files: int, file_size: int, seed: int = 0) -> None:
+    """Make a git repository shaped like CPython, tagged v3.12.2.
+
+    File sizes vary around `file_size`; the same arguments always give
+    the same repository.
+    """
+    rng = random.Random(seed)
+    total_weight = sum(weight for _, _, weight in LAYOUT)
+    paths = dict(FIXED_FILES)
+    for directory, suffix, weight in LAYOUT:
+        count = max(1, files * weight // total_weight)
+        for i in range(count):
+            size = max(1, int(rng.expovariate(1 / file_size)))
+            paths[f"{directory}/file{i:05}{suffix}"] = synthetic_text(rng, size)
+    for name, content in paths.items():
+        path = os.path.join(repo, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    configure = os.path.join(repo, "configure")
+    with open(configure, "w") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod(configure, 0o755)
+    os.symlink("os.py", os.path.join(repo, "Lib", "python"))
+    git(repo, "init", "--quiet")
+    git(repo, "add", "--all")
+    git(repo, "commit", "--quiet", "--message", f"Python {TAG}")
+    git(repo, "tag", "--annotate", "--message", f"Python {TAG}", f"v{TAG}")
+
+
+def install_stubs(bin_dir: str) -> None:
+    """Put a stub blurb first on the PATH."""
+    os.makedirs(bin_dir, exist_ok=True)
+    blurb = os.path.join(bin_dir, "blurb")
+    with open(blurb, "w") as f:
+        f.write(BLURB)
+    os.chmod(blurb, 0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+
+def disk_usage(path: str) -> int:
+    """Bytes allocated under a path, counting hardlinked files once."""
+    seen = set()
+    usage = 0
+    for directory, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                usage += st.st_blocks * 512
+    return usage
+
+
+class DiskMonitor:
+    """Sample the disk usage of a directory in a thread, keeping the peak."""
+
+    def __init__(self, path: str, interval: float = 0.05) -> None:
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while True:
+            self.peak = max(self.peak, disk_usage(self.path))
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self) -> DiskMonitor:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, disk_usage(self.path))
+
+
+class PhaseTimer:
+    def __init__(self) -> None:
+        self.seconds: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+
+    def wrap(self, name: str, function: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            with self.phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def instrument(self) -> Iterator[None]:
+        """Time the phases of release.export while in the context."""
+        originals = {
+            name: getattr(release, name)
+            for name in ("clean_tree", "tarball", "verify_tarballs")
+        }
+        release.clean_tree = self.wrap("cleanup", release.clean_tree)
+        release.tarball = self.wrap("compress", release.tarball)
+        release.verify_tarballs = self.wrap("verify", release.verify_tarballs)
+        try:
+            yield
+        finally:
+            for name, function in originals.items():
+                setattr(release, name, function)
+
+    def add_commands(self, log: str, name: str, *prefix: str) -> None:
+        """Add the time of the commands starting with `prefix` in a log."""
+        with open(log) as f:
+            for line in f:
+                record = json.loads(line)
+                # Other records, like uploads, have no command.
+                command = record.get("command")
+                if isinstance(command, list) and command[: len(prefix)] == list(prefix):
+                    self.seconds[name] = self.seconds.get(name, 0.0) + record["seconds"]
+
+
+def md5_file(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def time_compressors(
+    repo: str, tree: str, scratch: str, jobs: int, timer: PhaseTimer
+) -> None:
+    """Time "git archive" and each compressor on its own."""
+    with timer.phase("archive"):
+        subprocess.run(
+            ["git", "archive", "--format=tar", f"v{TAG}"],
+            cwd=repo,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+    os.makedirs(scratch)
+    outputs = []
+    for name, factory in (
+        ("gzip", reprotar.gzip_compressor),
+        ("xz", reprotar.xz_compressor),
+    ):
+        output = os.path.join(scratch, f"{name}.tar")
+        with timer.phase(name):
+            reprotar.write_tarballs(
+                tree, {output: factory}, clamp_mtime=COMMIT_EPOCH, jobs=jobs
+            )
+        outputs.append(output)
+    with timer.phase("md5"):
+        for output in outputs:
+            md5_file(output)
+
+
+def run(
+    work: str, files: int, file_size: int, jobs: int | None = None, seed: int = 0
+) -> Result:
+    """Make the repository in `work`, export it and time the phases."""
+    jobs = jobs or os.cpu_count() or 1
+    result = Result(files=files, file_size=file_size, jobs=jobs)
+    repo = os.path.join(work, "cpython")
+    os.makedirs(repo)
+    make_repository(repo, files, file_size, seed)
+    install_stubs(os.path.join(work, "bin"))
+    log = os.path.join(work, "commands.jsonl")
+    os.environ["RELEASE_COMMAND_LOG"] = log
+
+    timer = PhaseTimer()
+    cwd = os.getcwd()
+    os.chdir(repo)
+    try:
+        tag = release.Tag(TAG)
+        with DiskMonitor(os.path.join(repo, tag.text)) as monitor:
+            with timer.instrument():
+                start = time.perf_counter()
+                release.export(tag, silent=True, skip_docs=True, jobs=jobs)
+                result.total = time.perf_counter() - start
+        timer.add_commands(log, "extract", "git", "archive")
+        timer.add_commands(log, "blurb", "blurb")
+        result.peak_disk = monitor.peak
+        dist = os.path.join(repo, tag.text)
+        for name in sorted(os.listdir(os.path.join(dist, "src"))):
+            result.tarball_sizes[name] = os.path.getsize(
+                os.path.join(dist, "src", name)
+            )
+        time_compressors(
+            repo,
+            os.path.join(dist, f"Python-{tag.text}"),
+            os.path.join(work, "compressors"),
+            jobs,
+            timer,
+        )
+    finally:
+        os.chdir(cwd)
+    result.phases = {
+        name: timer.seconds[name] for name in PHASES if name in timer.seconds
+    }
+    return result
+
+
+def baseline_path(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{name}.json")
+
+
+def save_baseline(result: Result, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(asdict(result), f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load_baseline(path: str) -> Result:
+    with open(path) as f:
+        return Result(**json.load(f))
+
+
+def format_bytes(size: float) -> str:
+    return f"{size / 1024**2:.1f} MiB"
+
+
+def report(result: Result, baseline: Result | None = None) -> str:
+    """A table of the phases, with the change from a baseline if given."""
+    lines = [
+        f"{result.files} files of ~{result.file_size} bytes, {result.jobs} jobs",
+    ]
+    rows = [*result.phases.items(), ("total", result.total)]
+    baseline_rows = {}
+    if baseline is not None:
+        baseline_rows = {**baseline.phases, "total": baseline.total}
+    for name, seconds in rows:
+        line = f"  {name:<10} {seconds:8.3f}s"
+        before = baseline_rows.get(name)
+        if before:
+            line += f"  {before:8.3f}s  {(seconds - before) / before:+7.1%}"
+        lines.append(line)
+    line = f"  {'peak disk':<10} {format_bytes(result.peak_disk):>9}"
+    if baseline is not None and baseline.peak_disk:
+        line += f"  {format_bytes(baseline.peak_disk):>9}"
+        line += (
+            f"  {(result.peak_disk - baseline.peak_disk) / baseline.peak_disk:+7.1%}"
+        )
+    lines.append(line)
+    for name, size in result.tarball_sizes.items():
+        lines.append(f"  {name:<24} {format_bytes(size):>9}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--files", type=int, default=5000, help="number of files")
+    parser.add_argument(
+        "--file-size", type=int, default=8192, help="mean size of a file in bytes"
+    )
+    parser.add_argument("--jobs", type=int, help="compression threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--work-dir", help="where to make the repository (default: a temporary dir)"
+    )
+    parser.add_argument(
+        "--baselines",
+        default=DEFAULT_BASELINES,
+        help="directory of the baselines (default: %(default)s)",
+    )
+    parser.add_argument("--save", metavar="NAME", help="save the result as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="compare with a baseline")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        try:
+            baseline = load_baseline(baseline_path(args.baselines, args.compare))
+        except OSError as e:
+            sys.exit(f"Can't read baseline {args.compare!r}: {e}")
+
+    with contextlib.ExitStack() as stack:
+        if args.work_dir:
+            work = os.path.abspath(args.work_dir)
+            if os.path.exists(work):
+                sys.exit(f"{work} already exists")
+        else:
+            work = stack.enter_context(tempfile.TemporaryDirectory())
+        result = run(work, args.files, args.file_size, args.jobs, args.seed)
+
+    print(report(result, baseline))
+    if args.save:
+        path = baseline_path(args.baselines, args.save)
+        save_baseline(result, path)
+        print(f"Saved the baseline to {path}")
+
+
+if __name__ == "__main__":
+    main()
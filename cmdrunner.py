@@ -0,0 +1,258 @@
+"""Run the external commands of the release scripts, and log every run.
+
+Each command run by these functions is recorded as one JSON line in
+the command log: the command, its directory, when it started, how long
+it took, its exit status and how many bytes of output it wrote.  The log
+is at $RELEASE_COMMAND_LOG, or ~/.cache/python-release/commands.jsonl.
+
+Other steps of a release, like file uploads, add their own records with
+log(), so the log can be compared across releases.
+
+Commands are argument lists run without a shell, unless shell=True is
+given with a command string.  run_many runs independent commands at the
+same time, streaming their output with a prefix on each line.
+stream_cmd gives the output of a command to the caller to read as it
+comes, like "git archive" piped into tarfile.  check_output returns it
+once the command is done, and leaves its failure to the caller.
+
+This module is uploaded next to add-to-pydotorg.py on the downloads
+server, so it only uses the standard library.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import IO, Any, Iterator, Mapping, NoReturn, Sequence
+
+_log_lock = threading.Lock()
+_output_lock = threading.Lock()
+
+
+@dataclass
+class CommandResult:
+    command: list[str] | str
+    cwd: str
+    started: str
+    seconds: float
+    returncode: int
+    # None when the output went to a terminal or a pipe.
+    output_bytes: int | None
+
+
+def error(*msgs: str) -> NoReturn:
+    print("**ERROR**", file=sys.stderr)
+    for msg in msgs:
+        print(msg, file=sys.stderr)
+    sys.exit(1)
+
+
+def log_path() -> str:
+    if "RELEASE_COMMAND_LOG" in os.environ:
+        return os.environ["RELEASE_COMMAND_LOG"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "python-release", "commands.jsonl")
+
+
+def log(record: Mapping[str, Any]) -> None:
+    """Append a record, made of JSON values, to the command log."""
+    path = log_path()
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _log_lock:
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Couldn't write to the command log {path}: {e}", file=sys.stderr)
+
+
+def _record(
+    command: list[str] | str,
+    cwd: str | None,
+    started: datetime.datetime,
+    start: float,
+    returncode: int,
+    output_bytes: int | None,
+) -> CommandResult:
+    result = CommandResult(
+        command=command,
+        cwd=os.path.abspath(cwd or os.curdir),
+        started=started.isoformat(timespec="seconds"),
+        seconds=round(time.perf_counter() - start, 3),
+        returncode=returncode,
+        output_bytes=output_bytes,
+    )
+    log(asdict(result))
+    return result
+
+
+def _file_size(fileobj: IO[Any]) -> int | None:
+    try:
+        fileobj.flush()
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _echo(data: bytes, prefix: str) -> None:
+    text = data.decode(errors="replace")
+    if prefix:
+        text = "".join(prefix + line for line in text.splitlines(keepends=True))
+    with _output_lock:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+def run_cmd(
+    cmd: Sequence[str] | str,
+    silent: bool = False,
+    shell: bool = False,
+    interactive: bool = False,
+    prefix: str = "",
+    check: bool = True,
+    cwd: str | None = None,
+    stdout: IO[Any] | None = None,
+    stderr: int | IO[Any] | None = None,
+    env: dict[str, str] | None = None,
+) -> CommandResult:
+    """Run a command, and exit with an error if it fails.
+
+    The output is shown as it comes, each line after `prefix`, or hidden
+    if `silent`.  It can instead go to a file, with `stdout` and `stderr`.
+    `interactive` commands, like an editor, keep the terminal.
+    """
+    if shell and not isinstance(cmd, str):
+        cmd = shlex.join(cmd)
+    elif not shell and isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    command: list[str] | str = cmd if isinstance(cmd, str) else list(cmd)
+    if not silent:
+        print(f"{prefix}Executing {command}")
+    started = datetime.datetime.now(datetime.timezone.utc)
+    start = time.perf_counter()
+    output_bytes: int | None = None
+    if interactive:
+        returncode = subprocess.call(command, shell=shell, cwd=cwd, env=env)
+    elif stdout is not None:
+        before = _file_size(stdout)
+        returncode = subprocess.call(
+            command, shell=shell, cwd=cwd, env=env, stdout=stdout, stderr=stderr
+        )
+        after = _file_size(stdout)
+        if before is not None and after is not None:
+            output_bytes = after - before
+    else:
+        with subprocess.Popen(
+            command,
+            shell=shell,
+            cwd=cwd,
+            env=env,
+            stdout=subprocess.PIPE,
+            # Silent commands still show their errors.
+            stderr=stderr if stderr is not None or silent else subprocess.STDOUT,
+        ) as proc:
+            assert proc.stdout is not None
+            output_bytes = 0
+            # Whole lines, so prefixed output from several commands doesn't
+            # get mixed up.
+            for line in iter(proc.stdout.readline, b""):
+                output_bytes += len(line)
+                if not silent:
+                    _echo(line, prefix)
+        returncode = proc.returncode
+    result = _record(command, cwd, started, start, returncode, output_bytes)
+    if check and returncode != 0:
+        error(f"{command} failed")
+    return result
+
+
+@contextlib.contextmanager
+def stream_cmd(
+    cmd: Sequence[str], silent: bool = False, cwd: str | None = None
+) -> Iterator[IO[bytes]]:
+    """Run a command, and give its output to read while in the context.
+
+    On leaving the context the run is logged, and if the command failed,
+    the program exits with an error, even if reading the output raised.
+    """
+    command = list(cmd)
+    if not silent:
+        print(f"Executing {command}")
+    started = datetime.datetime.now(datetime.timezone.utc)
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE)
+    try:
+        with proc:
+            assert proc.stdout is not None
+            yield proc.stdout
+    finally:
+        # The output went to the caller, so its size isn't known.
+        _record(command, cwd, started, start, proc.returncode, None)
+        if proc.returncode != 0:
+            error(f"{command} failed")
+
+
+def check_output(
+    cmd: Sequence[str],
+    cwd: str | None = None,
+    input: bytes | None = None,
+    stderr: int | None = None,
+) -> bytes:
+    """Run a command quietly and return its output.
+
+    Like subprocess.check_output, a failure raises CalledProcessError, for
+    the caller to report in its own terms.
+    """
+    command = list(cmd)
+    started = datetime.datetime.now(datetime.timezone.utc)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        command, cwd=cwd, input=input, stdout=subprocess.PIPE, stderr=stderr
+    )
+    _record(command, cwd, started, start, proc.returncode, len(proc.stdout))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command, proc.stdout)
+    return proc.stdout
+
+
+def run_many(
+    commands: Sequence[Sequence[str]],
+    jobs: int | None = None,
+    names: Sequence[str] | None = None,
+    silent: bool = False,
+    cwd: str | None = None,
+) -> list[CommandResult]:
+    """Run independent commands, at most `jobs` at a time.
+
+    Each line of output is prefixed with the name of its command, by
+    default its position and program.  All the commands are run even if
+    some fail; then the failures are reported together.
+    """
+    if names is None:
+        names = [
+            f"{i}/{len(commands)} {os.path.basename(cmd[0])}"
+            for i, cmd in enumerate(commands, 1)
+        ]
+    jobs = jobs or min(len(commands), os.cpu_count() or 1) or 1
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(
+                run_cmd, cmd, silent=silent, prefix=f"[{name}] ", check=False, cwd=cwd
+            )
+            for cmd, name in zip(commands, names)
+        ]
+        results = [future.result() for future in futures]
+    failed = [result for result in results if result.returncode != 0]
+    if failed:
+        error(*(f"{result.command} failed" for result in failed))
+    return results
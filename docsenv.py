@@ -0,0 +1,270 @@
+"""A cache of virtual environments for building the documentation.
+
+Environments are keyed by the content of Doc/requirements.txt and the
+version of the interpreter, so a release that doesn't change the docs
+requirements reuses the environment of the previous one.  Wheels are kept
+in a shared wheelhouse, and environments are installed from it without
+asking the package index once it has the wheels they need.
+
+Each environment has a manifest, written once it is complete, holding its
+key and its "pip freeze".  An environment without a manifest, or whose
+packages no longer match it, is rebuilt.  The manifest's mtime records
+when the environment was last used, and the least recently used
+environments are removed beyond MAX_ENVIRONMENTS.  Then the wheels that
+no remaining environment has installed are removed from the wheelhouse.
+
+Several builds, in threads or processes, can share the cache.  Each
+environment has two lock files next to it: "<key>.build.lock" is held
+exclusively while the environment is checked or made, and "<key>.lock"
+is shared by the builds using it.  An environment is only evicted if
+nothing holds its use lock.  "wheels.lock" is shared while environments
+are installed from the wheelhouse, and the wheelhouse is only pruned if
+nothing holds it.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+from typing import IO, Iterator
+
+import cmdrunner
+
+MAX_ENVIRONMENTS = 3
+MANIFEST = "manifest.json"
+WHEELHOUSE = "wheels"
+
+
+class DocsEnvironmentError(Exception):
+    """An environment couldn't be made."""
+
+
+def default_cache_root() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "python-release", "docs-venv")
+
+
+class DocsEnvironmentCache:
+    def __init__(
+        self,
+        root: str | None = None,
+        python: str = "python3",
+        max_environments: int = MAX_ENVIRONMENTS,
+    ) -> None:
+        self.root = root or default_cache_root()
+        self.python = python
+        self.max_environments = max_environments
+        self.wheelhouse = os.path.join(self.root, WHEELHOUSE)
+
+    def python_version(self) -> str:
+        output = cmdrunner.check_output(
+            [self.python, "-c", "import sys; print(sys.version)"]
+        )
+        return output.decode().strip()
+
+    def key(self, requirements: str) -> str:
+        """The cache key of an environment for a requirements file."""
+        digest = hashlib.sha256()
+        with open(requirements, "rb") as f:
+            digest.update(f.read())
+        digest.update(b"\0" + self.python_version().encode())
+        return digest.hexdigest()[:16]
+
+    def lock_path(self, key: str, kind: str = "") -> str:
+        return os.path.join(self.root, f"{key}{kind}.lock")
+
+    @contextlib.contextmanager
+    def use(self, requirements: str) -> Iterator[str]:
+        """Get the path of an environment with the requirements installed.
+
+        The environment isn't evicted or rebuilt until the block ends.
+        """
+        with contextlib.ExitStack() as stack:
+            try:
+                key = self.key(requirements)
+                os.makedirs(self.root, exist_ok=True)
+                stack.enter_context(_locked(self.lock_path(key), fcntl.LOCK_SH))
+                venv = self.prepare(key, requirements)
+                self.evict(keep=key)
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise DocsEnvironmentError(e) from e
+            yield venv
+
+    def prepare(self, key: str, requirements: str) -> str:
+        """Check the environment of a key, or make it."""
+        path = os.path.join(self.root, key)
+        venv = os.path.join(path, "venv")
+        with _locked(self.lock_path(key, ".build"), fcntl.LOCK_EX):
+            if self.is_intact(path, key):
+                print(f"Reusing docs environment {key}")
+            else:
+                print(f"Creating docs environment {key}")
+                shutil.rmtree(path, ignore_errors=True)
+                os.makedirs(path)
+                self.create(venv, requirements)
+                manifest = {"key": key, "freeze": self.freeze(venv)}
+                with open(os.path.join(path, MANIFEST), "w") as f:
+                    json.dump(manifest, f, indent=2, sort_keys=True)
+            os.utime(os.path.join(path, MANIFEST))
+        return venv
+
+    def is_intact(self, path: str, key: str) -> bool:
+        """Whether an environment is complete and unchanged since it was made."""
+        try:
+            with open(os.path.join(path, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if manifest.get("key") != key:
+            return False
+        try:
+            return bool(
+                manifest.get("freeze") == self.freeze(os.path.join(path, "venv"))
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return False
+
+    def create(self, venv: str, requirements: str) -> None:
+        _check_call([self.python, "-m", "venv", venv])
+        pip = os.path.join(venv, "bin", "pip")
+        offline = [
+            pip,
+            "install",
+            "--no-index",
+            "--find-links",
+            self.wheelhouse,
+            "-r",
+            requirements,
+        ]
+        os.makedirs(self.wheelhouse, exist_ok=True)
+        # The wheels can't be pruned while they're being installed.
+        with _locked(self.lock_path(WHEELHOUSE), fcntl.LOCK_SH):
+            result = cmdrunner.run_cmd(offline, check=False, stderr=subprocess.DEVNULL)
+            if result.returncode == 0:
+                return
+            # Fetch what the wheelhouse is missing, then install from it.
+            _check_call(
+                [
+                    pip,
+                    "wheel",
+                    "--find-links",
+                    self.wheelhouse,
+                    "--wheel-dir",
+                    self.wheelhouse,
+                    "-r",
+                    requirements,
+                ]
+            )
+            _check_call(offline)
+
+    def freeze(self, venv: str) -> list[str]:
+        """The packages installed in an environment, as "pip freeze" lists them."""
+        output = cmdrunner.check_output(
+            [os.path.join(venv, "bin", "pip"), "freeze", "--all"]
+        )
+        return sorted(output.decode().splitlines())
+
+    def environments(self) -> list[tuple[float, str]]:
+        """The (last used, key) of the cached environments, oldest first."""
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.name == WHEELHOUSE or not entry.is_dir():
+                continue
+            try:
+                used = os.stat(os.path.join(entry.path, MANIFEST)).st_mtime
+            except OSError:
+                # Incomplete, so the first to go.
+                used = 0.0
+            found.append((used, entry.name))
+        return sorted(found)
+
+    def evict(self, keep: str) -> list[str]:
+        """Remove the least recently used environments beyond the limit,
+        and the wheels that only they used."""
+        environments = [key for used, key in self.environments() if key != keep]
+        excess = len(environments) + 1 - self.max_environments
+        removed = environments[: max(excess, 0)]
+        for key in list(removed):
+            try:
+                with _locked(self.lock_path(key), fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            except BlockingIOError:
+                # A build is using it.
+                removed.remove(key)
+        self.prune_wheelhouse()
+        return removed
+
+    def prune_wheelhouse(self) -> list[str]:
+        """Remove the wheels of packages no cached environment has installed."""
+        removed = []
+        try:
+            with _locked(self.lock_path(WHEELHOUSE), fcntl.LOCK_EX | fcntl.LOCK_NB):
+                installed = self.installed_packages()
+                for entry in os.scandir(self.wheelhouse):
+                    package = _wheel_package(entry.name)
+                    if package is not None and package not in installed:
+                        os.unlink(entry.path)
+                        removed.append(entry.name)
+        except BlockingIOError:
+            # An environment is being installed from it.
+            pass
+        except FileNotFoundError:
+            # No environment has been made yet.
+            pass
+        return sorted(removed)
+
+    def installed_packages(self) -> set[tuple[str, str]]:
+        """The (name, version) of the packages of the complete environments."""
+        installed: set[tuple[str, str]] = set()
+        for _, key in self.environments():
+            try:
+                with open(os.path.join(self.root, key, MANIFEST)) as f:
+                    freeze = json.load(f).get("freeze")
+            except (OSError, ValueError):
+                # Incomplete: it will be made again, from the index if needed.
+                continue
+            if isinstance(freeze, list):
+                installed.update(filter(None, map(_installed_package, freeze)))
+        return installed
+
+
+def _canonical_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _installed_package(line: str) -> tuple[str, str] | None:
+    """The (name, version) of a "pip freeze" line like "Sphinx==7.2.6"."""
+    name, sep, version = line.partition("==")
+    if not sep:
+        # Editable and direct URL installs don't come from the wheelhouse.
+        return None
+    return _canonical_name(name), version.strip()
+
+
+def _wheel_package(filename: str) -> tuple[str, str] | None:
+    """The (name, version) of a wheel, from its file name."""
+    if not filename.endswith(".whl"):
+        return None
+    name, version, *_ = filename[: -len(".whl")].split("-")
+    # Wheel file names escape "-" in versions as "_".
+    return _canonical_name(name), version.replace("_", "-")
+
+
+@contextlib.contextmanager
+def _locked(path: str, operation: int) -> Iterator[IO[str]]:
+    """Hold a flock on a file, made if needed, for the block."""
+    with open(path, "a") as f:
+        fcntl.flock(f, operation)
+        yield f
+
+
+def _check_call(cmd: list[str]) -> None:
+    result = cmdrunner.run_cmd(cmd, check=False)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd)
@@ -0,0 +1,285 @@
+"""Queries against a git repository, without a git process per query.
+
+Objects are read through one long-lived "git cat-file --batch" process,
+and names are resolved through one "git cat-file --batch-check" process,
+per repository.  Answers which can't change, like the commit a tag points
+to or the time of a commit, are memoized for the life of the process.
+
+    >>> repo = gitquery.repository("/path/to/cpython")
+    >>> repo.commit_time("v3.12.2")
+    1707250784
+"""
+
+from __future__ import annotations
+
+import atexit
+import collections
+import os
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import IO, Iterator
+
+import cmdrunner
+
+
+class GitError(Exception):
+    """A git object couldn't be found or read."""
+
+
+@dataclass(frozen=True)
+class TreeEntry:
+    path: str
+    mode: str
+    object_name: str
+
+    @property
+    def is_tree(self) -> bool:
+        return self.mode == "40000"
+
+
+@dataclass(frozen=True)
+class DiffEntry:
+    """A path changed between two trees, as "git diff --raw" shows it."""
+
+    status: str
+    path: str
+    mode: str
+    object_name: str
+
+
+class _CatFile:
+    """A "git cat-file" process answering one query at a time."""
+
+    def __init__(self, path: str, option: str) -> None:
+        self.path = path
+        self.option = option
+        self.proc: subprocess.Popen[bytes] | None = None
+        self.lock = threading.Lock()
+
+    def _start(self) -> subprocess.Popen[bytes]:
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(
+                ["git", "cat-file", self.option],
+                cwd=self.path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        return self.proc
+
+    def query(self, name: str) -> tuple[str, str, int, bytes | None]:
+        """Return the object name, type, size and (for --batch) content."""
+        if "\n" in name:
+            raise GitError(f"invalid object name {name!r}")
+        with self.lock:
+            proc = self._start()
+            stdin: IO[bytes] = proc.stdin  # type: ignore[assignment]
+            stdout: IO[bytes] = proc.stdout  # type: ignore[assignment]
+            try:
+                stdin.write(name.encode() + b"\n")
+                stdin.flush()
+            except OSError:
+                raise GitError(f"git cat-file failed in {self.path}") from None
+            header = stdout.readline().decode().split()
+            if not header:
+                raise GitError(f"git cat-file failed in {self.path}")
+            if header[-1] == "missing" or header[-1] == "ambiguous":
+                raise GitError(f"{name} is {header[-1]} in {self.path}")
+            object_name, object_type, size = header[0], header[1], int(header[2])
+            content = None
+            if self.option == "--batch":
+                content = stdout.read(size)
+                stdout.read(1)
+            return object_name, object_type, size, content
+
+    def close(self) -> None:
+        with self.lock:
+            if self.proc is not None:
+                assert self.proc.stdin is not None
+                self.proc.stdin.close()
+                self.proc.wait()
+                self.proc = None
+
+
+class GitRepository:
+    def __init__(self, path: str | os.PathLike[str] = ".") -> None:
+        self.path = os.fspath(path)
+        self._batch = _CatFile(self.path, "--batch")
+        self._check = _CatFile(self.path, "--batch-check")
+        self._commits: dict[str, str] = {}
+        self._commit_times: dict[str, int] = {}
+        # Blobs by object name, least recently used first.
+        self._blobs: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._blobs_size = 0
+        self._blobs_lock = threading.Lock()
+        self.blob_cache_size = 0
+
+    def __enter__(self) -> GitRepository:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._batch.close()
+        self._check.close()
+
+    def object_info(self, name: str) -> tuple[str, str, int]:
+        """Return the object name, type and size of a revision."""
+        object_name, object_type, size, _ = self._check.query(name)
+        return object_name, object_type, size
+
+    def read_object(self, name: str, expected_type: str | None = None) -> bytes:
+        _, object_type, _, content = self._batch.query(name)
+        if expected_type is not None and object_type != expected_type:
+            raise GitError(f"{name} is a {object_type}, not a {expected_type}")
+        assert content is not None
+        return content
+
+    def read_blob(self, name: str) -> bytes:
+        """Read a blob by object name.
+
+        With a blob_cache_size, up to that many bytes of blobs are kept, so
+        trees sharing most of their files (like the branches of a security
+        release) each read a blob from git once.
+        """
+        if not self.blob_cache_size:
+            return self.read_object(name, "blob")
+        with self._blobs_lock:
+            if name in self._blobs:
+                self._blobs.move_to_end(name)
+                return self._blobs[name]
+        data = self.read_object(name, "blob")
+        with self._blobs_lock:
+            if name not in self._blobs and len(data) <= self.blob_cache_size:
+                self._blobs[name] = data
+                self._blobs_size += len(data)
+                while self._blobs_size > self.blob_cache_size:
+                    _, evicted = self._blobs.popitem(last=False)
+                    self._blobs_size -= len(evicted)
+        return data
+
+    def commit(self, rev: str) -> str:
+        """The commit a revision (like a tag name) points to.
+
+        Tags aren't moved once a release is made, so this is memoized.
+        """
+        if rev not in self._commits:
+            object_name, _, _ = self.object_info(f"{rev}^{{commit}}")
+            self._commits[rev] = object_name
+        return self._commits[rev]
+
+    def commit_time(self, rev: str) -> int:
+        """The committer timestamp of the commit of a revision."""
+        commit = self.commit(rev)
+        if commit not in self._commit_times:
+            headers = self.read_object(commit, "commit").split(b"\n\n", 1)[0]
+            for line in headers.split(b"\n"):
+                if line.startswith(b"committer "):
+                    self._commit_times[commit] = int(line.rsplit(b" ", 2)[1])
+                    break
+            else:
+                raise GitError(f"commit {commit} has no committer")
+        return self._commit_times[commit]
+
+    def tree(self, rev: str) -> list[TreeEntry]:
+        """The entries of a tree, or of the tree of a commit or tag."""
+        data = self.read_object(f"{rev}^{{tree}}", "tree")
+        entries = []
+        offset = 0
+        while offset < len(data):
+            space = data.index(b" ", offset)
+            nul = data.index(b"\0", space)
+            entries.append(
+                TreeEntry(
+                    os.fsdecode(data[space + 1 : nul]),
+                    data[offset:space].decode(),
+                    data[nul + 1 : nul + 21].hex(),
+                )
+            )
+            offset = nul + 21
+        return entries
+
+    def walk_tree(self, rev: str, prefix: str = "") -> Iterator[TreeEntry]:
+        """All the entries under a tree, like "git ls-tree -r -t".
+
+        Each tree comes before its entries, and entries have paths relative
+        to the root of the tree.
+        """
+        for entry in self.tree(rev):
+            path = f"{prefix}{entry.path}"
+            yield TreeEntry(path, entry.mode, entry.object_name)
+            if entry.is_tree:
+                yield from self.walk_tree(entry.object_name, f"{path}/")
+
+    def diff(self, old: str, new: str) -> list[DiffEntry]:
+        """The files changed from one revision to another, without renames.
+
+        For deleted files, `mode` and `object_name` are those of the old file.
+        """
+        try:
+            output = cmdrunner.check_output(
+                [
+                    "git",
+                    "diff",
+                    "--raw",
+                    "-z",
+                    "--no-renames",
+                    "--no-abbrev",
+                    old,
+                    new,
+                ],
+                cwd=self.path,
+            )
+        except subprocess.CalledProcessError as e:
+            raise GitError(f"git diff {old} {new} failed in {self.path}") from e
+        fields = output.split(b"\0")
+        entries = []
+        for info, path in zip(fields[::2], fields[1::2]):
+            old_mode, new_mode, old_name, new_name, status = info[1:].decode().split()
+            if status == "D":
+                mode, object_name = old_mode, old_name
+            else:
+                mode, object_name = new_mode, new_name
+            entries.append(DiffEntry(status, os.fsdecode(path), mode, object_name))
+        return entries
+
+    def run(self, *args: str) -> str:
+        """Run a git command in the repository and return its output."""
+        try:
+            output = cmdrunner.check_output(["git", *args], cwd=self.path)
+        except subprocess.CalledProcessError as e:
+            raise GitError(f"git {args[0]} failed in {self.path}") from e
+        return output.decode().strip()
+
+    def config(self, key: str, local: bool = False) -> str | None:
+        try:
+            return self.run("config", *(["--local"] if local else []), "--get", key)
+        except GitError:
+            return None
+
+    def remote_url(self, remote: str) -> str:
+        return self.run("ls-remote", "--get-url", remote)
+
+    def is_clean(self) -> bool:
+        return not self.run("status", "--porcelain")
+
+
+_repositories: dict[str, GitRepository] = {}
+_repositories_lock = threading.Lock()
+
+
+def repository(path: str | os.PathLike[str] = ".") -> GitRepository:
+    """The shared GitRepository for a path."""
+    key = os.path.realpath(path)
+    with _repositories_lock:
+        if key not in _repositories:
+            _repositories[key] = GitRepository(key)
+        return _repositories[key]
+
+
+@atexit.register
+def _close_repositories() -> None:
+    for repo in _repositories.values():
+        repo.close()
@@ -8,61 +8,165 @@ Additions by Barry Warsaw, Georg Brandl and Benjamin Peterson
 
 from __future__ import annotations
 
+import bisect
+import concurrent.futures
 import datetime
+import fnmatch
+import functools
 import glob
+import gzip
 import hashlib
+import io
+import json
+import lzma
 import optparse
 import os
+import queue
 import re
 import readline  # noqa: F401
 import shutil
-import subprocess
 import sys
+import tarfile
 import tempfile
+import time
 from contextlib import contextmanager
-from typing import Any, Callable, Generator, Self
+from dataclasses import dataclass, field
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Generator,
+    Iterable,
+    Iterator,
+    Mapping,
+    Self,
+    Sequence,
+    cast,
+)
+
+import docsenv
+import gitquery
+import reprotar
+import transfer
+from cmdrunner import check_output, error, run_cmd, run_many, stream_cmd
 
 COMMASPACE = ", "
-SPACE = " "
 tag_cre = re.compile(r"(\d+)(?:\.(\d+)(?:\.(\d+))?)?(?:([ab]|rc)(\d+))?$")
 
 
 # Ideas stolen from Mailman's release script, Lib/tokens.py and welease
 
 
+@functools.lru_cache(maxsize=None)
+def parse_tag(tag_name: str) -> tuple[int, int, int, str, int]:
+    """Parse a tag name into (major, minor, patch, level, serial).
+
+    The level of a final release is "f".
+    """
+    result = tag_cre.match(tag_name)
+    if result is None:
+        error(f"tag {tag_name} is not valid")
+    assert result is not None
+    major, minor, patch, level, serial = result.groups()
+    return (
+        int(major),
+        int(minor or 0),
+        int(patch or 0),
+        level or "f",
+        int(serial or 0),
+    )
+
+
+@functools.total_ordering
 class Tag:
+    """A release version, ordered as releases are made: a < b < rc < final."""
+
+    __slots__ = (
+        "major",
+        "minor",
+        "patch",
+        "level",
+        "serial",
+        "is_final",
+        "text",
+        "basic_version",
+    )
+
+    LEVEL_RANK = {"a": 0, "b": 1, "rc": 2, "f": 3}
+
+    major: int
+    minor: int
+    patch: int
+    level: str
+    serial: int
+    is_final: bool
+    text: str
+    basic_version: str
+
     def __init__(self, tag_name: str) -> None:
         # if tag is ".", use current directory name as tag
         # e.g. if current directory name is "3.4.6",
         # "release.py --bump 3.4.6" and "release.py --bump ." are the same
         if tag_name == ".":
             tag_name = os.path.basename(os.getcwd())
-        result = tag_cre.match(tag_name)
-        if result is None:
-            error(f"tag {tag_name} is not valid")
-        assert result is not None
-        data = list(result.groups())
-        if data[3] is None:
-            # A final release.
-            self.is_final = True
-            data[3] = "f"
-        else:
-            self.is_final = False
-        # For everything else, None means 0.
-        for i, thing in enumerate(data):
-            if thing is None:
-                data[i] = 0
-        self.major = int(data[0])
-        self.minor = int(data[1])
-        self.patch = int(data[2])
-        self.level = data[3]
-        self.serial = int(data[4])
+        self._set(*parse_tag(tag_name))
+
+    def _set(self, major: int, minor: int, patch: int, level: str, serial: int) -> None:
+        set_slot = object.__setattr__
+        set_slot(self, "major", major)
+        set_slot(self, "minor", minor)
+        set_slot(self, "patch", patch)
+        set_slot(self, "level", level)
+        set_slot(self, "serial", serial)
+        set_slot(self, "is_final", level == "f")
         # This has the effect of normalizing the version.
-        self.text = self.normalized()
-        if self.level != "f":
-            assert self.level is not None
-            self.text += self.level + str(self.serial)
-        self.basic_version = f"{self.major}.{self.minor}"
+        text = f"{major}.{minor}.{patch}"
+        if level != "f":
+            text += level + str(serial)
+        set_slot(self, "text", text)
+        set_slot(self, "basic_version", f"{major}.{minor}")
+
+    def __setattr__(self, name: str, value: object) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self) -> tuple[type[Tag], tuple[str]]:
+        return type(self), (self.text,)
+
+    def __setstate__(self, state: Any) -> None:
+        # Tags pickled before Tag had slots (in a run_release shelve)
+        # come back through here with their old __dict__.
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        self._set(*parse_tag(state["text"]))
+
+    @property
+    def sort_key(self) -> tuple[int, int, int, int, int]:
+        return (
+            self.major,
+            self.minor,
+            self.patch,
+            self.LEVEL_RANK[self.level],
+            self.serial,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Tag):
+            return NotImplemented
+        return self.sort_key == other.sort_key
+
+    def __lt__(self, other: object) -> bool:
+        if not isinstance(other, Tag):
+            return NotImplemented
+        return self.sort_key < other.sort_key
+
+    def __hash__(self) -> int:
+        return hash(self.sort_key)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.text!r})"
 
     def __str__(self) -> str:
         return self.text
@@ -98,43 +202,76 @@ class Tag:
         return self.__class__(f"{self.major}.{int(self.minor)+1}.0a0")
 
     def as_tuple(self) -> tuple[int, int, int, str, int]:
-        assert isinstance(self.level, str)
         return self.major, self.minor, self.patch, self.level, self.serial
 
     @property
     def committed_at(self) -> datetime.datetime:
         # Fetch the epoch of the tagged commit for build reproducibility.
-        proc = subprocess.run(
-            ["git", "log", self.gitname, "-1", "--pretty=%ct"], stdout=subprocess.PIPE
-        )
-        if proc.returncode != 0:
+        try:
+            timestamp = gitquery.repository().commit_time(self.gitname)
+        except gitquery.GitError:
             error(f"Couldn't fetch the epoch of tag {self.gitname}")
-        return datetime.datetime.fromtimestamp(
-            int(proc.stdout.decode().strip()), tz=datetime.timezone.utc
-        )
+        return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
 
 
-def error(*msgs: str) -> None:
-    print("**ERROR**", file=sys.stderr)
-    for msg in msgs:
-        print(msg, file=sys.stderr)
-    sys.exit(1)
+class ReleaseHistory:
+    """The release tags of a repository, sorted for lookups by bisection."""
 
+    def __init__(self, tags: Iterable[Tag]) -> None:
+        self.tags = sorted(set(tags))
 
-def run_cmd(
-    cmd: list[str] | str, silent: bool = False, shell: bool = False, **kwargs: Any
-) -> None:
-    if shell:
-        cmd = SPACE.join(cmd)
-    if not silent:
-        print(f"Executing {cmd}")
-    try:
-        if silent:
-            subprocess.check_call(cmd, shell=shell, stdout=subprocess.PIPE, **kwargs)
-        else:
-            subprocess.check_call(cmd, shell=shell, **kwargs)
-    except subprocess.CalledProcessError:
-        error(f"{cmd} failed")
+    @classmethod
+    def from_repository(cls, path: str = ".") -> ReleaseHistory:
+        """Read every v* tag of a repository with one "git for-each-ref"."""
+        output = gitquery.repository(path).run(
+            "for-each-ref", "--format=%(refname:strip=2)", "refs/tags/v*"
+        )
+        return cls(
+            Tag(name[1:]) for name in output.splitlines() if tag_cre.match(name[1:])
+        )
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def __iter__(self) -> Iterator[Tag]:
+        return iter(self.tags)
+
+    def __contains__(self, tag: object) -> bool:
+        if not isinstance(tag, Tag):
+            return False
+        i = bisect.bisect_left(self.tags, tag)
+        return i < len(self.tags) and self.tags[i] == tag
+
+    def previous(self, tag: Tag) -> Tag | None:
+        """The release before `tag` on its branch, if there is one."""
+        i = bisect.bisect_left(self.tags, tag)
+        if i and self.tags[i - 1].basic_version == tag.basic_version:
+            return self.tags[i - 1]
+        return None
+
+    def latest(self, basic_version: str | None = None) -> Tag | None:
+        """The newest release, on a branch like "3.12" if one is given."""
+        if basic_version is None:
+            return self.tags[-1] if self.tags else None
+        major, minor = map(int, basic_version.split("."))
+        i = bisect.bisect_left(self.tags, (major, minor + 1), key=self._branch_key)
+        if i and self.tags[i - 1].basic_version == basic_version:
+            return self.tags[i - 1]
+        return None
+
+    def latest_rc(self, basic_version: str | None = None) -> Tag | None:
+        """The newest release candidate, on a branch if one is given."""
+        tags = self.tags
+        if basic_version is not None:
+            major, minor = map(int, basic_version.split("."))
+            lo = bisect.bisect_left(tags, (major, minor), key=self._branch_key)
+            hi = bisect.bisect_left(tags, (major, minor + 1), key=self._branch_key)
+            tags = tags[lo:hi]
+        return next((tag for tag in reversed(tags) if tag.level == "rc"), None)
+
+    @staticmethod
+    def _branch_key(tag: Tag) -> tuple[int, int]:
+        return tag.major, tag.minor
 
 
 readme_re = re.compile(r"This is Python version [23]\.\d").match
@@ -191,8 +328,8 @@ def chdir_to_repo_root() -> str:
     return root
 
 
-def get_output(args: list[str]) -> bytes:
-    return subprocess.check_output(args)
+def get_output(args: list[str], cwd: str | None = None) -> bytes:
+    return check_output(args, cwd=cwd)
 
 
 def check_env() -> None:
@@ -203,7 +340,7 @@ def check_env() -> None:
 
 
 def get_arg_parser() -> optparse.OptionParser:
-    usage = "%prog [options] tagname"
+    usage = "%prog [options] tagname\n       %prog --export [options] tagname..."
     p = optparse.OptionParser(usage=usage)
     p.add_option(
         "-b",
@@ -225,6 +362,20 @@ def get_arg_parser() -> optparse.OptionParser:
         metavar="username",
         help="Upload the tarballs and docs to dinsdale",
     )
+    p.add_option(
+        "-j",
+        "--jobs",
+        type="int",
+        default=None,
+        help="Number of compression threads shared by the exports "
+        "(default: one per CPU)",
+    )
+    p.add_option(
+        "--streams",
+        type="int",
+        default=transfer.STREAMS,
+        help="Number of concurrent upload streams (default: %default)",
+    )
     p.add_option(
         "-m",
         "--branch",
@@ -252,6 +403,33 @@ def get_arg_parser() -> optparse.OptionParser:
         action="store_true",
         help="Skip building the documentation during export",
     )
+    p.add_option(
+        "--index",
+        default=False,
+        action="store_true",
+        help="Write an index sidecar beside each source tarball, "
+        "for random access to its members",
+    )
+    p.add_option(
+        "--zstd",
+        default=False,
+        action="store_true",
+        help="Also make a Zstandard compressed .tar.zst during export",
+    )
+    p.add_option(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Keep the exported tree of each branch in ~/.cache/python-release "
+        "and update it with git diffs, for quick respins",
+    )
+    p.add_option(
+        "--treeless",
+        default=False,
+        action="store_true",
+        help="Make the tarballs straight from git objects during export, "
+        "without writing the tree to disk (needs --skip-docs for rc and final)",
+    )
     return p
 
 
@@ -261,9 +439,10 @@ def constant_replace(
     """Inserts in between --start constant-- and --end constant-- in a file"""
     start_tag = comment_start + "--start constants--" + comment_end
     end_tag = comment_start + "--end constants--" + comment_end
-    with open(fn, encoding="ascii") as infile, open(
-        fn + ".new", "w", encoding="ascii"
-    ) as outfile:
+    with (
+        open(fn, encoding="ascii") as infile,
+        open(fn + ".new", "w", encoding="ascii") as outfile,
+    ):
         found_constants = False
         waiting_for_end = False
         for line in infile:
@@ -284,7 +463,7 @@ def constant_replace(
     os.rename(fn + ".new", fn)
 
 
-def tweak_patchlevel(tag: Tag, done: bool = False) -> None:
+def tweak_patchlevel(tag: Tag, done: bool = False, repo: str = ".") -> None:
     print("Updating Include/patchlevel.h...", end=" ")
     template = '''
 #define PY_MAJOR_VERSION\t{tag.major}
@@ -307,14 +486,15 @@ def tweak_patchlevel(tag: Tag, done: bool = False) -> None:
     )
     if tag.as_tuple() >= (3, 7, 0, "a", 3):
         new_constants = new_constants.expandtabs()
-    constant_replace("Include/patchlevel.h", new_constants)
+    constant_replace(os.path.join(repo, "Include", "patchlevel.h"), new_constants)
     print("done")
 
 
-def bump(tag: Tag) -> None:
+def bump(tag: Tag, repo: str = ".") -> None:
+    """Bump the version in the files of the repository at `repo`."""
     print(f"Bumping version to {tag}")
 
-    tweak_patchlevel(tag)
+    tweak_patchlevel(tag, repo=repo)
 
     extra_work = False
     # Older releases have a plain text README,
@@ -334,9 +514,9 @@ def bump(tag: Tag) -> None:
         ]
     print("\nManual editing time...")
     for fn in other_files:
-        if os.path.exists(fn):
+        if os.path.exists(os.path.join(repo, fn)):
             print(f"Edit {fn}")
-            manual_edit(fn)
+            manual_edit(os.path.join(repo, fn))
         else:
             print(f"Skipping {fn}")
 
@@ -348,7 +528,7 @@ def bump(tag: Tag) -> None:
 
 def manual_edit(fn: str) -> None:
     editor = os.environ["EDITOR"].split()
-    run_cmd([*editor, fn])
+    run_cmd([*editor, fn], interactive=True)
 
 
 @contextmanager
@@ -374,217 +554,910 @@ def make_dist(name: str) -> None:
         print(f"created dist directory {name}")
 
 
-def tarball(source: str, clamp_mtime: str) -> None:
-    """Build tarballs for a directory."""
-    print("Making .tgz")
+def tarball(
+    source: str,
+    clamp_mtime: datetime.datetime,
+    jobs: int | None = None,
+    zstd: bool = False,
+    entries: Iterable[reprotar.TarEntry] | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    index: bool = False,
+) -> None:
+    """Build tarballs for a directory, or for the entries it would have.
+
+    The tarballs are written to "src" beside the directory, and their md5
+    sums to "md5sums.txt".  With `index`, each tarball gets an index
+    sidecar for reprotar.IndexedTarball.
+    """
     base = os.path.basename(source)
-    tgz = os.path.join("src", base + ".tgz")
-    xz = os.path.join("src", base + ".tar.xz")
-    # Recommended options for creating reproducible tarballs from:
-    # https://www.gnu.org/software/tar/manual/html_node/Reproducibility.html#Reproducibility
-    # and https://reproducible-builds.org/docs/archives/
-    repro_options = [
-        # Sorts the entries in the tarball by name.
-        "--sort=name",
-        # Sets a maximum 'modified time' of entries in tarball.
-        f"--mtime={clamp_mtime}",
-        "--clamp-mtime",
-        # Sets the owner uid and gid to 0.
-        "--owner=0",
-        "--group=0",
-        "--numeric-owner",
-        # Omits process ID, file access, and status change times.
-        "--pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,delete=ctime",
-        # Omit irrelevant info about file permissions.
-        "--mode=go+u,go-w",
-    ]
-    run_cmd(
-        [
-            "tar",
-            "cf",
-            tgz,
-            *repro_options,
-            "--use-compress-program",
-            "gzip --no-name -9",
+    src = os.path.join(os.path.dirname(source), "src")
+    outputs = {
+        os.path.join(src, base + ".tgz"): reprotar.gzip_compressor,
+        os.path.join(src, base + ".tar.xz"): reprotar.xz_compressor,
+    }
+    if zstd:
+        outputs[os.path.join(src, base + ".tar.zst")] = reprotar.zstd_compressor
+    print("Making", COMMASPACE.join(path.split(base, 1)[1] for path in outputs))
+    # The tar stream is written once and compressed into every tarball
+    # in parallel, with the md5 sums calculated while the tarballs are written.
+    if entries is None:
+        artifacts = reprotar.write_tarballs(
             source,
-        ]
-    )
-    print("Making .tar.xz")
-    run_cmd(["tar", "cJf", xz, *repro_options, source])
-    print("Calculating md5 sums")
-    checksum_tgz = hashlib.md5()
-    with open(tgz, "rb") as data:
-        checksum_tgz.update(data.read())
-    checksum_xz = hashlib.md5()
-    with open(xz, "rb") as data:
-        checksum_xz.update(data.read())
-    print("  %s  %8s  %s" % (checksum_tgz.hexdigest(), int(os.path.getsize(tgz)), tgz))
-    print("  %s  %8s  %s" % (checksum_xz.hexdigest(), int(os.path.getsize(xz)), xz))
-
-
-def export(tag: Tag, silent: bool = False, skip_docs: bool = False) -> None:
+            outputs,
+            clamp_mtime=int(clamp_mtime.timestamp()),
+            jobs=jobs,
+            executor=executor,
+        )
+    else:
+        artifacts = reprotar.write_tarball_entries(
+            entries,
+            outputs,
+            clamp_mtime=int(clamp_mtime.timestamp()),
+            jobs=jobs,
+            executor=executor,
+        )
+    for artifact in artifacts:
+        path = os.path.relpath(artifact.path)
+        print("  %s  %8s  %s" % (artifact.md5, artifact.size, path))
+    with open(os.path.join(os.path.dirname(source), "md5sums.txt"), "w") as f:
+        for artifact in artifacts:
+            f.write(f"{artifact.md5}  src/{os.path.basename(artifact.path)}\n")
+    if index:
+        for artifact in artifacts:
+            print("  indexed", os.path.relpath(reprotar.write_index(artifact)))
+
+
+class Exclusions:
+    """Glob patterns for paths which are left out of the exported tree.
+
+    Patterns are matched against paths relative to the root of the tree,
+    as in .gitignore: a pattern starting with "/" is anchored to the root,
+    any other pattern matches a file or directory name at any depth.
+    """
+
+    def __init__(self, *patterns: str) -> None:
+        self.patterns = patterns
+        self.anchored = self._compile(p[1:] for p in patterns if p.startswith("/"))
+        self.names = self._compile(p for p in patterns if not p.startswith("/"))
+
+    @staticmethod
+    def _compile(patterns: Iterable[str]) -> re.Pattern[str]:
+        # "(?!)" never matches.
+        return re.compile("|".join(map(fnmatch.translate, patterns)) or "(?!)")
+
+    def match(self, path: str) -> bool:
+        """Is this path excluded by a pattern?"""
+        return bool(
+            self.anchored.match(path) or self.names.match(path.rsplit("/", 1)[-1])
+        )
+
+    def excludes(self, path: str) -> bool:
+        """Is this path, or one of the directories containing it, excluded?"""
+        parts = path.split("/")
+        return any(self.match("/".join(parts[:i])) for i in range(1, len(parts) + 1))
+
+
+# Paths we don't want to ship in tarballs.  Misc/NEWS.d is removed
+# separately by "blurb export", after "blurb merge" and the docs used it.
+EXPORT_EXCLUDES = Exclusions(
+    # Byte code.
+    "__pycache__",
+    "*.py[co]",
+    # VCS and CI files.
+    "/.azure-pipelines",
+    "/.bzrignore",
+    "/.codecov.yml",
+    "/.git",
+    "/.gitattributes",
+    "/.github",
+    "/.gitignore",
+    "/.hg",
+    "/.hgeol",
+    "/.hgignore",
+    "/.hgtags",
+    "/.hgtouch",
+    "/.mention-bot",
+    "/.travis.yml",
+    # Doc build artifacts.
+    "/Doc/build",
+    "/Doc/dist",
+    "/Doc/venv",
+    "/Doc/tools/docutils",
+    "/Doc/tools/jinja2",
+    "/Doc/tools/pygments",
+    "/Doc/tools/sphinx",
+)
+
+
+@dataclass
+class CleanupReport:
+    """Paths removed by clean_tree, relative to the root of the tree."""
+
+    removed: list[str]
+    seconds: float
+
+
+def clean_tree(root: str, exclusions: Exclusions = EXPORT_EXCLUDES) -> CleanupReport:
+    """Remove the excluded paths from a tree, in a single walk.
+
+    Excluded directories are removed as a whole without being walked.
+    """
+    start = time.perf_counter()
+    removed: list[str] = []
+
+    def walk(path: str, relative: str) -> None:
+        with os.scandir(path) as scan:
+            entries = sorted(scan, key=lambda entry: entry.name)
+        for entry in entries:
+            name = relative + entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if exclusions.match(name):
+                if is_dir:
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+                removed.append(name)
+            elif is_dir:
+                walk(entry.path, name + "/")
+
+    walk(root, "")
+    return CleanupReport(removed, time.perf_counter() - start)
+
+
+def extract_tag(
+    tag: Tag,
+    archivename: str,
+    path: str,
+    silent: bool = False,
+    pathspecs: Sequence[str] = (),
+) -> None:
+    """Extract the tree of a tag into path/archivename.
+
+    The output of "git archive" is extracted as it is read, without the
+    paths excluded by EXPORT_EXCLUDES.  `pathspecs` limits the extraction
+    to part of the tree.
+    """
+    cmd = [
+        "git",
+        "archive",
+        "--format=tar",
+        f"--prefix={archivename}/",
+        tag.gitname,
+        *pathspecs,
+    ]
+    print("Skipping VCS .*ignore, .git*, et al")
+
+    def members(tar: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+        for member in tar:
+            name = member.name.removeprefix(f"{archivename}/")
+            if not EXPORT_EXCLUDES.excludes(name):
+                yield member
+
+    # A tarfile.ReadError from an archive git didn't finish is replaced
+    # by the error of git, and one from an archive it did is raised.
+    with stream_cmd(cmd, silent=silent) as stdout:
+        with tarfile.open(fileobj=stdout, mode="r|") as tar:
+            tar.extractall(path, members=members(tar), filter="tar")
+
+
+# What "blurb merge" needs: the files it uses to find the root of a
+# CPython checkout, and the news entries.
+BLURB_PATHSPECS = (
+    "README*",
+    "LICENSE",
+    "Include/Python.h",
+    "Python/ceval.c",
+    "Misc/NEWS.d",
+)
+
+# A treeless export leaves out what "blurb export" removes from the tree.
+TREELESS_EXCLUDES = Exclusions(*EXPORT_EXCLUDES.patterns, "/Misc/NEWS.d")
+
+
+def merge_news(tag: Tag, silent: bool = False) -> bytes:
+    """Return the Misc/NEWS that "blurb merge" makes for a tag."""
+    with tempfile.TemporaryDirectory() as path:
+        extract_tag(tag, "cpython", path, silent=silent, pathspecs=BLURB_PATHSPECS)
+        run_cmd(["blurb", "merge"], silent=silent, cwd=os.path.join(path, "cpython"))
+        with open(os.path.join(path, "cpython", "Misc", "NEWS"), "rb") as news:
+            return news.read()
+
+
+def git_tree_entries(
+    tag: Tag,
+    archivename: str,
+    overlay: Mapping[str, bytes],
+    exclusions: Exclusions = TREELESS_EXCLUDES,
+) -> Iterator[reprotar.TarEntry]:
+    """Tar entries for the tree of a tag, read straight from git objects.
+
+    The entries are those an export would archive from disk: the tagged
+    tree without the excluded paths, with the files in `overlay` (paths
+    relative to the root of the tree) added or replaced.  Every entry gets
+    the commit time as mtime, like "git archive" does.
+    """
+    mtime = int(tag.committed_at.timestamp())
+    repo = gitquery.repository()
+    # Path -> (git file mode, object name), and the names in each directory.
+    tree: dict[str, tuple[str, str]] = {}
+    children: dict[str, list[str]] = {"": []}
+    try:
+        for entry in repo.walk_tree(tag.gitname):
+            if not exclusions.excludes(entry.path):
+                tree[entry.path] = (entry.mode, entry.object_name)
+    except gitquery.GitError as e:
+        error(f"Couldn't read the tree of {tag.gitname}: {e}")
+    for path in overlay:
+        tree[path] = ("100644", "")
+    for path, (mode, _) in tree.items():
+        if mode in ("40000", "160000"):
+            children[path] = []
+    for path in tree:
+        parent, _, name = path.rpartition("/")
+        children[parent].append(name)
+
+    def tarinfo(name: str, type: bytes, mode: int, size: int = 0) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mode = mode
+        info.size = size
+        info.mtime = mtime
+        return info
+
+    def walk(directory: str) -> Iterator[reprotar.TarEntry]:
+        for name in sorted(children[directory]):
+            path = f"{directory}/{name}" if directory else name
+            arcname = f"{archivename}/{path}"
+            mode, object_name = tree[path]
+            if path in overlay:
+                data = overlay[path]
+                info = tarinfo(arcname, tarfile.REGTYPE, 0o644, len(data))
+                yield info, io.BytesIO(data)
+            elif mode in ("40000", "160000"):
+                # Submodules are archived as empty directories.
+                yield tarinfo(arcname, tarfile.DIRTYPE, 0o755), None
+                yield from walk(path)
+            elif mode == "120000":
+                info = tarinfo(arcname, tarfile.SYMTYPE, 0o777)
+                info.linkname = os.fsdecode(repo.read_blob(object_name))
+                yield info, None
+            else:
+                data = repo.read_blob(object_name)
+                file_mode = 0o755 if mode == "100755" else 0o644
+                info = tarinfo(arcname, tarfile.REGTYPE, file_mode, len(data))
+                yield info, io.BytesIO(data)
+
+    yield tarinfo(archivename, tarfile.DIRTYPE, 0o755), None
+    yield from walk("")
+
+
+def export_cache_root() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "python-release", "export")
+
+
+class ExportCache:
+    """The last exported tree of each branch, kept up to date with git diffs.
+
+    A respin only changes a few files, so instead of extracting the whole
+    tree again, the cached tree of the branch is moved to the new tag by
+    applying the diff between the two, and copied out with hardlinks.
+    Files are never changed in place, only replaced, so earlier copies keep
+    their content, and export() copies the files it changes itself.
+    """
+
+    def __init__(self, root: str | None = None) -> None:
+        self.root = root or export_cache_root()
+
+    def checkout(self, tag: Tag, silent: bool = False) -> str:
+        """Return the path of a cached tree of the tag, like extract_tag's."""
+        repo = gitquery.repository()
+        branch_dir = os.path.join(self.root, tag.basic_version)
+        tree = os.path.join(branch_dir, "tree")
+        state_path = os.path.join(branch_dir, "state.json")
+        try:
+            with open(state_path) as f:
+                cached = json.load(f)["commit"]
+            repo.commit(cached)
+        except (OSError, ValueError, KeyError, TypeError, gitquery.GitError):
+            cached = None
+
+        os.makedirs(branch_dir, exist_ok=True)
+        # Until the tree is complete, it can't be trusted.
+        with open(state_path, "w") as f:
+            json.dump({"commit": None}, f)
+        commit = repo.commit(tag.gitname)
+        if cached is not None and os.path.isdir(tree):
+            changes = repo.diff(cached, commit)
+            print(
+                f"Updating the cached tree from {cached[:12]}: {len(changes)} changes"
+            )
+            for change in changes:
+                if not EXPORT_EXCLUDES.excludes(change.path):
+                    self.apply(repo, tree, change)
+        else:
+            print("Extracting the tree into the export cache")
+            shutil.rmtree(tree, ignore_errors=True)
+            extract_tag(tag, "tree", branch_dir, silent=silent)
+
+        # "git archive" gives everything the commit time.
+        mtime = tag.committed_at.timestamp()
+        for directory, dirs, files in os.walk(tree):
+            for name in dirs + files:
+                path = os.path.join(directory, name)
+                os.utime(path, (mtime, mtime), follow_symlinks=False)
+        os.utime(tree, (mtime, mtime))
+        with open(state_path, "w") as f:
+            json.dump({"commit": commit, "tag": tag.gitname}, f)
+        return tree
+
+    @staticmethod
+    def apply(
+        repo: gitquery.GitRepository, tree: str, change: gitquery.DiffEntry
+    ) -> None:
+        path = os.path.join(tree, change.path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        if change.status == "D":
+            if os.path.lexists(path):
+                os.unlink(path)
+            # git doesn't keep empty directories.
+            parent = os.path.dirname(path)
+            while parent != tree and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+            return
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        if change.mode == "160000":
+            # Submodules are archived as empty directories.
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.mkdir(path, 0o755)
+            return
+        data = repo.read_blob(change.object_name)
+        tmp = f"{path}.export-tmp"
+        if change.mode == "120000":
+            os.symlink(os.fsdecode(data), tmp)
+        else:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.chmod(tmp, 0o755 if change.mode == "100755" else 0o644)
+        os.replace(tmp, path)
+
+
+def link_tree(src: str, dst: str, copied: Sequence[str] = ()) -> None:
+    """Copy a tree with hardlinks, except for the paths under `copied`.
+
+    The files that are written to in place must be copied, or writing
+    them would change the tree they come from too.
+    """
+
+    def link(source: str, target: str) -> None:
+        name = os.path.relpath(source, src).replace(os.sep, "/")
+        if any(name == path or name.startswith(f"{path}/") for path in copied):
+            shutil.copy2(source, target)
+        else:
+            os.link(source, target)
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=link)
+
+
+def export(
+    tag: Tag,
+    silent: bool = False,
+    skip_docs: bool = False,
+    zstd: bool = False,
+    treeless: bool = False,
+    cache: ExportCache | None = None,
+    jobs: int | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    index: bool = False,
+) -> None:
+    """Export the source tarballs of a tag, and the docs of a release.
+
+    `jobs` and `executor` are passed on to reprotar, so that several
+    exports can share their compression threads.
+    """
     make_dist(tag.text)
     print("Exporting tag:", tag.text)
     archivename = f"Python-{tag.text}"
-    # I have not figured out how to get git to directly produce an
-    # archive directory like hg can, so use git to produce a temporary
-    # tarball then expand it with tar.
-    archivetempfile = f"{archivename}.tar"
-    run_cmd(
-        [
-            "git",
-            "archive",
-            "--format=tar",
-            f"--prefix={archivename}/",
-            "-o",
-            archivetempfile,
-            tag.gitname,
-        ],
-        silent=silent,
+    if treeless:
+        if not skip_docs and (tag.is_final or tag.level == "rc"):
+            error("A treeless export can't build the docs, use --skip-docs")
+        export_treeless(
+            tag,
+            archivename,
+            silent=silent,
+            zstd=zstd,
+            jobs=jobs,
+            executor=executor,
+            index=index,
+        )
+        return
+    dist = os.path.abspath(tag.text)
+    tree = os.path.join(dist, archivename)
+    # Touch a few files that get generated so they're up-to-date in
+    # the tarball.
+    #
+    # Note, with the demise of "make touch" and the hg touch
+    # extension, touches should not be needed anymore,
+    # but keep it for now as a reminder.
+    maybe_touchables = [
+        "Include/Python-ast.h",
+        "Include/internal/pycore_ast.h",
+        "Include/internal/pycore_ast_state.h",
+        "Python/Python-ast.c",
+        "Python/opcode_targets.h",
+    ]
+    if cache is None:
+        extract_tag(tag, archivename, dist, silent=silent)
+    else:
+        cached = cache.checkout(tag, silent=silent)
+        if os.path.exists(tree):
+            print(f"Replacing {tag.text}/{archivename}")
+            shutil.rmtree(tree)
+        # "blurb merge" rewrites Misc/NEWS, and the touches change the
+        # mtime every link of a file shares.
+        link_tree(cached, tree, copied=("Misc/NEWS", *maybe_touchables))
+
+    touchables = [
+        file for file in maybe_touchables if os.path.exists(os.path.join(tree, file))
+    ]
+    print(
+        "Touching:",
+        COMMASPACE.join(name.rsplit("/", 1)[-1] for name in touchables),
     )
-    with pushd(tag.text):
-        archivetempfile = f"../{archivetempfile}"
-        run_cmd(["tar", "-xf", archivetempfile], silent=silent)
-        os.unlink(archivetempfile)
-        with pushd(archivename):
-            # Touch a few files that get generated so they're up-to-date in
-            # the tarball.
-            #
-            # Note, with the demise of "make touch" and the hg touch
-            # extension, touches should not be needed anymore,
-            # but keep it for now as a reminder.
-            maybe_touchables = [
-                "Include/Python-ast.h",
-                "Include/internal/pycore_ast.h",
-                "Include/internal/pycore_ast_state.h",
-                "Python/Python-ast.c",
-                "Python/opcode_targets.h",
-            ]
-            touchables = [file for file in maybe_touchables if os.path.exists(file)]
-            print(
-                "Touching:",
-                COMMASPACE.join(name.rsplit("/", 1)[-1] for name in touchables),
-            )
-            for name in touchables:
-                os.utime(name, None)
-
-            # build docs *before* we do "blurb export"
-            # because docs now depend on Misc/NEWS.d
-            # and we remove Misc/NEWS.d as part of cleanup for export
-            #
-            # If --skip-docs is provided we don't build and docs.
-            if not skip_docs and (tag.is_final or tag.level == "rc"):
-                docdist = build_docs()
-
-            print("Using blurb to build Misc/NEWS")
-            run_cmd(["blurb", "merge"], silent=silent)
-
-            # Remove files we don't want to ship in tarballs.
-            print("Removing VCS .*ignore, .git*, Misc/NEWS.d, et al")
-            for name in (
-                ".gitattributes",
-                ".gitignore",
-                ".hgignore",
-                ".hgeol",
-                ".hgtags",
-                ".hgtouch",
-                ".bzrignore",
-                ".codecov.yml",
-                ".mention-bot",
-                ".travis.yml",
-            ):
-                try:
-                    os.unlink(name)
-                except OSError:
-                    pass
+    for name in touchables:
+        os.utime(os.path.join(tree, name), None)
+
+    # The docs and the source tarballs only share the tree as extracted:
+    # the docs need Misc/NEWS.d, which "blurb export" removes.  So the
+    # docs are built in a copy of it, while the tarballs are made, and
+    # the two only meet to copy the docs into the dist directory.
+    #
+    # If --skip-docs is provided we don't build and docs.
+    # The compression blocks go to the caller's executor, or to a pool of
+    # `jobs` threads made by reprotar, never to the docs thread.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as docs_pool:
+        docs = None
+        if not skip_docs and (tag.is_final or tag.level == "rc"):
+            docs_tree = os.path.join(dist, "docs-build", archivename)
+            # The docs build writes to the tree while "blurb merge" does.
+            link_tree(tree, docs_tree, copied=("Doc", "Misc"))
+            docs = docs_pool.submit(build_docs, docs_tree)
+
+        package_source(
+            tag,
+            tree,
+            silent=silent,
+            zstd=zstd,
+            jobs=jobs,
+            executor=executor,
+            index=index,
+        )
+        if docs is not None:
+            shutil.copytree(docs.result(), os.path.join(dist, "docs"))
+            shutil.rmtree(os.path.join(dist, "docs-build"))
+    finish_export(tag, archivename)
 
-            # Remove directories we don't want to ship in tarballs.
-            run_cmd(["blurb", "export"], silent=silent)
-            for name in (".azure-pipelines", ".git", ".github", ".hg"):
-                shutil.rmtree(name, ignore_errors=True)
 
-        if not skip_docs and (tag.is_final or tag.level == "rc"):
-            shutil.copytree(docdist, "docs")
-
-        with pushd(os.path.join(archivename, "Doc")):
-            print("Removing doc build artifacts")
-            shutil.rmtree("venv", ignore_errors=True)
-            shutil.rmtree("build", ignore_errors=True)
-            shutil.rmtree("dist", ignore_errors=True)
-            shutil.rmtree("tools/docutils", ignore_errors=True)
-            shutil.rmtree("tools/jinja2", ignore_errors=True)
-            shutil.rmtree("tools/pygments", ignore_errors=True)
-            shutil.rmtree("tools/sphinx", ignore_errors=True)
-
-        with pushd(archivename):
-            print("Zapping pycs")
-            run_cmd(
-                [
-                    "find",
-                    ".",
-                    "-depth",
-                    "-name",
-                    "__pycache__",
-                    "-exec",
-                    "rm",
-                    "-rf",
-                    "{}",
-                    ";",
-                ],
-                silent=silent,
-            )
-            run_cmd(
-                ["find", ".", "-name", "*.py[co]", "-exec", "rm", "-f", "{}", ";"],
-                silent=silent,
-            )
+# Bytes of blobs kept in memory by a batch export, for the files shared
+# by the branches being exported.
+EXPORT_BLOB_CACHE_SIZE = 512 * 1024 * 1024
+
+
+def export_many(
+    tags: Sequence[Tag],
+    jobs: int | None = None,
+    cache: ExportCache | None = None,
+    **options: Any,
+) -> None:
+    """Export several tags at once, like the branches of a security release.
+
+    Each tag is exported as by export(), in its own thread, but all of them
+    share one pool of `jobs` compression threads.  With an export cache,
+    the tags of one branch share its cached tree, so they are exported one
+    after the other.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    gitquery.repository().blob_cache_size = EXPORT_BLOB_CACHE_SIZE
+    groups: dict[str, list[Tag]] = {}
+    for tag in tags:
+        key = tag.basic_version if cache is not None else tag.text
+        groups.setdefault(key, []).append(tag)
+
+    def export_group(group: list[Tag]) -> None:
+        for tag in group:
+            export(tag, cache=cache, jobs=jobs, executor=executor, **options)
+
+    failed = []
+    with (
+        concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor,
+        concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as exports,
+    ):
+        futures = {
+            exports.submit(export_group, group): group for group in groups.values()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except (Exception, SystemExit) as e:
+                # error() exits with its message already printed.
+                names = COMMASPACE.join(tag.text for tag in futures[future])
+                failed.append(names if isinstance(e, SystemExit) else f"{names}: {e}")
+    if failed:
+        error("Failed to export:", *failed)
+
+
+def package_source(
+    tag: Tag,
+    tree: str,
+    silent: bool = False,
+    zstd: bool = False,
+    jobs: int | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    index: bool = False,
+) -> None:
+    """Make the source tarballs of an exported tree."""
+    print("Using blurb to build Misc/NEWS")
+    run_cmd(["blurb", "merge"], silent=silent, cwd=tree)
+
+    # Remove Misc/NEWS.d, we don't want to ship it in tarballs.
+    run_cmd(["blurb", "export"], silent=silent, cwd=tree)
+
+    print("Removing doc build artifacts, pycs and VCS files")
+    report = clean_tree(tree)
+    if not silent:
+        for name in report.removed:
+            print(f"  {name}")
+    print(f"Removed {len(report.removed)} paths in {report.seconds:.2f}s")
+
+    os.mkdir(os.path.join(os.path.dirname(tree), "src"))
+    tarball(
+        tree,
+        tag.committed_at,
+        jobs=jobs,
+        zstd=zstd,
+        executor=executor,
+        index=index,
+    )
+
 
-        os.mkdir("src")
-        tarball(archivename, tag.committed_at.strftime("%Y-%m-%d %H:%M:%SZ"))
+def export_treeless(
+    tag: Tag,
+    archivename: str,
+    silent: bool = False,
+    zstd: bool = False,
+    jobs: int | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    index: bool = False,
+) -> None:
+    """Make the tarballs of an export without writing the tree to disk.
+
+    Only Misc/NEWS is generated; the touched files only get a new mtime,
+    which is clamped to the commit time in the tarballs anyway.
+    """
+    print("Using blurb to build Misc/NEWS")
+    overlay = {"Misc/NEWS": merge_news(tag, silent=silent)}
+    dist = os.path.abspath(tag.text)
+    os.mkdir(os.path.join(dist, "src"))
+    entries = git_tree_entries(tag, archivename, overlay)
+    tarball(
+        os.path.join(dist, archivename),
+        tag.committed_at,
+        jobs=jobs,
+        zstd=zstd,
+        entries=entries,
+        executor=executor,
+        index=index,
+    )
+    finish_export(tag, archivename)
+
+
+def finish_export(tag: Tag, archivename: str) -> None:
+    dist = os.path.abspath(tag.text)
+    print("Verifying the tarballs against the git tree")
+    report = verify_tarballs(
+        tag,
+        archivename,
+        [os.path.join(dist, "src", archivename + ext) for ext in (".tgz", ".tar.xz")],
+    )
+    with open(os.path.join(dist, "verification.json"), "w") as f:
+        f.write(report.to_json())
+    if not report.ok:
+        error(
+            f"The tarballs don't match {tag.gitname}, "
+            f"see {tag.text}/verification.json:",
+            *report.problems[:20],
+        )
+    print(
+        f"Verified {report.members} members of {len(report.tarballs)} tarballs "
+        f"in {report.seconds:.2f}s"
+    )
     print()
     print(f"**Now extract the archives in {tag.text}/src and run the tests**")
     print("**You may also want to run make install and re-test**")
 
 
-def build_docs() -> str:
-    """Build and tarball the documentation"""
-    print("Building docs")
-    with tempfile.TemporaryDirectory() as venv:
-        run_cmd(["python3", "-m", "venv", venv])
-        pip = os.path.join(venv, "bin", "pip")
-        run_cmd([pip, "install", "-r", "Doc/requirements.txt"])
-        sphinx_build = os.path.join(venv, "bin", "sphinx-build")
-        blurb = os.path.join(venv, "bin", "blurb")
-        with pushd("Doc"):
-            run_cmd(
-                ["make", "dist", "SPHINXBUILD=" + sphinx_build, "BLURB=" + blurb],
-                env={**os.environ, "SPHINXOPTS": "-j10"},
-            )
-            return os.path.abspath("dist")
+@dataclass
+class VerificationReport:
+    tag: str
+    tarballs: list[str]
+    members: int = 0
+    problems: list[str] = field(default_factory=list)
+    seconds: float = 0.0
 
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "tag": self.tag,
+                "tarballs": self.tarballs,
+                "members": self.members,
+                "ok": self.ok,
+                "problems": self.problems,
+                "seconds": round(self.seconds, 3),
+            },
+            indent=2,
+            sort_keys=True,
+        )
 
-def upload(tag: Tag, username: str) -> None:
-    """scp everything to dinsdale"""
-    address = f'"{username}@dinsdale.python.org:'
 
-    def scp(from_loc: str, to_loc: str) -> None:
-        run_cmd(["scp", from_loc, address + to_loc])
+# (type, mode, size, linkname, mtime, git object name) of a tarball member.
+MemberRecord = tuple[bytes, int, int, str, int, str | None]
+
+
+def git_blob_name(data: bytes) -> str:
+    """The name git gives a blob with this content."""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def open_decompressed(path: str) -> IO[bytes]:
+    """Open a tarball through gzip or lzma, which check its trailer at EOF."""
+    if path.endswith((".tgz", ".gz")):
+        return cast(IO[bytes], gzip.GzipFile(path))
+    if path.endswith(".xz"):
+        return cast(IO[bytes], lzma.LZMAFile(path))
+    return open(path, "rb")
+
+
+def tarball_records(path: str) -> Iterator[tuple[str, MemberRecord]]:
+    """Stream the members of a tarball, with git names for their contents.
+
+    The stream is read to its end after the last member, so a truncated
+    or corrupt compression trailer raises an error too: tarfile's stream
+    mode stops at the end of the tar data.
+    """
+    with open_decompressed(path) as stream:
+        tar = tarfile.open(fileobj=stream, mode="r|")
+        for member in tar:
+            object_name = None
+            if member.isfile():
+                digest = hashlib.sha1(b"blob %d\0" % member.size)
+                fileobj = tar.extractfile(member)
+                assert fileobj is not None
+                while chunk := fileobj.read(1024 * 1024):
+                    digest.update(chunk)
+                object_name = digest.hexdigest()
+            elif member.issym():
+                object_name = git_blob_name(os.fsencode(member.linkname))
+            record = (
+                member.type,
+                member.mode,
+                member.size,
+                member.linkname,
+                member.mtime,
+                object_name,
+            )
+            yield member.name, record
+        while stream.read(1024 * 1024):
+            pass
+
+
+def verify_tarballs(
+    tag: Tag,
+    archivename: str,
+    tarballs: Sequence[str],
+    exclusions: Exclusions = TREELESS_EXCLUDES,
+    generated: Iterable[str] = ("Misc/NEWS",),
+) -> VerificationReport:
+    """Check tarballs against each other and against the tree of a tag.
+
+    The tarballs are decompressed concurrently and compared member by
+    member as they are read, so nothing is extracted to disk.  They must
+    hold the same members, and those must be the tagged tree without the
+    excluded paths, plus the generated files.
+    """
+    start = time.perf_counter()
+    report = VerificationReport(tag.gitname, [os.path.basename(t) for t in tarballs])
+    expected = {}
+    for entry in gitquery.repository().walk_tree(tag.gitname):
+        if not exclusions.excludes(entry.path):
+            expected[entry.path] = entry
+    generated_paths = set(generated)
+    unseen = set(expected) | generated_paths
+
+    def check(name: str, record: MemberRecord) -> None:
+        member_type, mode, _, _, _, object_name = record
+        if name == archivename:
+            if member_type != tarfile.DIRTYPE:
+                report.problems.append(f"{name}: not a directory")
+            return
+        if not name.startswith(archivename + "/"):
+            report.problems.append(f"{name}: outside {archivename}/")
+            return
+        path = name[len(archivename) + 1 :]
+        unseen.discard(path)
+        if path in generated_paths:
+            return
+        entry = expected.get(path)
+        if entry is None:
+            report.problems.append(f"{path}: not in {tag.gitname}")
+        elif entry.mode in ("40000", "160000"):
+            if member_type != tarfile.DIRTYPE:
+                report.problems.append(f"{path}: should be a directory")
+        elif entry.mode == "120000":
+            if member_type != tarfile.SYMTYPE or object_name != entry.object_name:
+                report.problems.append(f"{path}: should be a symlink")
+        elif member_type != tarfile.REGTYPE:
+            report.problems.append(f"{path}: should be a file")
+        elif object_name != entry.object_name:
+            report.problems.append(f"{path}: content differs")
+        elif mode != (0o755 if entry.mode == "100755" else 0o644):
+            report.problems.append(f"{path}: mode is {mode:o}")
+
+    def produce(path: str, records: queue.Queue[Any]) -> None:
+        try:
+            for record in tarball_records(path):
+                records.put(record)
+        except (OSError, EOFError, tarfile.TarError, lzma.LZMAError) as e:
+            records.put(e)
+        records.put(None)
+
+    streams: list[queue.Queue[Any]] = [queue.Queue(maxsize=256) for _ in tarballs]
+    with concurrent.futures.ThreadPoolExecutor(len(tarballs)) as executor:
+        for path, records in zip(tarballs, streams):
+            executor.submit(produce, path, records)
+        running = [True] * len(streams)
+        # Once the members of the tarballs stop lining up, they are reported
+        # once, and only the first tarball is still checked against the tree.
+        mismatched = False
+        while any(running):
+            items = []
+            for i, records in enumerate(streams):
+                item = records.get() if running[i] else None
+                if isinstance(item, Exception):
+                    report.problems.append(f"{report.tarballs[i]}: {item}")
+                    item = records.get()
+                if item is None:
+                    running[i] = False
+                items.append(item)
+            if not mismatched:
+                names = {item[0] if item is not None else None for item in items}
+                if len(names) > 1:
+                    report.problems.append("The tarballs have different members")
+                    mismatched = True
+                elif any(item != items[0] for item in items):
+                    name = items[0][0]
+                    report.problems.append(f"{name}: differs between the tarballs")
+            if items[0] is not None:
+                report.members += 1
+                check(*items[0])
+    for path in sorted(unseen):
+        report.problems.append(f"{path}: missing from the tarballs")
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+# The targets of Doc/Makefile which "make dist" runs one after the other,
+# besides dist-html.
+DOCS_DIST_TARGETS = ("dist-text", "dist-pdf", "dist-epub", "dist-texinfo")
+
+
+def sphinx_jobs(concurrent: int = 1) -> int:
+    """The -j for one of `concurrent` Sphinx builds sharing the cores."""
+    return max(1, (os.cpu_count() or 1) // concurrent)
+
+
+def makefile_targets(makefile: str) -> set[str]:
+    """The targets a Makefile has rules for."""
+    with open(makefile) as f:
+        rules = re.findall(r"^([\w.\- \t]+):(?!=)", f.read(), re.MULTILINE)
+    return {target for rule in rules for target in rule.split()}
+
+
+def build_docs(tree: str) -> str:
+    """Build and tarball the documentation of a tree"""
+    print("Building docs")
+    doc = os.path.join(tree, "Doc")
+    # The environment stays locked in the cache while the docs are built,
+    # so another export sharing the cache can't evict or rebuild it.
+    requirements = os.path.join(doc, "requirements.txt")
+    try:
+        with docsenv.DocsEnvironmentCache().use(requirements) as venv:
+            return build_docs_dist(doc, os.path.join(venv, "bin"))
+    except docsenv.DocsEnvironmentError as e:
+        error(f"Couldn't set up the docs environment: {e}")
+
+
+def build_docs_dist(doc: str, bin_dir: str) -> str:
+    """Build the docs dist of a Doc directory with its Makefile, using every core.
+
+    "make dist-html" runs first and leaves the pickled environment in
+    build/doctrees.  The other dist-* targets then run concurrently, each
+    from its own copy of it, so none of them reads the sources again, and
+    the cores are split between them.  If the Makefile of the branch
+    doesn't have these targets, "make dist" builds everything in turn.
+    """
+    doc = os.path.abspath(doc)
+    dist = os.path.join(doc, "dist")
+    shutil.rmtree(dist, ignore_errors=True)
+
+    def make(target: str, jobs: int, doctrees: str = "build/doctrees") -> list[str]:
+        return [
+            "make",
+            f"-j{jobs}",
+            target,
+            f"SPHINXBUILD={os.path.join(bin_dir, 'sphinx-build')}",
+            f"BLURB={os.path.join(bin_dir, 'blurb')}",
+            f"PYTHON={os.path.join(bin_dir, 'python')}",
+            # Given after the Makefile's own options, so these win.
+            f"SPHINXOPTS=-j {jobs} -d {doctrees}",
+        ]
 
-    with pushd(tag.text):
-        print("Uploading source tarballs")
-        scp("src", f"/data/python-releases/{tag.nickname}")
-        print("Upload doc tarballs")
-        scp("docs", f"/data/python-releases/doc/{tag.nickname}")
-        print(
-            "* Now change the permissions on the tarballs so they are "
-            "writable by the webmaster group. *"
+    targets = makefile_targets(os.path.join(doc, "Makefile"))
+    if not targets.issuperset(("dist-html", *DOCS_DIST_TARGETS)):
+        run_cmd(make("dist", sphinx_jobs()), cwd=doc)
+        return dist
+
+    run_cmd(make("dist-html", sphinx_jobs()), cwd=doc)
+    jobs = sphinx_jobs(len(DOCS_DIST_TARGETS))
+    commands = []
+    for target in DOCS_DIST_TARGETS:
+        doctrees = os.path.join("build", f"doctrees-{target}")
+        shutil.rmtree(os.path.join(doc, doctrees), ignore_errors=True)
+        shutil.copytree(
+            os.path.join(doc, "build", "doctrees"), os.path.join(doc, doctrees)
         )
+        commands.append(make(target, jobs, doctrees))
+    print("Building the other docs formats")
+    run_many(commands, names=DOCS_DIST_TARGETS, cwd=doc)
+    return dist
+
+
+def upload(tag: Tag, username: str, streams: int = transfer.STREAMS) -> None:
+    """Upload everything to dinsdale"""
+    uploader = transfer.Uploader(f"{username}@dinsdale.python.org", streams=streams)
+    dist = os.path.abspath(tag.text)
+    uploads = [
+        ("source tarballs", "src", f"/data/python-releases/{tag.nickname}"),
+        ("doc tarballs", "docs", f"/data/python-releases/doc/{tag.nickname}"),
+    ]
+    for what, local_dir, remote_dir in uploads:
+        if not os.path.isdir(os.path.join(dist, local_dir)):
+            print(f"No {what} in {tag.text}/{local_dir}, skipping")
+            continue
+        print(f"Uploading {what}")
+        try:
+            report = uploader.upload_dir(os.path.join(dist, local_dir), remote_dir)
+        except transfer.UploadError as e:
+            error(f"Uploading {what} failed: {e}")
+        print(report.summary())
+    print(
+        "* Now change the permissions on the tarballs so they are "
+        "writable by the webmaster group. *"
+    )
 
 
-def make_tag(tag: Tag) -> bool:
+def make_tag(tag: Tag, repo: str = ".") -> bool:
     # make sure we've run blurb export
-    good_files = glob.glob("Misc/NEWS.d/" + str(tag) + ".rst")
-    bad_files = list(glob.glob("Misc/NEWS.d/next/*/0*.rst"))
-    bad_files.extend(glob.glob("Misc/NEWS.d/next/*/2*.rst"))
+    news = os.path.join(glob.escape(repo), "Misc", "NEWS.d")
+    good_files = glob.glob(os.path.join(news, f"{tag}.rst"))
+    bad_files = list(glob.glob(os.path.join(news, "next", "*", "0*.rst")))
+    bad_files.extend(glob.glob(os.path.join(news, "next", "*", "2*.rst")))
     if bad_files or not good_files:
         print('It doesn\'t look like you ran "blurb release" yet.')
         if bad_files:
@@ -595,10 +1468,29 @@ def make_tag(tag: Tag) -> bool:
             print("Aborting.")
             return False
 
+    # make sure the tag follows the releases of its branch
+    history = ReleaseHistory.from_repository(repo)
+    if tag in history:
+        print(f"{tag.gitname} already exists.")
+        return False
+    latest = history.latest(tag.basic_version)
+    if latest is not None and latest > tag:
+        print(f"{tag.gitname} is older than {latest.gitname}, the latest release.")
+        if input("Are you sure you want to tag? (y/n) > ") not in ("y", "yes"):
+            print("Aborting.")
+            return False
+    previous = history.previous(tag)
+    print("Previous release on the branch:", previous or "none")
+    if tag.is_final and tag.patch == 0 and history.latest_rc(tag.basic_version) is None:
+        print(f"There is no release candidate of {tag.basic_version}.")
+        if input("Are you sure you want to tag? (y/n) > ") not in ("y", "yes"):
+            print("Aborting.")
+            return False
+
     # make sure we're on the correct branch
     if tag.patch > 0:
         if (
-            get_output(["git", "name-rev", "--name-only", "HEAD"]).strip().decode()
+            gitquery.repository(repo).run("name-rev", "--name-only", "HEAD")
             != tag.basic_version
         ):
             print("It doesn't look like you're on the correct branch.")
@@ -612,14 +1504,17 @@ def make_tag(tag: Tag) -> bool:
     uid = os.environ.get("GPG_KEY_FOR_RELEASE")
     if not uid:
         print("List of available private keys:")
-        run_cmd(['gpg -K | grep -A 1 "^sec"'], shell=True)
+        run_cmd('gpg -K | grep -A 1 "^sec"', shell=True)
         uid = input("Please enter key ID to use for signing: ")
-    run_cmd(["git", "tag", "-s", "-u", uid, tag.gitname, "-m", "Python " + str(tag)])
+    run_cmd(
+        ["git", "tag", "-s", "-u", uid, tag.gitname, "-m", "Python " + str(tag)],
+        cwd=repo,
+    )
     return True
 
 
-def done(tag: Tag) -> None:
-    tweak_patchlevel(tag, done=True)
+def done(tag: Tag, repo: str = ".") -> None:
+    tweak_patchlevel(tag, done=True, repo=repo)
 
 
 def main(argv: Any) -> None:
@@ -628,14 +1523,39 @@ def main(argv: Any) -> None:
     options, args = parser.parse_args(argv)
     if options.skip_docs and not options.export:
         error("--skip-docs option has no effect without --export")
-    if len(args) != 2:
+    if options.zstd and not options.export:
+        error("--zstd option has no effect without --export")
+    if options.index and not options.export:
+        error("--index option has no effect without --export")
+    if options.treeless and not options.export:
+        error("--treeless option has no effect without --export")
+    if options.incremental and not options.export:
+        error("--incremental option has no effect without --export")
+    if options.incremental and options.treeless:
+        error("--incremental and --treeless can't be used together")
+    if options.zstd and not reprotar.zstd_available():
+        error("--zstd needs the 'zstandard' package to be installed")
+    if options.jobs is not None and not options.export:
+        error("--jobs option has no effect without --export")
+    if options.jobs is not None and options.jobs < 1:
+        error("--jobs must be at least 1")
+    if len(args) < 2:
         if "RELEASE_TAG" not in os.environ:
             parser.print_usage()
             sys.exit(1)
-        tagname = os.environ["RELEASE_TAG"]
+        tagnames = [os.environ["RELEASE_TAG"]]
     else:
-        tagname = args[1]
-    tag = Tag(tagname)
+        tagnames = args[1:]
+    if len(tagnames) > 1 and not options.export:
+        error("Only --export can be given several tags")
+    if len(tagnames) > 1 and (
+        options.bump or options.tag or options.upload or options.done
+    ):
+        error("--bump, --tag, --upload and --done take a single tag")
+    tags = [Tag(tagname) for tagname in tagnames]
+    if len(set(tags)) != len(tags):
+        error("A tag was given more than once")
+    tag = tags[0]
     if not (options.export or options.upload):
         check_env()
     if options.bump:
@@ -643,9 +1563,29 @@ def main(argv: Any) -> None:
     if options.tag:
         make_tag(tag)
     if options.export:
-        export(tag, skip_docs=options.skip_docs)
+        cache = ExportCache() if options.incremental else None
+        if len(tags) > 1:
+            export_many(
+                tags,
+                jobs=options.jobs,
+                cache=cache,
+                skip_docs=options.skip_docs,
+                zstd=options.zstd,
+                treeless=options.treeless,
+                index=options.index,
+            )
+        else:
+            export(
+                tag,
+                skip_docs=options.skip_docs,
+                zstd=options.zstd,
+                treeless=options.treeless,
+                cache=cache,
+                jobs=options.jobs,
+                index=options.index,
+            )
     if options.upload:
-        upload(tag, options.upload)
+        upload(tag, options.upload, streams=options.streams)
     if options.done:
         done(tag)
 
@@ -0,0 +1,790 @@
+"""Reproducible tarballs for CPython source releases.
+
+This is an in-process replacement for the GNU tar invocation that
+release.py used to run.  It follows the same recipe:
+
+https://www.gnu.org/software/tar/manual/html_node/Reproducibility.html
+https://reproducible-builds.org/docs/archives/
+
+The tar stream is produced once and fed to every compressor, and the
+digests of each compressed artifact are computed as its bytes are written.
+
+All compressors split the tar stream into fixed-size blocks which are
+compressed independently on a shared thread pool, in the manner of pigz and
+'xz --threads'.  The output only depends on the input and the block size,
+never on the number of threads or on scheduling.
+
+An index of a tarball can be written beside it (see write_index), giving
+where each member is in the tar stream and, for xz and zstd, where each
+compressed block is, so IndexedTarball can read a single member without
+decompressing the whole tarball.
+"""
+
+from __future__ import annotations
+
+import bisect
+import collections
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import struct
+import tarfile
+import tempfile
+import threading
+import weakref
+import zlib
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import IO, Any, BinaryIO, Callable, Iterable, Mapping, Protocol, cast
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+# pigz's default block size, and 'xz --threads' default for preset 6
+# (three times the dictionary size).
+GZIP_BLOCK_SIZE = 128 * 1024
+XZ_BLOCK_SIZE = 3 * 8 * 1024 * 1024
+# Size of the deflate window, used to prime each gzip block with the
+# tail of the previous one.
+DEFLATE_WINDOW = 32 * 1024
+XZ_PRESET = 6
+# Each zstd block is an independent frame; decompression speed barely
+# depends on the level, so favour the compression ratio.
+ZSTD_BLOCK_SIZE = 8 * 1024 * 1024
+ZSTD_LEVEL = 19
+
+
+@dataclass(frozen=True)
+class Member:
+    """Where a member is in the tar stream: its header, then its data."""
+
+    name: str
+    type: str
+    offset: int
+    data_offset: int
+    size: int
+
+
+@dataclass(frozen=True)
+class Block:
+    """A compressed block which can be decompressed on its own."""
+
+    offset: int
+    size: int
+    uncompressed_offset: int
+    uncompressed_size: int
+    # For xz, the size of the block without its padding, for its index.
+    unpadded_size: int = 0
+
+
+class Compressor(Protocol):
+    # The blocks written, if they can be decompressed independently.
+    blocks: list[Block]
+
+    def write(self, data: bytes, /) -> int: ...
+
+    def close(self) -> None: ...
+
+    def cancel(self) -> None: ...
+
+
+@dataclass
+class Artifact:
+    """A finished tarball and its digests."""
+
+    path: str
+    size: int
+    md5: str
+    sha256: str
+    members: list[Member] = field(default_factory=list)
+    blocks: list[Block] = field(default_factory=list)
+
+
+class DigestWriter:
+    """Write-only file wrapper which hashes everything passing through it."""
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self.fileobj = fileobj
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.fileobj.write(data)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+    def artifact(self, path: str) -> Artifact:
+        return Artifact(
+            path=path,
+            size=self.size,
+            md5=self.md5.hexdigest(),
+            sha256=self.sha256.hexdigest(),
+        )
+
+
+CompressorFactory = Callable[[DigestWriter, Executor, int], Compressor]
+# A tar header, and the file object with its data for regular files.
+TarEntry = tuple[tarfile.TarInfo, BinaryIO | None]
+
+
+class _PendingBlocks:
+    """A bound on the bytes of blocks waiting to be written, per executor.
+
+    Every compressor using the executor, in any tarball, counts its blocks
+    against the same bound, so the memory they hold doesn't grow with the
+    number of compressors sharing it.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, size: int, force: bool = False) -> bool:
+        """Count a block in, if the bound allows it or `force` is given."""
+        with self.lock:
+            if not force and self.size + size > self.limit:
+                return False
+            self.size += size
+            return True
+
+    def release(self, size: int) -> None:
+        with self.lock:
+            self.size -= size
+
+
+_pending_blocks: weakref.WeakKeyDictionary[Executor, _PendingBlocks] = (
+    weakref.WeakKeyDictionary()
+)
+_pending_blocks_lock = threading.Lock()
+
+
+def _pending_blocks_of(executor: Executor, jobs: int) -> _PendingBlocks:
+    with _pending_blocks_lock:
+        if executor not in _pending_blocks:
+            # Two of the largest blocks for each thread.
+            _pending_blocks[executor] = _PendingBlocks(2 * jobs * XZ_BLOCK_SIZE)
+        return _pending_blocks[executor]
+
+
+class _Tee:
+    """Fan a single tar stream out to several compressors."""
+
+    def __init__(self, outputs: list[Compressor]) -> None:
+        self.outputs = outputs
+        self.offset = 0
+
+    def write(self, data: bytes) -> int:
+        for output in self.outputs:
+            output.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.offset
+
+
+class _BlockCompressor:
+    """Compress fixed-size blocks of a stream in parallel, in order."""
+
+    block_size: int
+    # Whether each block can be decompressed without the ones before it.
+    independent_blocks = True
+
+    def __init__(self, fileobj: DigestWriter, executor: Executor, jobs: int) -> None:
+        self.fileobj = fileobj
+        self.executor = executor
+        self.buffer = bytearray()
+        # Compressed blocks to come, with their uncompressed size.
+        self.pending: collections.deque[tuple[Future[bytes], int]] = collections.deque()
+        # Bound the memory used by blocks waiting to be written, together
+        # with the other compressors sharing the executor.
+        self.limit = _pending_blocks_of(executor, jobs)
+        self.blocks: list[Block] = []
+        self.uncompressed_offset = 0
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def close(self) -> None:
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._write_next()
+        self.finish()
+
+    def cancel(self) -> None:
+        """Give up the blocks not written yet, after an error."""
+        while self.pending:
+            future, size = self.pending.popleft()
+            future.cancel()
+            self.limit.release(size)
+
+    def _submit(self, block: bytes) -> None:
+        # Make room by writing this compressor's own blocks.  A compressor
+        # with none may always add one: the compressors of a tarball are
+        # fed by one thread, so waiting on the others would never end.
+        while not self.limit.acquire(len(block), force=not self.pending):
+            self._write_next()
+        self.pending.append((self.submit(block), len(block)))
+
+    def _write_next(self) -> None:
+        future, size = self.pending.popleft()
+        try:
+            data = future.result()
+        finally:
+            self.limit.release(size)
+        self.write_block(data, size)
+
+    def write_block(self, data: bytes, size: int, unpadded_size: int = 0) -> None:
+        """Write a compressed block of `size` bytes of the stream."""
+        if self.independent_blocks:
+            self.blocks.append(
+                Block(
+                    self.fileobj.tell(),
+                    len(data),
+                    self.uncompressed_offset,
+                    size,
+                    unpadded_size,
+                )
+            )
+        self.uncompressed_offset += size
+        self.fileobj.write(data)
+
+    def submit(self, block: bytes) -> Future[bytes]:
+        raise NotImplementedError
+
+    def finish(self) -> None:
+        raise NotImplementedError
+
+
+class ParallelGzipCompressor(_BlockCompressor):
+    """pigz-style gzip: one member made of independently deflated blocks.
+
+    Each block is primed with the last 32 KiB of the previous block and
+    ends with a sync flush, so the blocks concatenate into a single deflate
+    stream.  Equivalent to 'gzip --no-name -9'.
+    """
+
+    block_size = GZIP_BLOCK_SIZE
+    # Each block needs the end of the one before it.
+    independent_blocks = False
+
+    def __init__(self, fileobj: DigestWriter, executor: Executor, jobs: int) -> None:
+        super().__init__(fileobj, executor, jobs)
+        self.crc = 0
+        self.length = 0
+        self.dictionary = b""
+        # No file name, no timestamp, maximum compression, unknown OS.
+        fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<L", 0) + b"\x02\xff")
+
+    def submit(self, block: bytes) -> Future[bytes]:
+        self.crc = zlib.crc32(block, self.crc)
+        self.length += len(block)
+        future = self.executor.submit(_deflate_block, block, self.dictionary)
+        self.dictionary = block[-DEFLATE_WINDOW:]
+        return future
+
+    def finish(self) -> None:
+        # An empty final block with fixed Huffman codes ends the stream.
+        self.fileobj.write(b"\x03\x00")
+        self.fileobj.write(struct.pack("<LL", self.crc, self.length & 0xFFFFFFFF))
+
+
+def _deflate_block(block: bytes, dictionary: bytes) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(
+            9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary
+        )
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelXzCompressor(_BlockCompressor):
+    """Multi-block xz: a single stream whose blocks are compressed in parallel.
+
+    Each block is compressed as its own xz stream, then the blocks are taken
+    out of those streams and written under one stream header and index,
+    the same layout 'xz --threads' produces.
+    """
+
+    block_size = XZ_BLOCK_SIZE
+
+    def __init__(self, fileobj: DigestWriter, executor: Executor, jobs: int) -> None:
+        super().__init__(fileobj, executor, jobs)
+        # Unpadded and uncompressed size of each block, for the index.
+        self.records: list[tuple[int, int]] = []
+        fileobj.write(xz_stream_start())
+
+    def submit(self, block: bytes) -> Future[bytes]:
+        return self.executor.submit(_xz_block, block)
+
+    def write_block(self, data: bytes, size: int, unpadded_size: int = 0) -> None:
+        block, records = split_xz_stream(data)
+        # lzma.compress() makes a single block.
+        assert len(records) == 1
+        self.records.extend(records)
+        super().write_block(block, size, unpadded_size=records[0][0])
+
+    def finish(self) -> None:
+        self.fileobj.write(xz_stream_end(self.records))
+
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+# CRC64 check, the default of liblzma.
+XZ_STREAM_FLAGS = b"\x00\x04"
+
+
+def _crc32(data: bytes) -> bytes:
+    return struct.pack("<L", zlib.crc32(data))
+
+
+def _xz_block(block: bytes) -> bytes:
+    return lzma.compress(
+        block, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=XZ_PRESET
+    )
+
+
+def _encode_varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _decode_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def xz_index(records: list[tuple[int, int]]) -> bytes:
+    """Encode an xz index from (unpadded size, uncompressed size) records."""
+    index = bytearray(b"\x00")
+    index += _encode_varint(len(records))
+    for unpadded_size, uncompressed_size in records:
+        index += _encode_varint(unpadded_size)
+        index += _encode_varint(uncompressed_size)
+    index += b"\x00" * (-len(index) % 4)
+    return bytes(index) + _crc32(bytes(index))
+
+
+def xz_stream_start() -> bytes:
+    """The header of an xz stream."""
+    return XZ_HEADER_MAGIC + XZ_STREAM_FLAGS + _crc32(XZ_STREAM_FLAGS)
+
+
+def xz_stream_end(records: list[tuple[int, int]]) -> bytes:
+    """The index and footer of an xz stream of blocks with these records."""
+    index = xz_index(records)
+    backward_size = struct.pack("<L", len(index) // 4 - 1)
+    return (
+        index
+        + _crc32(backward_size + XZ_STREAM_FLAGS)
+        + backward_size
+        + XZ_STREAM_FLAGS
+        + XZ_FOOTER_MAGIC
+    )
+
+
+def split_xz_stream(stream: bytes) -> tuple[bytes, list[tuple[int, int]]]:
+    """Split a single xz stream into its blocks and its index records."""
+    if stream[:6] != XZ_HEADER_MAGIC or stream[-2:] != XZ_FOOTER_MAGIC:
+        raise ValueError("Not an xz stream")
+    (backward_size,) = struct.unpack("<L", stream[-8:-4])
+    index_size = (backward_size + 1) * 4
+    index = stream[-12 - index_size : -12]
+    count, pos = _decode_varint(index, 1)
+    records = []
+    for _ in range(count):
+        unpadded_size, pos = _decode_varint(index, pos)
+        uncompressed_size, pos = _decode_varint(index, pos)
+        records.append((unpadded_size, uncompressed_size))
+    return stream[12 : -12 - index_size], records
+
+
+class ParallelZstdCompressor(_BlockCompressor):
+    """Zstandard: a sequence of frames, one per block, with checksums.
+
+    Concatenated frames are a valid zstd file which every decoder reads
+    as a single stream.
+    """
+
+    block_size = ZSTD_BLOCK_SIZE
+
+    def __init__(self, fileobj: DigestWriter, executor: Executor, jobs: int) -> None:
+        if zstandard is None:
+            raise RuntimeError("The 'zstandard' package is needed for .tar.zst")
+        super().__init__(fileobj, executor, jobs)
+        self.empty = True
+
+    def submit(self, block: bytes) -> Future[bytes]:
+        self.empty = False
+        return self.executor.submit(_zstd_block, block)
+
+    def finish(self) -> None:
+        if self.empty:
+            # A zstd file needs at least one frame.
+            self.fileobj.write(_zstd_block(b""))
+
+
+def _zstd_block(block: bytes) -> bytes:
+    assert zstandard is not None
+    compressor = zstandard.ZstdCompressor(
+        level=ZSTD_LEVEL, write_checksum=True, write_content_size=True
+    )
+    return compressor.compress(block)
+
+
+def zstd_available() -> bool:
+    return zstandard is not None
+
+
+def open_zstd_tarball(path: str) -> tarfile.TarFile:
+    """Open a .tar.zst for reading, with random access to its members."""
+    if zstandard is None:
+        raise RuntimeError("The 'zstandard' package is needed for .tar.zst")
+    fileobj = tempfile.TemporaryFile()
+    with open(path, "rb") as compressed:
+        zstandard.ZstdDecompressor().copy_stream(compressed, fileobj)
+    fileobj.seek(0)
+    return tarfile.open(fileobj=fileobj, mode="r:")
+
+
+def gzip_compressor(fileobj: DigestWriter, executor: Executor, jobs: int) -> Compressor:
+    return ParallelGzipCompressor(fileobj, executor, jobs)
+
+
+def xz_compressor(fileobj: DigestWriter, executor: Executor, jobs: int) -> Compressor:
+    return ParallelXzCompressor(fileobj, executor, jobs)
+
+
+def zstd_compressor(fileobj: DigestWriter, executor: Executor, jobs: int) -> Compressor:
+    return ParallelZstdCompressor(fileobj, executor, jobs)
+
+
+def repro_mode(mode: int) -> int:
+    """Apply 'go+u,go-w' to a file mode."""
+    user = mode & 0o700
+    mode |= (user >> 3) | (user >> 6)
+    return mode & ~0o022
+
+
+def normalize_tarinfo(tarinfo: tarfile.TarInfo, clamp_mtime: int) -> tarfile.TarInfo:
+    """Strip the host-specific metadata from a tar entry."""
+    # Sets a maximum 'modified time' of entries in tarball.
+    tarinfo.mtime = min(int(tarinfo.mtime), clamp_mtime)
+    # Sets the owner uid and gid to 0.
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    # Omit irrelevant info about file permissions.
+    tarinfo.mode = repro_mode(tarinfo.mode)
+    # Omits file access and status change times.
+    tarinfo.pax_headers = {
+        key: value
+        for key, value in tarinfo.pax_headers.items()
+        if key not in ("atime", "ctime")
+    }
+    return tarinfo
+
+
+class _IndexingTarFile(tarfile.TarFile):
+    """A TarFile which records where it writes each member."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.index: list[Member] = []
+
+    def addfile(
+        self, tarinfo: tarfile.TarInfo, fileobj: IO[bytes] | None = None
+    ) -> None:
+        offset = self.offset
+        super().addfile(tarinfo, fileobj)
+        size = tarinfo.size if fileobj is not None else 0
+        data_offset = self.offset - -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.index.append(
+            Member(tarinfo.name, tarinfo.type.decode(), offset, data_offset, size)
+        )
+
+
+def open_tar_stream(fileobj: _Tee) -> _IndexingTarFile:
+    return _IndexingTarFile.open(
+        fileobj=cast(BinaryIO, fileobj),
+        mode="w|",
+        format=tarfile.PAX_FORMAT,
+        encoding="utf-8",
+    )
+
+
+def write_tarballs(
+    source: str,
+    outputs: Mapping[str, CompressorFactory],
+    clamp_mtime: int,
+    jobs: int | None = None,
+    executor: Executor | None = None,
+) -> list[Artifact]:
+    """Archive the `source` directory into every path of `outputs`.
+
+    `outputs` maps each tarball path to the compressor used for it.
+    Entries are added sorted by name, relative to the parent of `source`.
+    `jobs` is the number of compression threads, by default one per CPU.
+    Blocks are compressed on `executor` if given, shared with other
+    tarballs; `jobs` should then be its number of workers.
+    """
+
+    def add(tar: tarfile.TarFile) -> None:
+        tar.add(
+            source,
+            arcname=os.path.basename(source),
+            filter=lambda tarinfo: normalize_tarinfo(tarinfo, clamp_mtime),
+        )
+
+    return _write(outputs, add, jobs, executor)
+
+
+def write_tarball_entries(
+    entries: Iterable[TarEntry],
+    outputs: Mapping[str, CompressorFactory],
+    clamp_mtime: int,
+    jobs: int | None = None,
+    executor: Executor | None = None,
+) -> list[Artifact]:
+    """Archive prepared entries into every path of `outputs`.
+
+    To get the same tarballs as write_tarballs, `entries` have to come in
+    the same order: each directory followed by its contents sorted by name.
+    """
+
+    def add(tar: tarfile.TarFile) -> None:
+        for tarinfo, fileobj in entries:
+            tar.addfile(normalize_tarinfo(tarinfo, clamp_mtime), fileobj)
+
+    return _write(outputs, add, jobs, executor)
+
+
+def _write(
+    outputs: Mapping[str, CompressorFactory],
+    add: Callable[[tarfile.TarFile], None],
+    jobs: int | None,
+    executor: Executor | None = None,
+) -> list[Artifact]:
+    files: list[BinaryIO] = []
+    writers: list[DigestWriter] = []
+    compressors: list[Compressor] = []
+    jobs = jobs or os.cpu_count() or 1
+    if executor is None:
+        pool: contextlib.AbstractContextManager[Executor] = ThreadPoolExecutor(
+            max_workers=jobs
+        )
+    else:
+        # Shared with other tarballs being written at the same time.
+        pool = contextlib.nullcontext(executor)
+    with pool as executor:
+        try:
+            for path, compressor_factory in outputs.items():
+                files.append(open(path, "wb"))
+                writers.append(DigestWriter(files[-1]))
+                compressors.append(compressor_factory(writers[-1], executor, jobs))
+
+            with open_tar_stream(_Tee(compressors)) as tar:
+                add(tar)
+            for compressor in compressors:
+                compressor.close()
+        except BaseException:
+            for compressor in compressors:
+                compressor.cancel()
+            raise
+        finally:
+            for file in files:
+                file.close()
+    artifacts = []
+    for path, writer, compressor in zip(outputs, writers, compressors):
+        artifact = writer.artifact(path)
+        artifact.members = tar.index
+        artifact.blocks = compressor.blocks
+        artifacts.append(artifact)
+    return artifacts
+
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".index.json"
+MEMBER_FIELDS = ("name", "type", "offset", "data_offset", "size")
+BLOCK_FIELDS = (
+    "offset",
+    "size",
+    "uncompressed_offset",
+    "uncompressed_size",
+    "unpadded_size",
+)
+
+
+def compression(path: str) -> str:
+    """The compression of a tarball, from its first bytes."""
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    if magic.startswith(b"\x1f\x8b"):
+        return "gzip"
+    if magic == XZ_HEADER_MAGIC:
+        return "xz"
+    if magic.startswith(b"\x28\xb5\x2f\xfd"):
+        return "zstd"
+    return "none"
+
+
+def write_index(artifact: Artifact, path: str | None = None) -> str:
+    """Write the index sidecar of a tarball, by default beside it.
+
+    The index lists where each member is in the tar stream and, when the
+    tarball is made of independent blocks (xz and zstd), where each block
+    is, so that IndexedTarball can read a member without decompressing
+    what comes before it.  The same tarball always gives the same index.
+    """
+    path = path or artifact.path + INDEX_SUFFIX
+    index = {
+        "version": INDEX_VERSION,
+        "tarball": os.path.basename(artifact.path),
+        "size": artifact.size,
+        "sha256": artifact.sha256,
+        "compression": compression(artifact.path),
+        "member_fields": MEMBER_FIELDS,
+        "members": [
+            [getattr(member, name) for name in MEMBER_FIELDS]
+            for member in artifact.members
+        ],
+        "block_fields": BLOCK_FIELDS,
+        "blocks": [
+            [getattr(block, name) for name in BLOCK_FIELDS] for block in artifact.blocks
+        ],
+    }
+    with open(path, "w") as f:
+        json.dump(index, f, sort_keys=True, separators=(",", ":"))
+        f.write("\n")
+    return path
+
+
+class IndexedTarball:
+    """Random access to the members of a tarball, through its index.
+
+    Looking a member up only reads the index.  Reading it decompresses
+    the blocks holding its data, or for a gzip tarball, the stream up to
+    its end.
+
+        >>> with IndexedTarball("Python-3.12.2.tar.xz") as tarball:
+        ...     sbom = tarball.read("Python-3.12.2/Misc/sbom.spdx.json")
+    """
+
+    def __init__(self, path: str, index_path: str | None = None) -> None:
+        self.path = path
+        with open(index_path or path + INDEX_SUFFIX) as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version {index.get('version')}")
+        if os.path.getsize(path) != index["size"]:
+            raise ValueError(f"The index doesn't match {path}")
+        self.compression: str = index["compression"]
+        self.sha256: str = index["sha256"]
+        self.members = {values[0]: Member(*values) for values in index["members"]}
+        self.blocks = [Block(*values) for values in index["blocks"]]
+        self._starts = [block.uncompressed_offset for block in self.blocks]
+        self._file = open(path, "rb")
+
+    def __enter__(self) -> IndexedTarball:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def getnames(self) -> list[str]:
+        return list(self.members)
+
+    def getmember(self, name: str) -> Member:
+        try:
+            return self.members[name]
+        except KeyError:
+            raise KeyError(f"{name!r} not found in {self.path}") from None
+
+    def tarinfo(self, name: str) -> tarfile.TarInfo:
+        """The full header of a member, with its mode, mtime and pax records."""
+        member = self.getmember(name)
+        header = self.read_range(member.offset, member.data_offset - member.offset)
+        with tarfile.open(fileobj=io.BytesIO(header), mode="r:") as tar:
+            tarinfo = tar.next()
+        assert tarinfo is not None
+        return tarinfo
+
+    def read(self, name: str) -> bytes:
+        member = self.getmember(name)
+        return self.read_range(member.data_offset, member.size)
+
+    def read_range(self, offset: int, size: int) -> bytes:
+        """Read `size` bytes of the tar stream from `offset`."""
+        if self.compression == "none":
+            self._file.seek(offset)
+            return self._file.read(size)
+        if not self.blocks:
+            return self._read_stream(offset, size)
+        data = bytearray()
+        i = bisect.bisect_right(self._starts, offset) - 1
+        while len(data) < size and i < len(self.blocks):
+            block = self.blocks[i]
+            start = max(0, offset + len(data) - block.uncompressed_offset)
+            data += self._decompress(block)[start : start + size - len(data)]
+            i += 1
+        return bytes(data)
+
+    def _decompress(self, block: Block) -> bytes:
+        self._file.seek(block.offset)
+        data = self._file.read(block.size)
+        if self.compression == "xz":
+            # A block isn't a stream: give it a header, index and footer.
+            record = (block.unpadded_size, block.uncompressed_size)
+            stream = xz_stream_start() + data + xz_stream_end([record])
+            return lzma.decompress(stream, format=lzma.FORMAT_XZ)
+        if self.compression == "zstd":
+            if zstandard is None:
+                raise RuntimeError("The 'zstandard' package is needed for .tar.zst")
+            return zstandard.ZstdDecompressor().decompress(data)
+        raise ValueError(f"{self.compression} tarballs have no independent blocks")
+
+    def _read_stream(self, offset: int, size: int) -> bytes:
+        self._file.seek(0)
+        with gzip.GzipFile(fileobj=self._file) as stream:
+            while offset:
+                skipped = len(stream.read(min(offset, 1024 * 1024)))
+                if not skipped:
+                    break
+                offset -= skipped
+            return stream.read(size)
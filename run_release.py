@@ -9,22 +9,26 @@ from __future__ import annotations
 import argparse
 import asyncio
 import builtins
+import collections
+import concurrent.futures
 import contextlib
+import datetime
 import functools
 import getpass
 import json
 import os
 import pathlib
 import re
-import shelve
+import shlex
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import urllib.request
 from dataclasses import dataclass
 from shelve import DbfilenameShelf
-from typing import Any, Callable, Generator, Iterator
+from typing import Any, Callable, Generator, Mapping
 
 import aiohttp
 import gnupg
@@ -32,8 +36,12 @@ import paramiko
 import sigstore.oidc
 from alive_progress import alive_bar
 
+import cmdrunner
+import gitquery
 import release as release_mod
 import sbom
+import taskgraph
+import transfer
 from buildbotapi import BuildBotAPI, Builder
 
 API_KEY_REGEXP = re.compile(r"(?P<major>\w+):(?P<minor>\w+)")
@@ -45,6 +53,10 @@ RELEASE_REGEXP = re.compile(
 
 DOWNLOADS_SERVER = "downloads.nyc1.psf.io"
 DOCS_SERVER = "docs.nyc1.psf.io"
+# Seconds between keepalive messages on idle SSH connections.
+SSH_KEEPALIVE = 30
+# How many SFTP channels upload a directory at the same time.
+SFTP_STREAMS = transfer.STREAMS
 
 WHATS_NEW_TEMPLATE = """
 ****************************
@@ -184,6 +196,13 @@ Removed
 class Task:
     function: Callable[[DbfilenameShelf], None]
     description: str
+    # The functions of the tasks this one waits for, each the last task
+    # before it running that function.  None waits for every earlier task.
+    after: tuple[Callable[[DbfilenameShelf], None], ...] | None = None
+    # Tasks sharing a lock don't run at the same time: "git" for the
+    # working tree of the repository, "prompt" for the terminal, which
+    # questions to the user and progress bars need to themselves.
+    locks: tuple[str, ...] = ()
 
     def __call__(self, db: DbfilenameShelf) -> Any:
         return getattr(self, "function")(db)
@@ -193,6 +212,119 @@ class ReleaseException(Exception):
     """An error happened in the release process"""
 
 
+class SSHConnections:
+    """One authenticated SSH connection per server, shared by the tasks.
+
+    The key exchange and authentication happen once per server.  Tasks
+    open channels and SFTP sessions on the connection, which is kept
+    alive while other tasks run and opened again if it drops.
+    """
+
+    def __init__(self, username: str, keepalive: int = SSH_KEEPALIVE) -> None:
+        self.username = username
+        self.keepalive = keepalive
+        self.clients: dict[str, paramiko.SSHClient] = {}
+        self.locks: collections.defaultdict[str, threading.Lock] = (
+            collections.defaultdict(threading.Lock)
+        )
+
+    def connect(self, host: str) -> paramiko.SSHClient:
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.WarningPolicy)
+        client.connect(host, port=22, username=self.username)
+        client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def client(self, host: str, reconnect: bool = False) -> paramiko.SSHClient:
+        """The connection to a server, opened if it isn't open anymore."""
+        with self.locks[host]:
+            client = self.clients.get(host)
+            transport = client.get_transport() if client is not None else None
+            if reconnect or transport is None or not transport.is_active():
+                if client is not None:
+                    client.close()
+                client = self.clients[host] = self.connect(host)
+            return client
+
+    def open_session(self, host: str) -> paramiko.Channel:
+        try:
+            return self.client(host).get_transport().open_session()
+        except (paramiko.SSHException, EOFError, OSError):
+            # The server may have dropped an idle connection.
+            return self.client(host, reconnect=True).get_transport().open_session()
+
+    def sftp(self, host: str) -> MySFTPClient:
+        try:
+            return MySFTPClient.from_transport(self.client(host).get_transport())
+        except (paramiko.SSHException, EOFError, OSError):
+            transport = self.client(host, reconnect=True).get_transport()
+            return MySFTPClient.from_transport(transport)
+
+    def run(self, host: str, command: str, forward_agent: bool = False) -> str:
+        """Run a command on a server, and return its output.
+
+        With `forward_agent`, the command can use the local SSH agent to
+        connect to another server.
+        """
+        with self.open_session(host) as channel:
+            if forward_agent:
+                paramiko.agent.AgentRequestHandler(channel)
+            channel.exec_command(command)
+            # Both streams share the channel's window: read stderr at the
+            # same time, or a command writing a lot to it would wait forever
+            # for the window to reopen while stdout is being read.
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                reading = executor.submit(channel.makefile_stderr("rb").read)
+                stdout = channel.makefile("rb").read()
+                stderr = reading.result()
+            if channel.recv_exit_status() != 0:
+                raise ReleaseException(
+                    f"{command!r} failed on {host}: {stderr.decode(errors='replace')}"
+                )
+        return stdout.decode()
+
+    def close(self) -> None:
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+
+
+class LockedShelf(DbfilenameShelf):
+    """A shelf which tasks running at the same time can share."""
+
+    # Connections shared by the tasks, which aren't saved in the shelf.
+    ssh: SSHConnections
+
+    def __init__(self, filename: str, flag: str = "c") -> None:
+        super().__init__(filename, flag)
+        self.lock = threading.RLock()
+
+    def __getitem__(self, key: str) -> Any:
+        with self.lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        with self.lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        with self.lock:
+            super().__delitem__(key)
+
+    def __contains__(self, key: object) -> bool:
+        with self.lock:
+            return super().__contains__(key)
+
+    def sync(self) -> None:
+        with self.lock:
+            super().sync()
+
+    def close(self) -> None:
+        with self.lock:
+            super().close()
+
+
 class ReleaseDriver:
     def __init__(
         self,
@@ -202,24 +334,32 @@ class ReleaseDriver:
         git_repo: str,
         api_key: str,
         ssh_user: str,
-        first_state: Task | None = None,
+        jobs: int = taskgraph.JOBS,
+        replicate_docs: bool = False,
     ) -> None:
         self.tasks = tasks
+        self.jobs = jobs
+        self.dependencies = taskgraph.resolve(
+            [task.function for task in tasks], [task.after for task in tasks]
+        )
         dbfile = pathlib.Path.home() / ".python_release"
-        self.db = shelve.open(str(dbfile), "c")
+        self.db = LockedShelf(str(dbfile), "c")
         if not self.db.get("finished"):
             self.db["finished"] = False
         else:
             self.db.close()
-            self.db = shelve.open(str(dbfile), "n")
+            self.db = LockedShelf(str(dbfile), "n")
 
-        self.current_task: Task | None = first_state
-        self.completed_tasks = self.db.get("completed_tasks", [])
-        self.remaining_tasks = iter(tasks[len(self.completed_tasks) :])
+        if "completed" in self.db:
+            self.completed: set[int] = set(self.db["completed"])
+        else:
+            # Checkpoints of tasks run one after the other.
+            self.completed = set(range(len(self.db.get("completed_tasks", []))))
         if self.db.get("gpg_key"):
             os.environ["GPG_KEY_FOR_RELEASE"] = self.db["gpg_key"]
         if not self.db.get("git_repo"):
-            self.db["git_repo"] = pathlib.Path(git_repo)
+            # Absolute, since the tasks don't depend on the current directory.
+            self.db["git_repo"] = pathlib.Path(git_repo).resolve()
         if not self.db.get("auth_info"):
             self.db["auth_info"] = api_key
         if not self.db.get("ssh_user"):
@@ -227,6 +367,9 @@ class ReleaseDriver:
 
         if not self.db.get("release"):
             self.db["release"] = release_tag
+        self.db["replicate_docs"] = replicate_docs
+
+        self.db.ssh = SSHConnections(self.db["ssh_user"])
 
         print("Release data: ")
         print(f"- Branch: {release_tag.branch}")
@@ -237,24 +380,35 @@ class ReleaseDriver:
         print(f"- python.org API key : {self.db['auth_info']}")
         print()
 
-    def checkpoint(self) -> None:
-        self.db["completed_tasks"] = self.completed_tasks
+    def checkpoint(self, index: int) -> None:
+        self.completed.add(index)
+        self.db["completed"] = sorted(self.completed)
+        self.db.sync()
+        print(f"\r✅  {self.tasks[index].description}")
+
+    def execute(self, index: int) -> None:
+        task = self.tasks[index]
+        try:
+            task(self.db)
+        except BaseException:
+            print(f"\r💥  {task.description}")
+            raise
 
     def run(self) -> None:
-        for task in self.completed_tasks:
-            print(f"✅  {task.description}")
-
-        self.current_task = next(self.remaining_tasks, None)
-        while self.current_task is not None:
-            self.checkpoint()
-            try:
-                self.current_task(self.db)
-            except Exception as e:
-                print(f"\r💥  {self.current_task.description}")
-                raise e from None
-            print(f"\r✅  {self.current_task.description}")
-            self.completed_tasks.append(self.current_task)
-            self.current_task = next(self.remaining_tasks, None)
+        for index in sorted(self.completed):
+            print(f"✅  {self.tasks[index].description}")
+
+        try:
+            taskgraph.run(
+                self.execute,
+                self.dependencies,
+                [task.locks for task in self.tasks],
+                completed=self.completed,
+                on_done=self.checkpoint,
+                jobs=self.jobs,
+            )
+        finally:
+            self.db.ssh.close()
         self.db["finished"] = True
         print()
         print(f"Congratulations, Python {self.db['release']} is released 🎉🎉🎉")
@@ -274,14 +428,6 @@ def ask_question(question: str) -> bool:
     return True
 
 
-@contextlib.contextmanager
-def cd(path: str) -> Iterator[None]:
-    current_path = os.getcwd()
-    os.chdir(path)
-    yield
-    os.chdir(current_path)
-
-
 @contextlib.contextmanager
 def supress_print() -> Generator[None, None, None]:
     print_func = builtins.print
@@ -324,13 +470,9 @@ def check_gpg_keys(db: DbfilenameShelf) -> None:
 
 
 def check_ssh_connection(db: DbfilenameShelf) -> None:
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy)
-    client.connect(DOWNLOADS_SERVER, port=22, username=db["ssh_user"])
-    client.exec_command("pwd")
-    client.connect(DOCS_SERVER, port=22, username=db["ssh_user"])
-    client.exec_command("pwd")
+    # The connections are kept for the tasks which use them later.
+    db.ssh.run(DOWNLOADS_SERVER, "pwd")
+    db.ssh.run(DOCS_SERVER, "pwd")
 
 
 def check_buildbots(db: DbfilenameShelf) -> None:
@@ -385,7 +527,7 @@ def run_blurb_release(db: DbfilenameShelf) -> None:
 
 
 def check_cpython_repo_is_clean(db: DbfilenameShelf) -> None:
-    if subprocess.check_output(["git", "status", "--porcelain"], cwd=db["git_repo"]):
+    if not gitquery.repository(db["git_repo"]).is_clean():
         raise ReleaseException("Git repository is not clean")
 
 
@@ -461,17 +603,15 @@ def check_pyspecific(db):
 
 
 def bump_version(db: DbfilenameShelf) -> None:
-    with cd(db["git_repo"]):
-        release_mod.bump(db["release"])
+    release_mod.bump(db["release"], repo=str(db["git_repo"]))
     subprocess.check_call(
         ["git", "commit", "-a", "--amend", "--no-edit"], cwd=db["git_repo"]
     )
 
 
 def create_tag(db: DbfilenameShelf) -> None:
-    with cd(db["git_repo"]):
-        if not release_mod.make_tag(db["release"]):
-            raise ReleaseException("Error when creating tag")
+    if not release_mod.make_tag(db["release"], repo=str(db["git_repo"])):
+        raise ReleaseException("Error when creating tag")
     subprocess.check_call(
         ["git", "commit", "-a", "--amend", "--no-edit"], cwd=db["git_repo"]
     )
@@ -519,6 +659,23 @@ def wait_for_source_and_docs_artifacts(db: DbfilenameShelf) -> None:
     while not all(path.exists() for path in wait_for_paths):
         time.sleep(1)
 
+    zstd_path = release_path / "src" / f"Python-{release_tag}.tar.zst"
+    if zstd_path.exists():
+        print(f"Found optional artifact '{os.path.relpath(zstd_path, release_path)}'")
+
+
+def source_tarball_paths(db: DbfilenameShelf) -> list[pathlib.Path]:
+    """The source tarballs of the release, including the optional .tar.zst."""
+    tarballs_path = pathlib.Path(db["git_repo"] / str(db["release"]) / "src")
+    paths = [
+        tarballs_path / f"Python-{db['release']}.tgz",
+        tarballs_path / f"Python-{db['release']}.tar.xz",
+    ]
+    zstd_path = tarballs_path / f"Python-{db['release']}.tar.zst"
+    if zstd_path.exists():
+        paths.append(zstd_path)
+    return paths
+
 
 def sign_source_artifacts(db: DbfilenameShelf) -> None:
     print("Signing tarballs with GPG")
@@ -528,12 +685,10 @@ def sign_source_artifacts(db: DbfilenameShelf) -> None:
         subprocess.check_call('gpg -K | grep -A 1 "^sec"', shell=True)
         uid = input("Please enter key ID to use for signing: ")
 
-    tarballs_path = pathlib.Path(db["git_repo"] / str(db["release"]) / "src")
-    tgz = str(tarballs_path / (f"Python-{db['release']}.tgz"))
-    xz = str(tarballs_path / (f"Python-{db['release']}.tar.xz"))
+    tarballs = [str(path) for path in source_tarball_paths(db)]
 
-    subprocess.check_call(["gpg", "-bas", "-u", uid, tgz])
-    subprocess.check_call(["gpg", "-bas", "-u", uid, xz])
+    for tarball in tarballs:
+        subprocess.check_call(["gpg", "-bas", "-u", uid, tarball])
 
     print("Signing tarballs with Sigstore")
     subprocess.check_call(
@@ -543,8 +698,7 @@ def sign_source_artifacts(db: DbfilenameShelf) -> None:
             "sigstore",
             "sign",
             "--oidc-disable-ambient-providers",
-            tgz,
-            xz,
+            *tarballs,
         ]
     )
 
@@ -552,15 +706,19 @@ def sign_source_artifacts(db: DbfilenameShelf) -> None:
 def build_sbom_artifacts(db):
 
     # Skip building an SBOM if there isn't a 'Misc/sbom.spdx.json' file.
-    if not (db["git_repo"] / "Misc/sbom.spdx.json").exists():
+    # It's looked up in the tag, as post_release_merge may be changing the
+    # working tree meanwhile.
+    repo = gitquery.repository(db["git_repo"])
+    try:
+        repo.object_info(f"{db['release'].gitname}:Misc/sbom.spdx.json")
+    except gitquery.GitError:
         print("Skipping building an SBOM, missing 'Misc/sbom.spdx.json'")
         return
 
-    release_version = db["release"]
     # For each source tarball build an SBOM.
-    for ext in (".tgz", ".tar.xz"):
-        tarball_name = f"Python-{release_version}{ext}"
-        tarball_path = str(db["git_repo"] / str(db["release"]) / "src" / tarball_name)
+    for path in source_tarball_paths(db):
+        tarball_name = path.name
+        tarball_path = str(path)
 
         print(f"Building an SBOM for artifact '{tarball_name}'")
         sbom_data = sbom.create_sbom_for_source_tarball(tarball_path)
@@ -570,20 +728,156 @@ def build_sbom_artifacts(db):
 
 
 class MySFTPClient(paramiko.SFTPClient):
-    def put_dir(self, source: str, target: str, progress: Any = None) -> None:
-        for item in os.listdir(source):
-            if os.path.isfile(os.path.join(source, item)):
-                progress.text(item)
-                self.put(os.path.join(source, item), f"{target}/{item}")
-                progress()
-            else:
-                self.mkdir(f"{target}/{item}", ignore_existing=True)
-                self.put_dir(
-                    os.path.join(source, item),
-                    f"{target}/{item}",
-                    progress=progress,
+    def put_dir(
+        self,
+        source: str,
+        target: str,
+        progress: bool = False,
+        streams: int = SFTP_STREAMS,
+        remote: Mapping[str, transfer.FileState] | None = None,
+    ) -> transfer.UploadReport:
+        """Upload the files under a directory, over several SFTP channels.
+
+        The remote directories are made first.  The files are spread over
+        `streams` channels on the same connection, largest first, and each
+        upload is confirmed by checking the size of the remote file.
+
+        With the `remote` manifest of the target (see transfer.py), files
+        already there are skipped and partial files are resumed.
+
+        With `progress`, a progress bar shows the bytes sent by all the
+        streams, the rate and the time left.  The size, time and rate of
+        each file sent are recorded in the command log.
+        """
+        start = time.perf_counter()
+        report = transfer.UploadReport()
+        remote = remote or {}
+        with concurrent.futures.ThreadPoolExecutor(streams) as executor:
+            transfers, report.skipped = transfer.plan(source, target, remote, executor)
+        offsets = {
+            item.path: remote[item.path].size if item.resume else 0
+            for item in transfers
+        }
+        directories = {target}
+        for path in transfer.local_files(source):
+            parent = os.path.dirname(path)
+            while parent:
+                directories.add(f"{target}/{parent}")
+                parent = os.path.dirname(parent)
+        for directory in sorted(directories):
+            self.mkdir(directory, ignore_existing=True)
+
+        total = sum(item.size - offsets[item.path] for item in transfers)
+        peer = self.get_channel().get_transport().getpeername()[0]
+        progress_lock = threading.Lock()
+
+        def send(sftp: MySFTPClient, stream: list[transfer.Transfer], bar: Any) -> None:
+            for item in stream:
+                sent = 0
+
+                # Called by paramiko with the bytes of this file sent so far.
+                def callback(transferred: int, total: int) -> None:
+                    nonlocal sent
+                    if bar is not None:
+                        with progress_lock:
+                            bar(transferred - sent)
+                    sent = transferred
+
+                if bar is not None:
+                    with progress_lock:
+                        bar.text(item.path)
+                started = datetime.datetime.now(datetime.timezone.utc)
+                file_start = time.perf_counter()
+                if item.resume:
+                    sftp.resume(
+                        item.local_path,
+                        item.remote_path,
+                        offsets[item.path],
+                        callback=callback,
+                    )
+                else:
+                    sftp.put(
+                        item.local_path,
+                        item.remote_path,
+                        callback=callback,
+                        confirm=True,
+                    )
+                seconds = time.perf_counter() - file_start
+                size = item.size - offsets[item.path]
+                cmdrunner.log(
+                    {
+                        "transfer": item.remote_path,
+                        "host": peer,
+                        "started": started.isoformat(timespec="seconds"),
+                        "seconds": round(seconds, 3),
+                        "bytes": size,
+                        "resumed": item.resume,
+                        "bytes_per_second": round(size / seconds if seconds else 0),
+                    }
                 )
 
+        assigned = transfer.assign_streams(transfers, streams)
+        # The first stream uses this session, the others their own.
+        sessions = [self] + [self.open_session() for _ in assigned[1:]]
+        bar_context = (
+            alive_bar(total, unit="B", scale="SI", title=os.path.basename(target))
+            if progress and total
+            else contextlib.nullcontext()
+        )
+        try:
+            with bar_context as bar, concurrent.futures.ThreadPoolExecutor(
+                len(sessions)
+            ) as executor:
+                futures = [
+                    executor.submit(send, sftp, stream, bar)
+                    for sftp, stream in zip(sessions, assigned)
+                ]
+                # Wait for every stream, then report the first failure.
+                concurrent.futures.wait(futures)
+                for future in futures:
+                    future.result()
+        finally:
+            for sftp in sessions[1:]:
+                sftp.close()
+
+        for item in transfers:
+            report.uploaded.append(item.path)
+            if item.resume:
+                report.resumed.append(item.path)
+            report.bytes += item.size - offsets[item.path]
+        report.seconds = time.perf_counter() - start
+        return report
+
+    def resume(
+        self,
+        local_path: str,
+        remote_path: str,
+        offset: int,
+        callback: Callable[[int, int], None] | None = None,
+    ) -> None:
+        """Upload a file from an offset, the remote file having the start.
+
+        Like put(), `callback` is called with the bytes sent so far and
+        the bytes to send.
+        """
+        size = os.path.getsize(local_path)
+        sent = 0
+        with open(local_path, "rb") as src, self.open(remote_path, "r+b") as dst:
+            dst.set_pipelined(True)
+            src.seek(offset)
+            dst.seek(offset)
+            while chunk := src.read(transfer.CHUNK_SIZE):
+                dst.write(chunk)
+                sent += len(chunk)
+                if callback is not None:
+                    callback(sent, size - offset)
+        if self.stat(remote_path).st_size != size:
+            raise OSError(f"{remote_path} isn't the size of {local_path}")
+
+    def open_session(self) -> MySFTPClient:
+        """Another SFTP session on the same connection."""
+        return MySFTPClient.from_transport(self.get_channel().get_transport())
+
     def mkdir(self, path: str, mode: int = 511, ignore_existing: bool = False) -> None:
         try:
             super().mkdir(path, mode)
@@ -594,56 +888,67 @@ class MySFTPClient(paramiko.SFTPClient):
                 raise
 
 
-def upload_files_to_server(db: DbfilenameShelf) -> None:
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy)
-    client.connect(DOWNLOADS_SERVER, port=22, username=db["ssh_user"])
-
-    destination = pathlib.Path(f"/home/psf-users/{db['ssh_user']}/{db['release']}")
-    ftp_client = MySFTPClient.from_transport(client.get_transport())
-
-    client.exec_command(f"rm -rf {destination}")
-
-    with contextlib.suppress(OSError):
-        ftp_client.mkdir(str(destination))
+def sync_release_files(db: DbfilenameShelf, host: str, subdirs: list[str]) -> None:
+    """Make the staging directory on a server hold the release files.
 
+    Files already there are skipped, partial files are resumed, and files
+    which aren't part of the release anymore are removed at the end, so
+    running this again after a failure only sends what's missing.
+    """
+    destination = f"/home/psf-users/{db['ssh_user']}/{db['release']}"
     artifacts_path = pathlib.Path(db["git_repo"] / str(db["release"]))
 
     shutil.rmtree(artifacts_path / f"Python-{db['release']}", ignore_errors=True)
 
-    def upload_subdir(subdir: str) -> None:
-        with contextlib.suppress(OSError):
-            ftp_client.mkdir(str(destination / subdir))
-        with alive_bar(len(tuple((artifacts_path / subdir).glob("**/*")))) as progress:
-            ftp_client.put_dir(
-                artifacts_path / subdir,
-                str(destination / subdir),
-                progress=progress,
-            )
+    remote = transfer.parse_manifest(
+        db.ssh.run(host, transfer.remote_manifest_command(destination))
+    )
+    ftp_client = db.ssh.sftp(host)
+    ftp_client.mkdir(destination, ignore_existing=True)
+    uploaded = set()
+    for subdir in subdirs:
+        files = transfer.local_files(str(artifacts_path / subdir))
+        uploaded.update(f"{subdir}/{path}" for path in files)
+        prefix = f"{subdir}/"
+        report = ftp_client.put_dir(
+            str(artifacts_path / subdir),
+            f"{destination}/{subdir}",
+            progress=True,
+            remote={
+                path.removeprefix(prefix): state
+                for path, state in remote.items()
+                if path.startswith(prefix)
+            },
+        )
+        print(f"{subdir}: {report.summary()}")
+    ftp_client.close()
+
+    stale = sorted(set(remote) - uploaded)
+    if stale:
+        print(f"Removing {len(stale)} files which aren't part of the release")
+        db.ssh.run(
+            host,
+            f"cd {shlex.quote(destination)} && rm -f -- "
+            + " ".join(shlex.quote(path) for path in stale),
+        )
+
 
-    upload_subdir("src")
+def upload_files_to_server(db: DbfilenameShelf) -> None:
+    artifacts_path = pathlib.Path(db["git_repo"] / str(db["release"]))
+    subdirs = ["src"]
     if (artifacts_path / "docs").exists():
-        upload_subdir("docs")
-    ftp_client.close()
+        subdirs.append("docs")
+    sync_release_files(db, DOWNLOADS_SERVER, subdirs)
 
 
 def place_files_in_download_folder(db: DbfilenameShelf) -> None:
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy)
-    client.connect(DOWNLOADS_SERVER, port=22, username=db["ssh_user"])
-
     # Sources
 
     source = f"/home/psf-users/{db['ssh_user']}/{db['release']}"
     destination = f"/srv/www.python.org/ftp/python/{db['release'].normalized()}"
 
     def execute_command(command: str) -> None:
-        channel = client.get_transport().open_session()
-        channel.exec_command(command)
-        if channel.recv_exit_status() != 0:
-            raise ReleaseException(channel.recv_stderr(1000))
+        db.ssh.run(DOWNLOADS_SERVER, command)
 
     execute_command(f"mkdir -p {destination}")
     execute_command(f"cp {source}/src/* {destination}")
@@ -658,12 +963,6 @@ def place_files_in_download_folder(db: DbfilenameShelf) -> None:
         source = f"/home/psf-users/{db['ssh_user']}/{db['release']}"
         destination = f"/srv/www.python.org/ftp/python/doc/{release_tag}"
 
-        def execute_command(command: str) -> None:
-            channel = client.get_transport().open_session()
-            channel.exec_command(command)
-            if channel.recv_exit_status() != 0:
-                raise ReleaseException(channel.recv_stderr(1000))
-
         execute_command(f"mkdir -p {destination}")
         execute_command(f"cp {source}/docs/* {destination}")
         execute_command(f"chgrp downloads {destination}")
@@ -671,40 +970,36 @@ def place_files_in_download_folder(db: DbfilenameShelf) -> None:
         execute_command(f"find {destination} -type f -exec chmod 664 {{}} \\;")
 
 
+def replicate_docs(db: DbfilenameShelf, source_host: str, host: str) -> None:
+    """Have a server copy the staged docs from another server.
+
+    The copy goes over the network between the servers, authenticated
+    with the local SSH agent.
+    """
+    staging = f"/home/psf-users/{db['ssh_user']}/{db['release']}"
+    source = f"{db['ssh_user']}@{source_host}:{staging}/docs"
+    print(f"Copying the docs from {source_host} to {host}")
+    db.ssh.run(
+        host,
+        f"mkdir -p {shlex.quote(staging)} && "
+        f"scp -q -r -o BatchMode=yes {shlex.quote(source)} {shlex.quote(staging)}",
+        forward_agent=True,
+    )
+
+
 def upload_docs_to_the_docs_server(db: DbfilenameShelf) -> None:
     release_tag: release_mod.Tag = db["release"]
     if not (release_tag.is_final or release_tag.is_release_candidate):
         return
 
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy)
-    client.connect(DOCS_SERVER, port=22, username=db["ssh_user"])
-
-    destination = pathlib.Path(f"/home/psf-users/{db['ssh_user']}/{db['release']}")
-    ftp_client = MySFTPClient.from_transport(client.get_transport())
-
-    client.exec_command(f"rm -rf {destination}")
-
-    with contextlib.suppress(OSError):
-        ftp_client.mkdir(str(destination))
-
-    artifacts_path = pathlib.Path(db["git_repo"] / str(db["release"]))
-
-    shutil.rmtree(artifacts_path / f"Python-{db['release']}", ignore_errors=True)
-
-    def upload_subdir(subdir: str) -> None:
-        with contextlib.suppress(OSError):
-            ftp_client.mkdir(str(destination / subdir))
-        with alive_bar(len(tuple((artifacts_path / subdir).glob("**/*")))) as progress:
-            ftp_client.put_dir(
-                artifacts_path / subdir,
-                str(destination / subdir),
-                progress=progress,
-            )
-
-    upload_subdir("docs")
-    ftp_client.close()
+    if db.get("replicate_docs"):
+        try:
+            replicate_docs(db, DOWNLOADS_SERVER, DOCS_SERVER)
+        except (ReleaseException, paramiko.SSHException) as e:
+            print(f"Couldn't copy the docs between the servers, uploading them: {e}")
+    # After a copy, this checks the SHA-256 of every file, and only uploads
+    # the ones which didn't arrive intact.
+    sync_release_files(db, DOCS_SERVER, ["docs"])
 
 
 def unpack_docs_in_the_docs_server(db: DbfilenameShelf) -> None:
@@ -712,21 +1007,13 @@ def unpack_docs_in_the_docs_server(db: DbfilenameShelf) -> None:
     if not (release_tag.is_final or release_tag.is_release_candidate):
         return
 
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy)
-    client.connect(DOCS_SERVER, port=22, username=db["ssh_user"])
-
     # Sources
 
     source = f"/home/psf-users/{db['ssh_user']}/{db['release']}"
     destination = f"/srv/docs.python.org/release/{release_tag}"
 
     def execute_command(command: str) -> None:
-        channel = client.get_transport().open_session()
-        channel.exec_command(command)
-        if channel.recv_exit_status() != 0:
-            raise ReleaseException(channel.recv_stderr(1000))
+        db.ssh.run(DOCS_SERVER, command)
 
     docs_filename = f"python-{release_tag}-docs-html"
     execute_command(f"mkdir -p {destination}")
@@ -740,23 +1027,12 @@ def unpack_docs_in_the_docs_server(db: DbfilenameShelf) -> None:
 
 def start_build_of_source_and_docs(db: DbfilenameShelf) -> None:
     # Get the git commit SHA for the tag
-    commit_sha = (
-        subprocess.check_output(
-            ["git", "rev-list", "-n", "1", db["release"].gitname], cwd=db["git_repo"]
-        )
-        .decode()
-        .strip()
-    )
+    repo = gitquery.repository(db["git_repo"])
+    commit_sha = repo.commit(db["release"].gitname)
 
     # Get the owner of the GitHub repo (first path segment in a 'github.com' remote URL)
     # This works for both 'https' and 'ssh' style remote URLs.
-    origin_remote_url = (
-        subprocess.check_output(
-            ["git", "ls-remote", "--get-url", "origin"], cwd=db["git_repo"]
-        )
-        .decode()
-        .strip()
-    )
+    origin_remote_url = repo.remote_url("origin")
     if https_match := re.match(r"github\.com/([^/]+)/", origin_remote_url):
         origin_remote_github_owner = https_match.group(1)
     elif ssh_match := re.match(r"^git@github\.com:([^/]+)/", origin_remote_url):
@@ -815,11 +1091,7 @@ def create_release_object_in_db(db: DbfilenameShelf) -> None:
 
 
 def wait_until_all_files_are_in_folder(db: DbfilenameShelf) -> None:
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy)
-    client.connect(DOWNLOADS_SERVER, port=22, username=db["ssh_user"])
-    ftp_client = client.open_sftp()
+    ftp_client = db.ssh.sftp(DOWNLOADS_SERVER)
 
     destination = f"/srv/www.python.org/ftp/python/{db['release'].normalized()}"
 
@@ -849,20 +1121,17 @@ def wait_until_all_files_are_in_folder(db: DbfilenameShelf) -> None:
                 end="",
             )
             time.sleep(1)
+    ftp_client.close()
     print()
 
 
 def run_add_to_python_dot_org(db: DbfilenameShelf) -> None:
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy)
-    client.connect(DOWNLOADS_SERVER, port=22, username=db["ssh_user"])
-
-    # Ensure the file is there
-    source = pathlib.Path(__file__).parent / "add-to-pydotorg.py"
-    destination = pathlib.Path(f"/home/psf-users/{db['ssh_user']}/add-to-pydotorg.py")
-    ftp_client = MySFTPClient.from_transport(client.get_transport())
-    ftp_client.put(str(source), str(destination))
+    # Ensure the script is there, with the module it runs commands with
+    ftp_client = db.ssh.sftp(DOWNLOADS_SERVER)
+    for name in ("add-to-pydotorg.py", "cmdrunner.py"):
+        source = pathlib.Path(__file__).parent / name
+        destination = pathlib.Path(f"/home/psf-users/{db['ssh_user']}/{name}")
+        ftp_client.put(str(source), str(destination))
     ftp_client.close()
 
     auth_info = db["auth_info"]
@@ -872,6 +1141,7 @@ def run_add_to_python_dot_org(db: DbfilenameShelf) -> None:
     issuer = sigstore.oidc.Issuer(sigstore.oidc.DEFAULT_OAUTH_ISSUER_URL)
     identity_token = issuer.identity_token()
 
+    client = db.ssh.client(DOWNLOADS_SERVER)
     stdin, stdout, stderr = client.exec_command(
         f"AUTH_INFO={auth_info} SIGSTORE_IDENTITY_TOKEN={identity_token} python3 add-to-pydotorg.py {db['release']}"
     )
@@ -965,8 +1235,7 @@ def post_release_tagging(db: DbfilenameShelf) -> None:
         cwd=db["git_repo"],
     )
 
-    with cd(db["git_repo"]):
-        release_mod.done(db["release"])
+    release_mod.done(db["release"], repo=str(db["git_repo"]))
 
     subprocess.check_call(
         ["git", "commit", "-a", "-m", f"Post {db['release']}"],
@@ -986,13 +1255,12 @@ def maybe_prepare_new_main_branch(db: DbfilenameShelf) -> None:
     )
 
     new_release = release_tag.next_minor_release()
-    with cd(db["git_repo"]):
-        release_mod.bump(new_release)
+    release_mod.bump(new_release, repo=str(db["git_repo"]))
 
     prev_branch = f"{release_tag.major}.{release_tag.minor}"
     new_branch = f"{release_tag.major}.{int(release_tag.minor)+1}"
     whatsnew_file = f"Doc/whatsnew/{new_branch}.rst"
-    with cd(db["git_repo"]), open(whatsnew_file, "w") as f:
+    with open(db["git_repo"] / whatsnew_file, "w") as f:
         f.write(WHATS_NEW_TEMPLATE.format(version=new_branch, prev_version=prev_branch))
 
     subprocess.check_call(
@@ -1023,12 +1291,8 @@ def branch_new_versions(db: DbfilenameShelf) -> None:
 def is_mirror(repo: pathlib.Path, remote: str) -> bool:
     """Return True if the `repo` directory was created with --mirror."""
 
-    cmd = ["git", "config", "--local", "--get", f"remote.{remote}.mirror"]
-    try:
-        out = subprocess.check_output(cmd, cwd=repo)
-    except subprocess.CalledProcessError:
-        return False
-    return out.startswith(b"true")
+    mirror = gitquery.repository(repo).config(f"remote.{remote}.mirror", local=True)
+    return mirror is not None and mirror.startswith("true")
 
 
 def push_to_local_fork(db: DbfilenameShelf) -> None:
@@ -1153,18 +1417,43 @@ fix these things in this script so it also support your platform.
         help="Username to be used when authenticating via ssh",
         type=str,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=taskgraph.JOBS,
+        help="How many independent tasks to run at the same time "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--replicate-docs",
+        action="store_true",
+        help=f"Upload the docs to {DOWNLOADS_SERVER} only, and have {DOCS_SERVER} "
+        "copy them from there (needs an SSH agent)",
+    )
     args = parser.parse_args()
     auth_key = args.auth_key or os.getenv("AUTH_INFO")
     assert isinstance(auth_key, str), "We need an AUTH_INFO env var or --auth-key"
+    # The checks don't depend on each other, and most steps after the
+    # artifacts are built only depend on a few earlier ones.
     tasks = [
-        Task(check_git, "Checking git is available"),
-        Task(check_make, "Checking make is available"),
-        Task(check_blurb, "Checking blurb is available"),
-        Task(check_docker, "Checking docker is available"),
-        Task(check_autoconf, "Checking autoconf is available"),
-        Task(check_gpg_keys, "Checking GPG keys"),
-        Task(check_ssh_connection, f"Validating ssh connection to {DOWNLOADS_SERVER}"),
-        Task(check_buildbots, "Check buildbots are good"),
+        Task(check_git, "Checking git is available", after=()),
+        Task(check_make, "Checking make is available", after=()),
+        Task(check_blurb, "Checking blurb is available", after=()),
+        Task(check_docker, "Checking docker is available", after=()),
+        Task(check_autoconf, "Checking autoconf is available", after=()),
+        Task(check_gpg_keys, "Checking GPG keys", after=(), locks=("prompt",)),
+        Task(
+            check_ssh_connection,
+            f"Validating ssh connection to {DOWNLOADS_SERVER}",
+            after=(),
+        ),
+        Task(
+            check_buildbots,
+            "Check buildbots are good",
+            after=(),
+            locks=("prompt",),
+        ),
         Task(check_cpython_repo_is_clean, "Checking git repository is clean"),
         Task(preapre_temporary_branch, "Checking out a temporary release branch"),
         Task(run_blurb_release, "Run blurb release"),
@@ -1190,26 +1479,117 @@ fix these things in this script so it also support your platform.
             wait_for_source_and_docs_artifacts,
             "Wait for source and docs artifacts to build",
         ),
-        Task(build_sbom_artifacts, "Building SBOM artifacts"),
-        Task(sign_source_artifacts, "Sign source artifacts"),
-        Task(upload_files_to_server, "Upload files to the PSF server"),
-        Task(place_files_in_download_folder, "Place files in the download folder"),
-        Task(upload_docs_to_the_docs_server, "Upload docs to the PSF docs server"),
-        Task(unpack_docs_in_the_docs_server, "Place docs files in the docs folder"),
-        Task(wait_until_all_files_are_in_folder, "Wait until all files are ready"),
-        Task(create_release_object_in_db, "The django release object has been created"),
-        Task(post_release_merge, "Merge the tag into the release branch"),
-        Task(branch_new_versions, "Branch out new versions and prepare main branch"),
-        Task(post_release_tagging, "Final touches for the release"),
+        Task(
+            build_sbom_artifacts,
+            "Building SBOM artifacts",
+            after=(wait_for_source_and_docs_artifacts,),
+        ),
+        Task(
+            sign_source_artifacts,
+            "Sign source artifacts",
+            after=(wait_for_source_and_docs_artifacts,),
+            locks=("prompt",),
+        ),
+        Task(
+            upload_files_to_server,
+            "Upload files to the PSF server",
+            after=(build_sbom_artifacts, sign_source_artifacts),
+            # alive_progress shows one bar at a time, and takes over stdout.
+            locks=("prompt",),
+        ),
+        Task(
+            place_files_in_download_folder,
+            "Place files in the download folder",
+            after=(upload_files_to_server,),
+        ),
+        Task(
+            upload_docs_to_the_docs_server,
+            "Upload docs to the PSF docs server",
+            # The docs are copied from the downloads server once there.
+            after=(
+                (upload_files_to_server,)
+                if args.replicate_docs
+                else (wait_for_source_and_docs_artifacts,)
+            ),
+            locks=("prompt",),
+        ),
+        Task(
+            unpack_docs_in_the_docs_server,
+            "Place docs files in the docs folder",
+            after=(upload_docs_to_the_docs_server,),
+        ),
+        Task(
+            wait_until_all_files_are_in_folder,
+            "Wait until all files are ready",
+            after=(place_files_in_download_folder,),
+        ),
+        Task(
+            create_release_object_in_db,
+            "The django release object has been created",
+            # The release page links to the files, which must be there.
+            after=(wait_until_all_files_are_in_folder,),
+            locks=("prompt",),
+        ),
+        Task(
+            post_release_merge,
+            "Merge the tag into the release branch",
+            after=(wait_for_source_and_docs_artifacts,),
+            locks=("git",),
+        ),
+        Task(
+            branch_new_versions,
+            "Branch out new versions and prepare main branch",
+            after=(post_release_merge,),
+            locks=("git",),
+        ),
+        Task(
+            post_release_tagging,
+            "Final touches for the release",
+            after=(branch_new_versions,),
+            locks=("git",),
+        ),
         Task(
             maybe_prepare_new_main_branch,
             "prepare new main branch for feature freeze",
+            after=(post_release_tagging,),
+            locks=("git",),
+        ),
+        # The tag is only pushed once the release is available.
+        Task(
+            push_to_upstream,
+            "Push new tags and branches to upstream",
+            after=(
+                maybe_prepare_new_main_branch,
+                wait_until_all_files_are_in_folder,
+                unpack_docs_in_the_docs_server,
+                create_release_object_in_db,
+            ),
+            locks=("git", "prompt"),
+        ),
+        Task(
+            remove_temporary_branch,
+            "Removing temporary release branch",
+            after=(push_to_upstream,),
+            locks=("git",),
+        ),
+        Task(
+            run_add_to_python_dot_org,
+            "Add files to python.org download page",
+            after=(push_to_upstream,),
+            # Getting a Sigstore identity token opens a browser.
+            locks=("prompt",),
+        ),
+        Task(
+            purge_the_cdn,
+            "Purge the CDN of python.org/downloads",
+            after=(run_add_to_python_dot_org,),
+        ),
+        Task(
+            modify_the_release_to_the_prerelease_pages,
+            "Modify the pre-release page",
+            after=(run_add_to_python_dot_org,),
+            locks=("prompt",),
         ),
-        Task(push_to_upstream, "Push new tags and branches to upstream"),
-        Task(remove_temporary_branch, "Removing temporary release branch"),
-        Task(run_add_to_python_dot_org, "Add files to python.org download page"),
-        Task(purge_the_cdn, "Purge the CDN of python.org/downloads"),
-        Task(modify_the_release_to_the_prerelease_pages, "Modify the pre-release page"),
     ]
     automata = ReleaseDriver(
         git_repo=args.repo,
@@ -1217,6 +1597,8 @@ fix these things in this script so it also support your platform.
         api_key=auth_key,
         ssh_user=args.ssh_user,
         tasks=tasks,
+        jobs=args.jobs,
+        replicate_docs=args.replicate_docs,
     )
     automata.run()
 
@@ -26,6 +26,8 @@ import zipfile
 from typing import Any
 from urllib.request import urlopen
 
+import reprotar
+
 
 def spdx_id(value: str) -> str:
     """Encode a value into characters that are valid in an SPDX ID"""
@@ -422,6 +424,8 @@ def create_sbom_for_source_tarball(tarball_path: str) -> dict[str, Any]:
         tarball = tarfile.open(tarball_path, mode="r:gz")
     elif tarball_name.endswith(".tar.xz"):
         tarball = tarfile.open(tarball_path, mode="r:xz")
+    elif tarball_name.endswith(".tar.zst"):
+        tarball = reprotar.open_zstd_tarball(tarball_path)
     else:
         raise ValueError(f"Unknown tarball format: '{tarball_name}'")
 
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+"""Explain why two builds of a tarball aren't byte-identical.
+
+Both tarballs are decompressed and read as streams, side by side, and
+their entries are compared header by header (name, type, mode, owner,
+mtime, link target, pax records) and by the SHA-256 of their content.
+Memory use doesn't depend on the size of the tarballs: entries out of
+place are only looked for within a window of recent entries.
+
+If every entry matches, the difference is in the framing: the tar stream
+itself (padding, global headers) or the compression, like the mtime in a
+gzip header.
+
+    $ python tardiff.py Python-3.12.2.tar.xz ci/Python-3.12.2.tar.xz
+    Python-3.12.2/Include/patchlevel.h: mtime 1707250784 != 1707250790
+    Python-3.12.2/Misc/NEWS: content '3b5e...' != '9f1c...'
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import gzip
+import hashlib
+import lzma
+import sys
+import tarfile
+from dataclasses import dataclass, field
+from typing import IO, Any, BinaryIO, Iterator, cast
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+# The header fields compared, in the order they're reported.
+FIELDS = (
+    "type",
+    "mode",
+    "uid",
+    "gid",
+    "uname",
+    "gname",
+    "size",
+    "mtime",
+    "linkname",
+    "devmajor",
+    "devminor",
+    "pax_headers",
+    "content",
+)
+MAX_DIFFERENCES = 20
+WINDOW = 10_000
+CHUNK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+@dataclass(frozen=True)
+class Entry:
+    """The header of a tar entry and the digest of its content."""
+
+    index: int
+    name: str
+    type: bytes
+    mode: int
+    uid: int
+    gid: int
+    uname: str
+    gname: str
+    size: int
+    mtime: float
+    linkname: str
+    devmajor: int
+    devminor: int
+    pax_headers: tuple[tuple[str, str], ...]
+    content: str | None
+
+
+@dataclass
+class DiffReport:
+    entries: tuple[int, int] = (0, 0)
+    differences: list[str] = field(default_factory=list)
+    # Whether every difference was found, or the comparison stopped early.
+    complete: bool = True
+
+    @property
+    def identical(self) -> bool:
+        return not self.differences
+
+
+class Stopped(Exception):
+    """Enough differences were found."""
+
+
+class _HashingReader:
+    """Read-only file wrapper which hashes everything read through it."""
+
+    def __init__(self, fileobj: IO[bytes]) -> None:
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def finish(self) -> str:
+        """Read the rest of the stream, and return its digest."""
+        while self.read(CHUNK_SIZE):
+            pass
+        return self.sha256.hexdigest()
+
+
+def open_decompressed(path: str) -> tuple[str, BinaryIO]:
+    """Open a (compressed) tarball as a stream of tar bytes.
+
+    Return the name of the compression and the stream.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip", cast(BinaryIO, gzip.open(path))
+    if magic.startswith(XZ_MAGIC):
+        return "xz", cast(BinaryIO, lzma.open(path))
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("The 'zstandard' package is needed for .tar.zst")
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return "zstd", cast(BinaryIO, reader)
+    return "none", open(path, "rb")
+
+
+def gzip_header(path: str) -> dict[str, Any]:
+    """The fields of the first gzip member header which vary between builds."""
+    with open(path, "rb") as f:
+        header = f.read(10)
+        flags = header[3]
+        name = b""
+        if flags & 0x04:  # FEXTRA
+            f.read(int.from_bytes(f.read(2), "little"))
+        if flags & 0x08:  # FNAME
+            while (byte := f.read(1)) not in (b"", b"\0"):
+                name += byte
+    return {
+        "mtime": int.from_bytes(header[4:8], "little"),
+        "xfl": header[8],
+        "os": header[9],
+        "name": name.decode("latin-1"),
+    }
+
+
+def entries(tar: tarfile.TarFile) -> Iterator[Entry]:
+    for index, member in enumerate(tar):
+        content = None
+        if member.isfile():
+            digest = hashlib.sha256()
+            fileobj = tar.extractfile(member)
+            assert fileobj is not None
+            while chunk := fileobj.read(CHUNK_SIZE):
+                digest.update(chunk)
+            content = digest.hexdigest()
+        yield Entry(
+            index=index,
+            name=member.name,
+            type=member.type,
+            mode=member.mode,
+            uid=member.uid,
+            gid=member.gid,
+            uname=member.uname,
+            gname=member.gname,
+            size=member.size,
+            mtime=member.mtime,
+            linkname=member.linkname,
+            devmajor=member.devmajor,
+            devminor=member.devminor,
+            pax_headers=tuple(sorted(member.pax_headers.items())),
+            content=content,
+        )
+
+
+def _format(value: object) -> str:
+    if isinstance(value, tuple):
+        return "{" + ", ".join(f"{k}={v}" for k, v in value) + "}"
+    return repr(value) if isinstance(value, (str, bytes)) else str(value)
+
+
+class _Differ:
+    def __init__(self, max_differences: int, window: int) -> None:
+        self.max_differences = max_differences
+        self.window = window
+        self.differences: list[str] = []
+        self.missing_entries = 0
+        # The first pair of entries which weren't side by side.
+        self.out_of_step: tuple[Entry, Entry] | None = None
+        # Entries not matched yet, by name, oldest first.
+        self.pending: tuple[
+            collections.OrderedDict[str, Entry], collections.OrderedDict[str, Entry]
+        ] = (collections.OrderedDict(), collections.OrderedDict())
+
+    def report(self, difference: str) -> None:
+        self.differences.append(difference)
+        if len(self.differences) >= self.max_differences:
+            raise Stopped
+
+    def compare(self, a: Entry, b: Entry) -> None:
+        if a.index != b.index and self.out_of_step is None:
+            self.out_of_step = (a, b)
+        for name in FIELDS:
+            value_a, value_b = getattr(a, name), getattr(b, name)
+            if value_a != value_b:
+                self.report(
+                    f"{a.name}: {name} {_format(value_a)} != {_format(value_b)}"
+                )
+
+    def add(self, side: int, entry: Entry) -> None:
+        """Match an entry with the other side's, or keep it for later."""
+        other = self.pending[1 - side]
+        if entry.name in other:
+            match = other.pop(entry.name)
+            self.compare(*((entry, match) if side == 0 else (match, entry)))
+            return
+        pending = self.pending[side]
+        if entry.name in pending:
+            self.report(f"{entry.name}: appears more than once in tarball {side + 1}")
+        pending[entry.name] = entry
+        if len(pending) > self.window:
+            self.missing(side, pending.popitem(last=False)[1])
+
+    def missing(self, side: int, entry: Entry) -> None:
+        self.missing_entries += 1
+        self.report(f"{entry.name}: only in tarball {side + 1}")
+
+    def finish(self) -> None:
+        for side in (0, 1):
+            while self.pending[side]:
+                self.missing(side, self.pending[side].popitem(last=False)[1])
+        # Entries out of step without any missing entries are out of order.
+        if self.out_of_step is not None and not self.missing_entries:
+            a, b = self.out_of_step
+            self.report(
+                f"{a.name}: the entries are in another order, from entry "
+                f"{a.index} != {b.index}"
+            )
+
+
+def diff_tarballs(
+    path_a: str,
+    path_b: str,
+    max_differences: int = MAX_DIFFERENCES,
+    window: int = WINDOW,
+) -> DiffReport:
+    """Compare two tarballs entry by entry, stopping at max_differences."""
+    report = DiffReport()
+    differ = _Differ(max_differences, window)
+    compression_a, stream_a = open_decompressed(path_a)
+    compression_b, stream_b = open_decompressed(path_b)
+    with stream_a, stream_b:
+        reader_a, reader_b = _HashingReader(stream_a), _HashingReader(stream_b)
+        tar_a = tarfile.open(fileobj=cast(IO[bytes], reader_a), mode="r|")
+        tar_b = tarfile.open(fileobj=cast(IO[bytes], reader_b), mode="r|")
+        counts = [0, 0]
+        try:
+            if compression_a != compression_b:
+                differ.report(f"compression {compression_a} != {compression_b}")
+            iterators: list[Iterator[Entry] | None] = [entries(tar_a), entries(tar_b)]
+            checked_globals = False
+            while iterators[0] or iterators[1]:
+                for side, iterator in enumerate(iterators):
+                    entry = next(iterator, None) if iterator is not None else None
+                    if entry is None:
+                        iterators[side] = None
+                        continue
+                    counts[side] += 1
+                    differ.add(side, entry)
+                # The global pax headers come before the first entries.
+                if not checked_globals and all(counts):
+                    checked_globals = True
+                    if tar_a.pax_headers != tar_b.pax_headers:
+                        differ.report(
+                            f"global pax headers {tar_a.pax_headers} "
+                            f"!= {tar_b.pax_headers}"
+                        )
+            differ.finish()
+            if not differ.differences:
+                # Every entry matches: look at the framing.
+                digest_a, digest_b = reader_a.finish(), reader_b.finish()
+                if digest_a != digest_b:
+                    differ.report(
+                        "the tar streams differ outside of the entries "
+                        f"({reader_a.size} != {reader_b.size} bytes)"
+                    )
+                elif compression_a == "gzip":
+                    header_a, header_b = gzip_header(path_a), gzip_header(path_b)
+                    for key in header_a:
+                        if header_a[key] != header_b[key]:
+                            differ.report(
+                                f"gzip header {key} "
+                                f"{_format(header_a[key])} != {_format(header_b[key])}"
+                            )
+                if not differ.differences and not _same_file(path_a, path_b):
+                    differ.report(
+                        f"the tar streams are identical, the {compression_a} "
+                        "compression differs"
+                    )
+        except Stopped:
+            report.complete = False
+        report.entries = (counts[0], counts[1])
+    report.differences = differ.differences
+    return report
+
+
+def _same_file(path_a: str, path_b: str) -> bool:
+    with open(path_a, "rb") as a, open(path_b, "rb") as b:
+        while True:
+            chunk_a, chunk_b = a.read(CHUNK_SIZE), b.read(CHUNK_SIZE)
+            if chunk_a != chunk_b:
+                return False
+            if not chunk_a:
+                return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("tarballs", nargs=2, metavar="TARBALL")
+    parser.add_argument(
+        "-n",
+        "--max-differences",
+        type=int,
+        default=MAX_DIFFERENCES,
+        help="stop after this many differences (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=WINDOW,
+        help="how many entries to look ahead for an entry out of place "
+        "(default: %(default)s)",
+    )
+    args = parser.parse_args()
+    try:
+        path_a, path_b = args.tarballs
+        report = diff_tarballs(path_a, path_b, args.max_differences, args.window)
+    except (OSError, EOFError, lzma.LZMAError, tarfile.TarError, RuntimeError) as e:
+        sys.exit(f"Can't compare the tarballs: {e}")
+    for difference in report.differences:
+        print(difference)
+    if report.identical:
+        print(f"Identical: {report.entries[0]} entries")
+    elif not report.complete:
+        print(f"Stopped after {len(report.differences)} differences")
+    sys.exit(0 if report.identical else 1)
+
+
+if __name__ == "__main__":
+    main()
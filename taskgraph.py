@@ -0,0 +1,118 @@
+"""Run tasks as soon as what they depend on is done.
+
+Each task waits for the tasks it depends on, and holds named locks while
+it runs: two tasks sharing a lock (like the git working tree, or the
+terminal for a question) never run at the same time.  Ready tasks start
+in their order in the list, so a task list where every task depends on
+all the earlier ones runs just like a plain loop.
+
+If a task fails, no other task is started.  The running ones finish,
+then the first error is raised.  Finished tasks are reported as they
+finish, so the caller can checkpoint them and skip them when resuming.
+
+Each task runs in a daemon thread of its own.  An error raised in the
+calling thread, like KeyboardInterrupt on Ctrl-C, is raised at once,
+and the running tasks are abandoned: a task waiting for an answer at
+the terminal doesn't keep the program alive.
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+from typing import Callable, Collection, Hashable, Sequence
+
+JOBS = 8
+
+
+class CycleError(Exception):
+    """Some tasks depend on each other, or on a later task."""
+
+
+def resolve(
+    keys: Sequence[Hashable], after: Sequence[Collection[Hashable] | None]
+) -> list[frozenset[int]]:
+    """The indices of the tasks each task depends on.
+
+    A task depends on the tasks named by its `after` keys, each the last
+    task before it with that key, or on every earlier task if `after` is
+    None.
+    """
+    dependencies = []
+    last: dict[Hashable, int] = {}
+    for index, (key, names) in enumerate(zip(keys, after)):
+        if names is None:
+            dependencies.append(frozenset(range(index)))
+        else:
+            missing = [name for name in names if name not in last]
+            if missing:
+                raise CycleError(f"task {index} depends on later tasks: {missing}")
+            dependencies.append(frozenset(last[name] for name in names))
+        last[key] = index
+    return dependencies
+
+
+def run(
+    execute: Callable[[int], None],
+    dependencies: Sequence[Collection[int]],
+    locks: Sequence[Collection[str]] = (),
+    completed: Collection[int] = (),
+    on_done: Callable[[int], None] | None = None,
+    jobs: int = JOBS,
+) -> None:
+    """Run the tasks not completed yet, `jobs` at most at a time.
+
+    `execute` is called with the index of each task, in a worker thread.
+    `on_done` is called with the index of each task which finished, in
+    the calling thread.
+    """
+    count = len(dependencies)
+    locks = locks or [()] * count
+    done = set(completed)
+    running: set[int] = set()
+    held: set[str] = set()
+    errors: list[BaseException] = []
+    finished: queue.Queue[tuple[int, BaseException | None]] = queue.Queue()
+
+    def work(index: int) -> None:
+        try:
+            execute(index)
+        except BaseException as e:
+            finished.put((index, e))
+        else:
+            finished.put((index, None))
+
+    def ready(index: int) -> bool:
+        return (
+            index not in done
+            and index not in running
+            and all(dependency in done for dependency in dependencies[index])
+            and not held.intersection(locks[index])
+        )
+
+    while True:
+        if not errors:
+            for index in range(count):
+                if len(running) >= jobs:
+                    break
+                if ready(index):
+                    held.update(locks[index])
+                    running.add(index)
+                    threading.Thread(
+                        target=work, args=(index,), name=f"task-{index}", daemon=True
+                    ).start()
+        if not running:
+            break
+        index, exception = finished.get()
+        running.discard(index)
+        held.difference_update(locks[index])
+        if exception is not None:
+            errors.append(exception)
+            continue
+        done.add(index)
+        if on_done is not None:
+            on_done(index)
+    if errors:
+        raise errors[0]
+    if len(done) < count:
+        raise CycleError(f"tasks {sorted(set(range(count)) - done)} never got ready")
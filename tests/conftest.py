@@ -0,0 +1,89 @@
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+
+# The commit date of the tag in the fake CPython repository.
+COMMIT_EPOCH = 1707250784
+
+FILES = {
+    "README.rst": "This is Python version 3.12.2\n",
+    "LICENSE": "A. HISTORY OF THE SOFTWARE\n",
+    "Include/Python.h": "#include <patchlevel.h>\n",
+    "Include/Python-ast.h": "// generated\n",
+    "Python/ceval.c": "int main(void) { return 0; }\n",
+    "Lib/os.py": "import sys\n",
+    "Lib/test/test_os.py": "import os\n",
+    "Doc/conf.py": "project = 'Python'\n",
+    "Doc/.gitignore": "build/\n",
+    "Misc/NEWS.d/3.12.2.rst": ".. release date: 2024-02-06\n",
+    "Misc/NEWS.d/next/Library/2024-01-01-00-00-00.gh-issue-1.abc.rst": "Fix.\n",
+    ".gitattributes": "* text=auto\n",
+    ".gitignore": "*.o\n",
+    ".github/workflows/build.yml": "on: push\n",
+    ".azure-pipelines/ci.yml": "trigger: none\n",
+}
+
+
+@pytest.fixture(autouse=True)
+def command_log(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Keep the commands the tests run out of the real command log."""
+    log = tmp_path / "commands.jsonl"
+    monkeypatch.setenv("RELEASE_COMMAND_LOG", str(log))
+    return log
+
+
+def git(repo: Path, *args: str, epoch: int = COMMIT_EPOCH) -> str:
+    env = {
+        **os.environ,
+        "GIT_AUTHOR_NAME": "Release Manager",
+        "GIT_AUTHOR_EMAIL": "rm@python.org",
+        "GIT_AUTHOR_DATE": f"{epoch} +0000",
+        "GIT_COMMITTER_NAME": "Release Manager",
+        "GIT_COMMITTER_EMAIL": "rm@python.org",
+        "GIT_COMMITTER_DATE": f"{epoch} +0000",
+    }
+    return subprocess.check_output(
+        ["git", *args], cwd=repo, env=env, text=True, stderr=subprocess.STDOUT
+    )
+
+
+@pytest.fixture
+def cpython_repo(tmp_path: Path) -> Path:
+    """A tiny git repository shaped like CPython, tagged v3.12.2."""
+    repo = tmp_path / "cpython"
+    for name, content in FILES.items():
+        path = repo / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    (repo / "configure").write_text("#!/bin/sh\n")
+    (repo / "configure").chmod(0o755)
+    (repo / "Lib" / "python").symlink_to("os.py")
+    git(repo, "init", "--quiet")
+    git(repo, "add", "--all")
+    git(repo, "commit", "--quiet", "--message", "Python 3.12.2")
+    git(repo, "tag", "--annotate", "--message", "Python 3.12.2", "v3.12.2")
+    return repo
+
+
+BLURB = """\
+#!/bin/sh
+# Just enough of blurb for an export.
+case "$1" in
+merge) find Misc/NEWS.d -type f | LC_ALL=C sort | xargs cat > Misc/NEWS ;;
+export) rm -rf Misc/NEWS.d ;;
+esac
+"""
+
+
+@pytest.fixture
+def fake_blurb(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A stand-in for the blurb command, first on the PATH."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    blurb = bin_dir / "blurb"
+    blurb.write_text(BLURB)
+    blurb.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return blurb
@@ -0,0 +1,77 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import bench_export
+
+
+def test_run(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Arrange
+    monkeypatch.setenv("PATH", os.environ["PATH"])
+    cwd = os.getcwd()
+
+    # Act
+    result = bench_export.run(str(tmp_path), files=60, file_size=512, jobs=2)
+
+    # Assert
+    assert sorted(result.phases) == [
+        "archive",
+        "blurb",
+        "cleanup",
+        "compress",
+        "extract",
+        "gzip",
+        "md5",
+        "verify",
+        "xz",
+    ]
+    assert result.total >= result.phases["compress"] > 0
+    assert result.peak_disk > 0
+    assert sorted(result.tarball_sizes) == [
+        "Python-3.12.2.tar.xz",
+        "Python-3.12.2.tgz",
+    ]
+    assert os.getcwd() == cwd
+
+
+def test_synthetic_repository_is_reproducible(tmp_path: Path) -> None:
+    # Arrange
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+
+    # Act
+    for repo in (first, second):
+        bench_export.make_repository(str(repo), files=30, file_size=256)
+
+    # Assert
+    commits = [
+        (repo / ".git" / "refs" / "tags" / "v3.12.2").read_text()
+        for repo in (first, second)
+    ]
+    assert commits[0] == commits[1]
+
+
+def test_baseline(tmp_path: Path) -> None:
+    # Arrange
+    baseline = bench_export.Result(files=10, file_size=100, jobs=1)
+    baseline.phases = {"extract": 1.0, "compress": 2.0}
+    baseline.total = 3.0
+    baseline.peak_disk = 1024**2
+    path = bench_export.baseline_path(str(tmp_path / "bench"), "main")
+    bench_export.save_baseline(baseline, path)
+    result = bench_export.Result(files=10, file_size=100, jobs=1)
+    result.phases = {"extract": 1.5, "compress": 1.0}
+    result.total = 2.5
+    result.peak_disk = 2 * 1024**2
+
+    # Act
+    loaded = bench_export.load_baseline(path)
+    text = bench_export.report(result, loaded)
+
+    # Assert
+    assert loaded == baseline
+    assert "  extract       1.500s     1.000s   +50.0%" in text
+    assert "  compress      1.000s     2.000s   -50.0%" in text
+    assert "  peak disk    2.0 MiB    1.0 MiB  +100.0%" in text
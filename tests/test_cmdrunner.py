@@ -0,0 +1,159 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import cmdrunner
+
+
+def read_log(log: Path) -> list[dict[str, object]]:
+    return [json.loads(line) for line in log.read_text().splitlines()]
+
+
+def test_run_cmd(command_log: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    # Act
+    result = cmdrunner.run_cmd(["echo", "hello"], cwd="/")
+
+    # Assert
+    assert capsys.readouterr().out == "Executing ['echo', 'hello']\nhello\n"
+    assert result.returncode == 0
+    assert result.output_bytes == 6
+    [record] = read_log(command_log)
+    assert record["command"] == ["echo", "hello"]
+    assert record["cwd"] == "/"
+    assert record["returncode"] == 0
+    assert record["output_bytes"] == 6
+    assert isinstance(record["seconds"], float)
+
+
+def test_run_cmd_fails(command_log: Path) -> None:
+    # Act
+    with pytest.raises(SystemExit):
+        cmdrunner.run_cmd(["false"], silent=True)
+
+    # Assert
+    [record] = read_log(command_log)
+    assert record["returncode"] == 1
+
+
+def test_run_cmd_shell_quotes_arguments(capsys: pytest.CaptureFixture[str]) -> None:
+    # Act
+    cmdrunner.run_cmd(["echo", "a  b; echo c"], shell=True)
+
+    # Assert
+    assert capsys.readouterr().out.splitlines()[-1] == "a  b; echo c"
+
+
+def test_run_cmd_to_file(tmp_path: Path) -> None:
+    # Arrange
+    output = tmp_path / "output.log"
+
+    # Act
+    with open(output, "w") as f:
+        f.write("header\n")
+        result = cmdrunner.run_cmd(["echo", "hello"], silent=True, stdout=f)
+
+    # Assert
+    assert output.read_text() == "header\nhello\n"
+    assert result.output_bytes == 6
+
+
+def test_run_many(command_log: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    # Arrange
+    script = "import sys; print(sys.argv[1]); print(sys.argv[1] * 2)"
+    commands = [[sys.executable, "-c", script, name] for name in ("a", "b", "c")]
+
+    # Act
+    results = cmdrunner.run_many(commands, jobs=2, names=["x", "y", "z"])
+
+    # Assert
+    lines = [
+        line for line in capsys.readouterr().out.splitlines() if "Executing" not in line
+    ]
+    assert sorted(lines) == [
+        "[x] a",
+        "[x] aa",
+        "[y] b",
+        "[y] bb",
+        "[z] c",
+        "[z] cc",
+    ]
+    assert [result.output_bytes for result in results] == [5, 5, 5]
+    assert len(read_log(command_log)) == 3
+
+
+def test_run_many_reports_all_failures(
+    command_log: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    # Act
+    with pytest.raises(SystemExit):
+        cmdrunner.run_many([["false"], ["true"], ["false"]], silent=True)
+
+    # Assert
+    assert capsys.readouterr().err == (
+        "**ERROR**\n['false'] failed\n['false'] failed\n"
+    )
+    assert [record["returncode"] for record in read_log(command_log)].count(1) == 2
+
+
+def test_log(command_log: Path) -> None:
+    # Act
+    cmdrunner.run_cmd(["true"], silent=True)
+    cmdrunner.log({"transfer": "src/Python-3.13.0.tgz", "bytes": 1024})
+
+    # Assert
+    records = read_log(command_log)
+    assert records[0]["command"] == ["true"]
+    assert records[1] == {"transfer": "src/Python-3.13.0.tgz", "bytes": 1024}
+
+
+def test_check_output(command_log: Path) -> None:
+    # Act
+    output = cmdrunner.check_output(["cat"], cwd="/", input=b"hello\n")
+    with pytest.raises(subprocess.CalledProcessError):
+        cmdrunner.check_output(["false"])
+
+    # Assert
+    assert output == b"hello\n"
+    records = read_log(command_log)
+    assert records[0]["command"] == ["cat"]
+    assert records[0]["cwd"] == "/"
+    assert records[0]["output_bytes"] == 6
+    assert records[1]["returncode"] == 1
+
+
+def test_stream_cmd(command_log: Path) -> None:
+    # Act
+    with cmdrunner.stream_cmd(["echo", "hello"], silent=True, cwd="/") as stdout:
+        output = stdout.read()
+
+    # Assert
+    assert output == b"hello\n"
+    [record] = read_log(command_log)
+    assert record["command"] == ["echo", "hello"]
+    assert record["cwd"] == "/"
+    assert record["returncode"] == 0
+    assert record["output_bytes"] is None
+
+
+def test_stream_cmd_fails_over_reading_error(command_log: Path) -> None:
+    # Act
+    # The error of the command is the one reported, not the one it caused.
+    with pytest.raises(SystemExit):
+        with cmdrunner.stream_cmd(["false"], silent=True) as stdout:
+            if not stdout.read():
+                raise ValueError("no output")
+
+    # Assert
+    [record] = read_log(command_log)
+    assert record["returncode"] == 1
+
+
+def test_stream_cmd_reading_error() -> None:
+    # Act / Assert
+    with pytest.raises(ValueError, match="bad output"):
+        with cmdrunner.stream_cmd(["echo", "hello"], silent=True) as stdout:
+            stdout.read()
+            raise ValueError("bad output")
@@ -0,0 +1,173 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from pytest_mock import MockerFixture
+
+import docsenv
+
+
+def make_cache(tmp_path: Path, mocker: MockerFixture) -> docsenv.DocsEnvironmentCache:
+    cache = docsenv.DocsEnvironmentCache(
+        str(tmp_path / "cache"), python=sys.executable, max_environments=2
+    )
+    mocker.patch.object(cache, "create", side_effect=lambda venv, _: os.mkdir(venv))
+    mocker.patch.object(cache, "freeze", return_value=["Sphinx==7.2.6"])
+    return cache
+
+
+def test_key(tmp_path: Path) -> None:
+    # Arrange
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("sphinx~=7.2.0\n")
+    cache = docsenv.DocsEnvironmentCache(str(tmp_path), python=sys.executable)
+
+    # Act
+    first = cache.key(str(requirements))
+    requirements.write_text("sphinx~=7.3.0\n")
+    second = cache.key(str(requirements))
+
+    # Assert
+    assert len(first) == 16
+    assert first != second
+
+
+def test_create_fetches_missing_wheels(tmp_path: Path, mocker: MockerFixture) -> None:
+    # Arrange
+    cache = docsenv.DocsEnvironmentCache(str(tmp_path), python=sys.executable)
+    returncodes = [0, 1, 0, 0, 0, 1, 1]
+    run_cmd = mocker.patch(
+        "cmdrunner.run_cmd",
+        side_effect=lambda *args, **kwargs: mocker.Mock(returncode=returncodes.pop(0)),
+    )
+
+    # Act
+    cache.create(str(tmp_path / "venv"), "requirements.txt")
+    with pytest.raises(subprocess.CalledProcessError):
+        cache.create(str(tmp_path / "venv"), "requirements.txt")
+
+    # Assert
+    assert [call.args[0][1] for call in run_cmd.call_args_list] == [
+        "-m",
+        "install",
+        "wheel",
+        "install",
+        "-m",
+        "install",
+        "wheel",
+    ]
+
+
+def test_get_reuses_environment(tmp_path: Path, mocker: MockerFixture) -> None:
+    # Arrange
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("sphinx~=7.2.0\n")
+    cache = make_cache(tmp_path, mocker)
+
+    # Act
+    with cache.use(str(requirements)) as first:
+        pass
+    with cache.use(str(requirements)) as second:
+        pass
+
+    # Assert
+    assert first == second
+    assert os.path.isdir(first)
+    cache.create.assert_called_once()  # type: ignore[attr-defined]
+
+
+def test_get_rebuilds_changed_environment(
+    tmp_path: Path, mocker: MockerFixture
+) -> None:
+    # Arrange
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("sphinx~=7.2.0\n")
+    cache = make_cache(tmp_path, mocker)
+    with cache.use(str(requirements)):
+        pass
+
+    # Act
+    # Someone installed a package into the cached environment.
+    cache.freeze.return_value = ["Sphinx==7.2.6", "extra==1.0"]  # type: ignore[attr-defined]
+    with cache.use(str(requirements)):
+        pass
+
+    # Assert
+    assert cache.create.call_count == 2  # type: ignore[attr-defined]
+
+
+def test_evict_least_recently_used(tmp_path: Path, mocker: MockerFixture) -> None:
+    # Arrange
+    cache = make_cache(tmp_path, mocker)
+    requirements = tmp_path / "requirements.txt"
+    keys: list[str] = []
+
+    # Act
+    for used, version in enumerate(("7.1", "7.2", "7.3")):
+        requirements.write_text(f"sphinx~={version}.0\n")
+        keys.append(cache.key(str(requirements)))
+        with cache.use(str(requirements)):
+            pass
+        manifest = Path(cache.root, keys[-1], docsenv.MANIFEST)
+        os.utime(manifest, (used, used))
+
+    # Assert
+    assert [key for used, key in cache.environments()] == keys[1:]
+
+
+def test_evict_skips_environment_in_use(tmp_path: Path, mocker: MockerFixture) -> None:
+    # Arrange
+    cache = make_cache(tmp_path, mocker)
+    requirements = tmp_path / "requirements.txt"
+    keys: list[str] = []
+
+    # Act
+    requirements.write_text("sphinx~=7.1.0\n")
+    with cache.use(str(requirements)) as in_use:
+        keys.append(cache.key(str(requirements)))
+        # Other builds, at the same time, would evict the first environment.
+        for version in ("7.2", "7.3"):
+            requirements.write_text(f"sphinx~={version}.0\n")
+            keys.append(cache.key(str(requirements)))
+            with cache.use(str(requirements)):
+                pass
+        still_there = os.path.isdir(in_use)
+
+    # Assert
+    assert still_there
+    assert sorted(key for used, key in cache.environments()) == sorted(keys)
+
+
+def test_evict_prunes_wheelhouse(tmp_path: Path, mocker: MockerFixture) -> None:
+    # Arrange
+    cache = make_cache(tmp_path, mocker)
+    requirements = tmp_path / "requirements.txt"
+    wheels = Path(cache.wheelhouse)
+    wheels.mkdir(parents=True)
+    (wheels / "docutils-0.20.1-py3-none-any.whl").write_text("")
+    (wheels / "Jinja2-3.1.2-py3-none-any.whl").write_text("")
+
+    # Act
+    for used, version in enumerate(("7.1", "7.2", "7.3")):
+        requirements.write_text(f"sphinx~={version}.0\n")
+        # As "pip wheel" would have fetched it.
+        (wheels / f"sphinx-{version}.0-py3-none-any.whl").write_text("")
+        cache.freeze.return_value = [  # type: ignore[attr-defined]
+            f"Sphinx=={version}.0",
+            "docutils==0.20.1",
+            "pip==24.0",
+        ]
+        with cache.use(str(requirements)):
+            pass
+        manifest = Path(cache.root, cache.key(str(requirements)), docsenv.MANIFEST)
+        os.utime(manifest, (used, used))
+
+    # Assert
+    # The first environment was evicted; nothing ever installed Jinja2.
+    assert sorted(os.listdir(wheels)) == [
+        "docutils-0.20.1-py3-none-any.whl",
+        "sphinx-7.2.0-py3-none-any.whl",
+        "sphinx-7.3.0-py3-none-any.whl",
+    ]
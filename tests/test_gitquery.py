@@ -0,0 +1,117 @@
+import json
+from pathlib import Path
+
+import pytest
+from pytest_mock import MockerFixture
+
+import gitquery
+from tests.conftest import COMMIT_EPOCH, git
+
+
+def test_commit(cpython_repo: Path) -> None:
+    # Arrange
+    expected = git(cpython_repo, "rev-parse", "v3.12.2^{commit}").strip()
+
+    # Act
+    with gitquery.GitRepository(cpython_repo) as repo:
+        commit = repo.commit("v3.12.2")
+        commit_time = repo.commit_time("v3.12.2")
+
+    # Assert
+    assert commit == expected
+    assert commit_time == COMMIT_EPOCH
+
+
+def test_commit_memoized(cpython_repo: Path, mocker: MockerFixture) -> None:
+    # Arrange
+    repo = gitquery.GitRepository(cpython_repo)
+    repo.commit_time("v3.12.2")
+    query = mocker.spy(gitquery._CatFile, "query")
+
+    # Act
+    commit_time = repo.commit_time("v3.12.2")
+
+    # Assert
+    assert commit_time == COMMIT_EPOCH
+    query.assert_not_called()
+    repo.close()
+
+
+def test_missing(cpython_repo: Path) -> None:
+    # Arrange
+    with gitquery.GitRepository(cpython_repo) as repo:
+        # Act / Assert
+        with pytest.raises(gitquery.GitError):
+            repo.commit("v3.12.3")
+        # The processes still answer after an error.
+        assert repo.commit_time("v3.12.2") == COMMIT_EPOCH
+
+
+def test_walk_tree(cpython_repo: Path) -> None:
+    # Arrange
+    listing = git(cpython_repo, "ls-tree", "-r", "-t", "v3.12.2")
+    expected = []
+    for line in listing.splitlines():
+        info, path = line.split("\t")
+        mode, _, object_name = info.split()
+        expected.append(gitquery.TreeEntry(path, mode.lstrip("0"), object_name))
+
+    # Act
+    with gitquery.GitRepository(cpython_repo) as repo:
+        entries = list(repo.walk_tree("v3.12.2"))
+        symlink = next(entry for entry in entries if entry.path == "Lib/python")
+        target = repo.read_blob(symlink.object_name)
+
+    # Assert
+    assert entries == expected
+    assert symlink.mode == "120000"
+    assert target == b"os.py"
+
+
+def test_repository_shared(cpython_repo: Path) -> None:
+    # Act / Assert
+    assert gitquery.repository(cpython_repo) is gitquery.repository(
+        str(cpython_repo / "." / "")
+    )
+
+
+def test_blob_cache(cpython_repo: Path, mocker: MockerFixture) -> None:
+    # Arrange
+    with gitquery.GitRepository(cpython_repo) as repo:
+        blobs = {
+            entry.path: entry.object_name
+            for entry in repo.walk_tree("v3.12.2")
+            if entry.path in ("Lib/os.py", "Lib/python")
+        }
+        repo.blob_cache_size = len("import sys\n")
+        query = mocker.spy(gitquery._CatFile, "query")
+
+        # Act
+        first = repo.read_blob(blobs["Lib/os.py"])
+        second = repo.read_blob(blobs["Lib/os.py"])
+        # Doesn't fit beside Lib/os.py, so it's evicted.
+        repo.read_blob(blobs["Lib/python"])
+        third = repo.read_blob(blobs["Lib/os.py"])
+
+    # Assert
+    assert first == second == third == b"import sys\n"
+    assert query.call_count == 3
+
+
+def test_commands_logged(cpython_repo: Path, command_log: Path) -> None:
+    # Arrange
+    repo = gitquery.GitRepository(cpython_repo)
+
+    # Act
+    head = repo.run("rev-parse", "HEAD")
+    changes = repo.diff(head, head)
+    repo.close()
+
+    # Assert
+    assert changes == []
+    records = [json.loads(line) for line in command_log.read_text().splitlines()]
+    assert [record["command"][:2] for record in records] == [
+        ["git", "rev-parse"],
+        ["git", "diff"],
+    ]
+    assert records[0]["cwd"] == str(cpython_repo)
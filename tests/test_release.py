@@ -1,7 +1,19 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import os
+import tarfile
+from pathlib import Path
+
 import pytest
 from pytest_mock import MockerFixture
 
+import cmdrunner
 import release
+import reprotar
+from tests import conftest
 
 
 @pytest.mark.parametrize(
@@ -25,4 +37,567 @@ def test_manual_edit(
     release.manual_edit("README.rst")
 
     # Assert
-    mock_run_cmd.assert_called_once_with(expected)
+    mock_run_cmd.assert_called_once_with(expected, interactive=True)
+
+
+def test_extract_tag(
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+    cpython_repo: Path,
+    command_log: Path,
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.2")
+
+    # Act
+    release.extract_tag(tag, "Python-3.12.2", str(tmp_path / "3.12.2"), silent=True)
+
+    # Assert
+    tree = tmp_path / "3.12.2" / "Python-3.12.2"
+    assert (tree / "Lib" / "os.py").read_text() == "import sys\n"
+    assert (tree / "Lib" / "python").readlink() == Path("os.py")
+    assert os.access(tree / "configure", os.X_OK)
+    assert (tree / "Misc" / "NEWS.d" / "3.12.2.rst").exists()
+    # Only the files in the root of the tree are skipped.
+    assert (tree / "Doc" / ".gitignore").exists()
+    for name in (".gitattributes", ".gitignore", ".github", ".azure-pipelines"):
+        assert not (tree / name).exists()
+    assert not (tmp_path / "3.12.2" / "Python-3.12.2.tar").exists()
+    [record] = [json.loads(line) for line in command_log.read_text().splitlines()]
+    assert record["command"][:2] == ["git", "archive"]
+    assert record["returncode"] == 0
+
+
+def test_extract_tag_unknown_tag(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.3")
+
+    # Act / Assert
+    with pytest.raises(SystemExit):
+        release.extract_tag(tag, "Python-3.12.3", str(tmp_path), silent=True)
+
+
+def test_extract_tag_truncated_archive(mocker: MockerFixture, tmp_path: Path) -> None:
+    # Arrange
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        info = tarfile.TarInfo("Python-3.12.2/Lib/os.py")
+        info.size = 10000
+        tar.addfile(info, io.BytesIO(b"x" * info.size))
+    # As if git had exited successfully in the middle of the file.
+    partial = io.BytesIO(archive.getvalue()[:4096])
+    mocker.patch.object(
+        release, "stream_cmd", return_value=contextlib.nullcontext(partial)
+    )
+
+    # Act / Assert
+    with pytest.raises(tarfile.ReadError):
+        release.extract_tag(
+            release.Tag("3.12.2"), "Python-3.12.2", str(tmp_path), silent=True
+        )
+
+
+@pytest.mark.parametrize(
+    ["path", "expected"],
+    [
+        (".gitignore", True),
+        ("Doc/.gitignore", False),
+        (".github/workflows/build.yml", True),
+        ("Lib/__pycache__", True),
+        ("Lib/__pycache__/os.cpython-312.pyc", True),
+        ("Lib/os.pyc", True),
+        ("Lib/os.py", False),
+        ("Doc/build/html/index.html", True),
+        ("Doc/tools/sphinx", True),
+        ("Doc/tools/extensions/pyspecific.py", False),
+        ("Misc/NEWS.d/3.12.2.rst", False),
+    ],
+)
+def test_export_excludes(path: str, expected: bool) -> None:
+    assert release.EXPORT_EXCLUDES.excludes(path) is expected
+
+
+def test_clean_tree(tmp_path: Path) -> None:
+    # Arrange
+    for name in (
+        ".hgtags",
+        "Doc/build/html/index.html",
+        "Doc/conf.py",
+        "Doc/tools/extensions/pyspecific.py",
+        "Lib/__pycache__/os.cpython-312.pyc",
+        "Lib/os.py",
+        "Lib/test/data.pyo",
+    ):
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).touch()
+
+    # Act
+    report = release.clean_tree(str(tmp_path))
+
+    # Assert
+    assert report.removed == [
+        ".hgtags",
+        "Doc/build",
+        "Lib/__pycache__",
+        "Lib/test/data.pyo",
+    ]
+    assert report.seconds >= 0
+    assert sorted(
+        str(path.relative_to(tmp_path))
+        for path in tmp_path.rglob("*")
+        if path.is_file()
+    ) == ["Doc/conf.py", "Doc/tools/extensions/pyspecific.py", "Lib/os.py"]
+
+
+@pytest.mark.usefixtures("fake_blurb")
+def test_export_treeless(monkeypatch: pytest.MonkeyPatch, cpython_repo: Path) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.2")
+    release.export(tag, silent=True, skip_docs=True)
+    (cpython_repo / "3.12.2").rename(cpython_repo / "on-disk")
+
+    # Act
+    release.export(tag, silent=True, skip_docs=True, treeless=True)
+
+    # Assert
+    for name in ("Python-3.12.2.tgz", "Python-3.12.2.tar.xz"):
+        on_disk = cpython_repo / "on-disk" / "src" / name
+        treeless = cpython_repo / "3.12.2" / "src" / name
+        assert treeless.read_bytes() == on_disk.read_bytes()
+    assert not (cpython_repo / "3.12.2" / "Python-3.12.2").exists()
+    report = json.loads((cpython_repo / "3.12.2" / "verification.json").read_text())
+    assert report["ok"] is True
+    assert report["tarballs"] == ["Python-3.12.2.tgz", "Python-3.12.2.tar.xz"]
+
+
+def test_export_treeless_docs(
+    monkeypatch: pytest.MonkeyPatch, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.2")
+
+    # Act / Assert
+    with pytest.raises(SystemExit):
+        release.export(tag, silent=True, treeless=True)
+
+
+DOCS_MAKEFILE = """\
+dist-html:
+\techo "$@ $(SPHINXOPTS)" >> log
+\tmkdir -p build/doctrees dist
+\techo env > build/doctrees/environment.pickle
+\techo html > dist/html.zip
+dist-text dist-pdf dist-epub dist-texinfo:
+\techo "$@ $(SPHINXOPTS)" >> log
+\t# Each target must start from the environment of the html build.
+\tset -- $(SPHINXOPTS); test -f "$$4/environment.pickle"
+\techo $@ > dist/$@
+"""
+
+
+def test_build_docs_dist(mocker: MockerFixture, tmp_path: Path) -> None:
+    # Arrange
+    mocker.patch("os.cpu_count", return_value=8)
+    doc = tmp_path / "Doc"
+    doc.mkdir()
+    (doc / "Makefile").write_text(DOCS_MAKEFILE)
+
+    # Act
+    dist = release.build_docs_dist(str(doc), str(tmp_path / "bin"))
+
+    # Assert
+    assert sorted(os.listdir(dist)) == [
+        "dist-epub",
+        "dist-pdf",
+        "dist-texinfo",
+        "dist-text",
+        "html.zip",
+    ]
+    log = (doc / "log").read_text().splitlines()
+    assert log[0] == "dist-html -j 8 -d build/doctrees"
+    assert sorted(log[1:]) == [
+        f"{target} -j 2 -d build/doctrees-{target}"
+        for target in sorted(release.DOCS_DIST_TARGETS)
+    ]
+
+
+def test_build_docs_dist_without_targets(mocker: MockerFixture, tmp_path: Path) -> None:
+    # Arrange
+    mocker.patch("os.cpu_count", return_value=8)
+    doc = tmp_path / "Doc"
+    doc.mkdir()
+    (doc / "Makefile").write_text(
+        'dist:\n\tmkdir dist && echo "$(SPHINXBUILD) $(SPHINXOPTS)" > dist/log\n'
+    )
+
+    # Act
+    dist = release.build_docs_dist(str(doc), str(tmp_path / "bin"))
+
+    # Assert
+    log = Path(dist, "log").read_text()
+    assert log == f"{tmp_path / 'bin' / 'sphinx-build'} -j 8 -d build/doctrees\n"
+
+
+def test_sphinx_jobs(mocker: MockerFixture) -> None:
+    # Arrange
+    mocker.patch("os.cpu_count", return_value=32)
+
+    # Act / Assert
+    assert release.sphinx_jobs() == 32
+    assert release.sphinx_jobs(5) == 6
+    assert release.sphinx_jobs(64) == 1
+
+
+@pytest.mark.usefixtures("fake_blurb")
+def test_export_builds_docs_in_copy(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.2")
+
+    def build_docs(tree: str) -> str:
+        # The docs get the news entries, whatever the source packaging does.
+        assert os.path.isdir(os.path.join(tree, "Misc", "NEWS.d"))
+        dist = os.path.join(tree, "Doc", "dist")
+        os.makedirs(dist)
+        Path(dist, "python-3.12.2-docs.epub").write_text("epub\n")
+        return dist
+
+    mocker.patch("release.build_docs", side_effect=build_docs)
+
+    # Act
+    release.export(tag, silent=True)
+
+    # Assert
+    dist = cpython_repo / "3.12.2"
+    assert sorted(os.listdir(dist)) == [
+        "Python-3.12.2",
+        "docs",
+        "md5sums.txt",
+        "src",
+        "verification.json",
+    ]
+    assert os.listdir(dist / "docs") == ["python-3.12.2-docs.epub"]
+    assert not (dist / "Python-3.12.2" / "Misc" / "NEWS.d").exists()
+    assert (dist / "src" / "Python-3.12.2.tar.xz").exists()
+
+
+def test_verify_tarballs_problems(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.2")
+    release.extract_tag(tag, "Python-3.12.2", str(tmp_path), silent=True)
+    tree = tmp_path / "Python-3.12.2"
+    (tree / "Lib" / "os.py").write_text("import nt\n")
+    (tree / "Lib" / "extra.py").write_text("")
+    (tree / "Doc" / "conf.py").unlink()
+    (tree / "configure").chmod(0o644)
+    (tmp_path / "src").mkdir()
+    release.tarball(str(tree), tag.committed_at)
+    tarballs = [
+        str(tmp_path / "src" / name)
+        for name in ("Python-3.12.2.tgz", "Python-3.12.2.tar.xz")
+    ]
+
+    # Act
+    report = release.verify_tarballs(
+        tag, "Python-3.12.2", tarballs, release.EXPORT_EXCLUDES, generated=()
+    )
+
+    # Assert
+    assert report.problems == [
+        "Lib/extra.py: not in v3.12.2",
+        "Lib/os.py: content differs",
+        "configure: mode is 644",
+        "Doc/conf.py: missing from the tarballs",
+    ]
+    assert json.loads(report.to_json())["ok"] is False
+
+
+@pytest.mark.usefixtures("fake_blurb")
+def test_export_incremental(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    cache = release.ExportCache(str(tmp_path / "cache"))
+    release.export(release.Tag("3.12.2"), silent=True, skip_docs=True, cache=cache)
+    (cpython_repo / "Lib" / "os.py").write_text("import sys, stat\n")
+    (cpython_repo / "Lib" / "test" / "test_os.py").unlink()
+    (cpython_repo / "Lib" / "new").mkdir()
+    (cpython_repo / "Lib" / "new" / "module.py").write_text("")
+    (cpython_repo / "Lib" / "python").unlink()
+    (cpython_repo / "Lib" / "python").write_text("not a symlink any more\n")
+    (cpython_repo / "configure").chmod(0o644)
+    # A respin is committed later, so every file gets a new mtime.
+    respin = conftest.COMMIT_EPOCH + 3600
+    conftest.git(
+        cpython_repo, "commit", "--quiet", "--all", "--message", "Respin", epoch=respin
+    )
+    conftest.git(cpython_repo, "add", "Lib/new/module.py")
+    conftest.git(
+        cpython_repo, "commit", "--quiet", "--message", "Add module", epoch=respin
+    )
+    conftest.git(
+        cpython_repo,
+        "tag",
+        "--annotate",
+        "--message",
+        "3.12.3",
+        "v3.12.3",
+        epoch=respin,
+    )
+    tag = release.Tag("3.12.3")
+    release.export(tag, silent=True, skip_docs=True)
+    (cpython_repo / "3.12.3").rename(cpython_repo / "fresh")
+
+    # Act
+    release.export(tag, silent=True, skip_docs=True, cache=cache)
+
+    # Assert
+    for name in ("Python-3.12.3.tgz", "Python-3.12.3.tar.xz"):
+        fresh = cpython_repo / "fresh" / "src" / name
+        incremental = cpython_repo / "3.12.3" / "src" / name
+        assert incremental.read_bytes() == fresh.read_bytes()
+        with tarfile.open(incremental) as tar:
+            assert {member.mtime for member in tar} == {respin}
+    assert not (tmp_path / "cache" / "3.12" / "tree" / "Lib" / "test").exists()
+    # The tree of the earlier export is untouched.
+    os_py = cpython_repo / "3.12.2" / "Python-3.12.2" / "Lib" / "os.py"
+    assert os_py.read_text() == "import sys\n"
+
+
+@pytest.mark.usefixtures("fake_blurb")
+def test_export_keeps_cache_intact(
+    mocker: MockerFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+    cpython_repo: Path,
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    cache = release.ExportCache(str(tmp_path / "cache"))
+    cached = tmp_path / "cache" / "3.12" / "tree"
+
+    def build_docs(tree: str) -> str:
+        # Sphinx and blurb write over files of the docs tree in place.
+        with open(os.path.join(tree, "Doc", "conf.py"), "a") as f:
+            f.write("html_theme = 'docs'\n")
+        dist = os.path.join(tree, "Doc", "dist")
+        os.makedirs(dist)
+        return dist
+
+    mocker.patch("release.build_docs", side_effect=build_docs)
+
+    # Act
+    release.export(release.Tag("3.12.2"), silent=True, cache=cache)
+    exported = cpython_repo / "3.12.2" / "Python-3.12.2"
+    with open(exported / "Include" / "Python-ast.h", "a") as f:
+        f.write("// edited\n")
+
+    # Assert
+    assert (cached / "Doc" / "conf.py").read_text() == "project = 'Python'\n"
+    ast_h = cached / "Include" / "Python-ast.h"
+    assert ast_h.read_text() == "// generated\n"
+    assert ast_h.stat().st_mtime == conftest.COMMIT_EPOCH
+    assert not (cached / "Misc" / "NEWS").exists()
+
+
+@pytest.mark.usefixtures("fake_blurb")
+def test_export_many(monkeypatch: pytest.MonkeyPatch, cpython_repo: Path) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    release.export(release.Tag("3.12.2"), silent=True, skip_docs=True)
+    (cpython_repo / "3.12.2").rename(cpython_repo / "alone")
+    (cpython_repo / "Lib" / "os.py").write_text("import sys, stat\n")
+    conftest.git(cpython_repo, "commit", "--quiet", "--all", "--message", "3.13")
+    conftest.git(cpython_repo, "tag", "--annotate", "--message", "3.13.0", "v3.13.0")
+    tags = [release.Tag("3.12.2"), release.Tag("3.13.0")]
+
+    # Act
+    release.export_many(tags, jobs=2, silent=True, skip_docs=True)
+
+    # Assert
+    for name in ("Python-3.12.2.tgz", "Python-3.12.2.tar.xz"):
+        alone = cpython_repo / "alone" / "src" / name
+        assert (cpython_repo / "3.12.2" / "src" / name).read_bytes() == (
+            alone.read_bytes()
+        )
+    for tag in tags:
+        dist = cpython_repo / tag.text
+        md5sums = (dist / "md5sums.txt").read_text().splitlines()
+        assert [line.split("  ")[1] for line in md5sums] == [
+            f"src/Python-{tag.text}.tgz",
+            f"src/Python-{tag.text}.tar.xz",
+        ]
+        for line in md5sums:
+            md5, path = line.split("  ")
+            assert hashlib.md5((dist / path).read_bytes()).hexdigest() == md5
+        assert json.loads((dist / "verification.json").read_text())["ok"] is True
+
+
+def test_export_many_failure(
+    mocker: MockerFixture, capsys: pytest.CaptureFixture[str]
+) -> None:
+    # Arrange
+    def export(tag: release.Tag, **kwargs: object) -> None:
+        if tag.text == "3.11.9":
+            cmdrunner.error("Can't export 3.11.9")
+
+    mocker.patch("release.export", side_effect=export)
+    tags = [release.Tag("3.11.9"), release.Tag("3.12.4")]
+
+    # Act
+    with pytest.raises(SystemExit):
+        release.export_many(tags, jobs=1)
+
+    # Assert
+    assert release.export.call_count == 2  # type: ignore[attr-defined]
+    assert "Failed to export:\n3.11.9\n" in capsys.readouterr().err
+
+
+@pytest.mark.usefixtures("fake_blurb")
+def test_export_index(monkeypatch: pytest.MonkeyPatch, cpython_repo: Path) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+
+    # Act
+    release.export(release.Tag("3.12.2"), silent=True, skip_docs=True, index=True)
+
+    # Assert
+    src = cpython_repo / "3.12.2" / "src"
+    assert sorted(os.listdir(src)) == [
+        "Python-3.12.2.tar.xz",
+        "Python-3.12.2.tar.xz.index.json",
+        "Python-3.12.2.tgz",
+        "Python-3.12.2.tgz.index.json",
+    ]
+    with reprotar.IndexedTarball(str(src / "Python-3.12.2.tar.xz")) as tarball:
+        assert tarball.read("Python-3.12.2/Lib/os.py") == b"import sys\n"
+
+
+@pytest.mark.usefixtures("fake_blurb")
+def test_export_compresses_in_callers_executor(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    write = mocker.spy(reprotar, "_write")
+    # The docs build runs alongside the compression.
+    mocker.patch("release.build_docs", side_effect=lambda tree: tree)
+
+    # Act
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        release.export(release.Tag("3.12.2"), silent=True, jobs=3, executor=executor)
+    (cpython_repo / "3.12.2").rename(cpython_repo / "shared")
+    release.export(release.Tag("3.12.2"), silent=True, jobs=2)
+
+    # Assert
+    # reprotar._write(outputs, add, jobs, executor)
+    shared, alone = write.call_args_list
+    assert shared.args[2] == 3
+    assert shared.args[3] is executor
+    # Without an executor, reprotar makes a pool of `jobs` threads.
+    assert alone.args[2] == 2
+    assert alone.args[3] is None
+
+
+def test_done_in_repo(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    # Arrange
+    repo = tmp_path / "cpython"
+    (repo / "Include").mkdir(parents=True)
+    (repo / "Include" / "patchlevel.h").write_text(
+        '/*--start constants--*/\n#define PY_VERSION "3.12.2"\n/*--end constants--*/\n'
+    )
+    # Not from the repository, as when run from run_release.
+    monkeypatch.chdir(tmp_path)
+
+    # Act
+    release.done(release.Tag("3.12.2"), repo=str(repo))
+
+    # Assert
+    patchlevel = (repo / "Include" / "patchlevel.h").read_text()
+    assert '"3.12.2+"' in patchlevel
+    assert "PY_MICRO_VERSION" in patchlevel
+
+
+def test_verify_tarballs_missing_member(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.2")
+    release.extract_tag(tag, "Python-3.12.2", str(tmp_path), silent=True)
+    tree = tmp_path / "Python-3.12.2"
+    src = tmp_path / "src"
+    src.mkdir()
+    release.tarball(str(tree), tag.committed_at)
+    (src / "Python-3.12.2.tgz").rename(src / "complete.tgz")
+    # A member from the middle of the tree, so those after it don't line up.
+    (tree / "Include" / "Python.h").unlink()
+    release.tarball(str(tree), tag.committed_at)
+
+    # Act
+    report = release.verify_tarballs(
+        tag,
+        "Python-3.12.2",
+        [str(src / "complete.tgz"), str(src / "Python-3.12.2.tar.xz")],
+        release.EXPORT_EXCLUDES,
+        generated=(),
+    )
+
+    # Assert
+    assert report.problems == ["The tarballs have different members"]
+
+
+def test_verify_tarballs_stream_problems(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, cpython_repo: Path
+) -> None:
+    # Arrange
+    monkeypatch.chdir(cpython_repo)
+    tag = release.Tag("3.12.2")
+    release.extract_tag(tag, "Python-3.12.2", str(tmp_path), silent=True)
+    tree = tmp_path / "Python-3.12.2"
+    (tmp_path / "src").mkdir()
+    release.tarball(str(tree), tag.committed_at)
+    src = tmp_path / "src"
+    xz = src / "Python-3.12.2.tar.xz"
+    # More members at the end of the gzip tarball than in the xz one.
+    for name in ("zz1", "zz2", "zz3"):
+        (tree / name).write_text("")
+    release.tarball(str(tree), tag.committed_at)
+    xz.unlink()
+    (src / "Python-3.12.2.tgz").rename(src / "longer.tgz")
+    for name in ("zz1", "zz2", "zz3"):
+        (tree / name).unlink()
+    release.tarball(str(tree), tag.committed_at)
+    # A gzip trailer with a wrong CRC, which tarfile's stream mode misses.
+    tgz = src / "Python-3.12.2.tgz"
+    data = bytearray(tgz.read_bytes())
+    data[-8] ^= 0xFF
+    tgz.write_bytes(bytes(data))
+
+    # Act
+    mismatched = release.verify_tarballs(
+        tag,
+        "Python-3.12.2",
+        [str(src / "longer.tgz"), str(xz)],
+        release.EXPORT_EXCLUDES,
+        generated=(),
+    )
+    corrupt = release.verify_tarballs(
+        tag, "Python-3.12.2", [str(tgz), str(xz)], release.EXPORT_EXCLUDES, ()
+    )
+
+    # Assert
+    assert mismatched.problems.count("The tarballs have different members") == 1
+    assert [p for p in corrupt.problems if p.startswith("Python-3.12.2.tgz:")]
@@ -1,9 +1,11 @@
-from subprocess import CompletedProcess
+import pickle
+from pathlib import Path
 
 import pytest
 from pytest_mock import MockerFixture
 
 import release
+from tests.conftest import git
 
 
 def test_tag() -> None:
@@ -64,9 +66,7 @@ def test_tag_committed(mocker: MockerFixture) -> None:
     # Arrange
     tag = release.Tag("3.12.2")
 
-    proc = CompletedProcess([], 0)
-    proc.stdout = b"1707250784"
-    mocker.patch("subprocess.run", return_value=proc)
+    mocker.patch("gitquery.GitRepository.commit_time", return_value=1707250784)
 
     # Act / Assert
     assert str(tag.committed_at) == "2024-02-06 20:19:44+00:00"
@@ -91,3 +91,138 @@ def test_tag_invalid() -> None:
     # Act / Assert
     with pytest.raises(SystemExit):
         release.Tag(tag_name)
+
+
+def test_tag_order() -> None:
+    # Arrange
+    names = ["3.12.0", "3.12.0rc1", "3.12.0a7", "3.11.8", "3.12.0b1", "3.12.0rc2"]
+
+    # Act
+    tags = sorted(release.Tag(name) for name in names)
+
+    # Assert
+    assert [str(tag) for tag in tags] == [
+        "3.11.8",
+        "3.12.0a7",
+        "3.12.0b1",
+        "3.12.0rc1",
+        "3.12.0rc2",
+        "3.12.0",
+    ]
+    assert release.Tag("3.12") == release.Tag("3.12.0")
+    assert len({release.Tag("3.12"), release.Tag("3.12.0")}) == 1
+
+
+def test_tag_immutable() -> None:
+    # Arrange
+    tag = release.Tag("3.12.2")
+
+    # Act / Assert
+    with pytest.raises(AttributeError):
+        tag.patch = 3  # type: ignore[misc]
+    with pytest.raises(AttributeError):
+        tag.extra = 1  # type: ignore[attr-defined]
+
+
+def test_tag_pickle() -> None:
+    # Arrange
+    tag = release.Tag("3.13.0rc1")
+    # A Tag pickled before it had slots.
+    old = (
+        b"ccopy_reg\n_reconstructor\n(crelease\nTag\nc__builtin__\nobject\nNtR"
+        b"(dp0\nVis_final\nI01\nsVtext\nV3.12.2\nsVlevel\nVf\nsb."
+    )
+
+    # Act / Assert
+    assert pickle.loads(pickle.dumps(tag)) == tag
+    assert pickle.loads(pickle.dumps(tag)).is_release_candidate is True
+    assert pickle.loads(old) == release.Tag("3.12.2")
+
+
+def test_release_history() -> None:
+    # Arrange
+    history = release.ReleaseHistory(
+        release.Tag(name)
+        for name in (
+            "3.11.7",
+            "3.11.8",
+            "3.12.0rc1",
+            "3.12.0rc2",
+            "3.12.0",
+            "3.12.1",
+            "3.13.0a1",
+        )
+    )
+
+    # Act / Assert
+    assert history.previous(release.Tag("3.12.1")) == release.Tag("3.12.0")
+    assert history.previous(release.Tag("3.12.2")) == release.Tag("3.12.1")
+    assert history.previous(release.Tag("3.12.0rc1")) is None
+    assert history.previous(release.Tag("3.13.0a1")) is None
+    assert history.latest() == release.Tag("3.13.0a1")
+    assert history.latest("3.11") == release.Tag("3.11.8")
+    assert history.latest("3.10") is None
+    assert history.latest_rc() == release.Tag("3.12.0rc2")
+    assert history.latest_rc("3.11") is None
+    assert release.Tag("3.12.0rc2") in history
+    assert release.Tag("3.12.2") not in history
+
+
+def test_release_history_from_repository(cpython_repo: Path) -> None:
+    # Arrange
+    git(cpython_repo, "tag", "v3.12.2rc1")
+    git(cpython_repo, "tag", "not-a-release")
+
+    # Act
+    history = release.ReleaseHistory.from_repository(str(cpython_repo))
+
+    # Assert
+    assert list(history) == [release.Tag("3.12.2rc1"), release.Tag("3.12.2")]
+
+
+def test_make_tag_existing(mocker: MockerFixture, cpython_repo: Path) -> None:
+    # Arrange
+    run_cmd = mocker.patch("release.run_cmd")
+    mocker.patch("builtins.input", return_value="y")
+
+    # Act / Assert
+    assert release.make_tag(release.Tag("3.12.2"), repo=str(cpython_repo)) is False
+    run_cmd.assert_not_called()
+
+
+def test_make_tag_previous(
+    mocker: MockerFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+    cpython_repo: Path,
+) -> None:
+    # Arrange
+    monkeypatch.setenv("GPG_KEY_FOR_RELEASE", "rm@python.org")
+    run_cmd = mocker.patch("release.run_cmd")
+    mocker.patch("builtins.input", return_value="y")
+
+    # Act
+    tagged = release.make_tag(release.Tag("3.12.3"), repo=str(cpython_repo))
+
+    # Assert
+    assert tagged is True
+    assert "Previous release on the branch: 3.12.2" in capsys.readouterr().out
+    assert run_cmd.call_args.args[0][:2] == ["git", "tag"]
+
+
+def test_make_tag_final_without_rc(
+    mocker: MockerFixture, capsys: pytest.CaptureFixture[str], cpython_repo: Path
+) -> None:
+    # Arrange
+    git(cpython_repo, "tag", "v3.13.0b1")
+    run_cmd = mocker.patch("release.run_cmd")
+    # Go on without "blurb release", but not without a release candidate.
+    mocker.patch("builtins.input", side_effect=["y", "n"])
+
+    # Act
+    tagged = release.make_tag(release.Tag("3.13.0"), repo=str(cpython_repo))
+
+    # Assert
+    assert tagged is False
+    assert "There is no release candidate of 3.13." in capsys.readouterr().out
+    run_cmd.assert_not_called()
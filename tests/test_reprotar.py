@@ -0,0 +1,306 @@
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import random
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+import reprotar
+
+CLAMP_MTIME = 1707250784
+
+
+def make_tree(root: Path) -> Path:
+    source = root / "Python-3.12.2"
+    (source / "Lib" / "sub").mkdir(parents=True)
+    (source / "Lib" / "b.py").write_text("b = 1\n")
+    (source / "Lib" / "a.py").write_text("a = 1\n")
+    (source / "configure").write_text("#!/bin/sh\n")
+    (source / "configure").chmod(0o700)
+    (source / "README.rst").write_text("This is Python version 3.12.2\n")
+    # Newer than the clamp time.
+    os.utime(source / "Lib" / "b.py", (CLAMP_MTIME + 100, CLAMP_MTIME + 100))
+    # Older than the clamp time.
+    os.utime(source / "README.rst", (CLAMP_MTIME - 100, CLAMP_MTIME - 100))
+    return source
+
+
+@pytest.mark.parametrize(
+    ["mode", "expected"],
+    [
+        (0o644, 0o644),
+        (0o664, 0o644),
+        (0o600, 0o644),
+        (0o700, 0o755),
+        (0o775, 0o755),
+        (0o777, 0o755),
+    ],
+)
+def test_repro_mode(mode: int, expected: int) -> None:
+    assert reprotar.repro_mode(mode) == expected
+
+
+def test_write_tarballs(tmp_path: Path) -> None:
+    # Arrange
+    source = make_tree(tmp_path)
+    tgz = str(tmp_path / "Python-3.12.2.tgz")
+    xz = str(tmp_path / "Python-3.12.2.tar.xz")
+
+    # Act
+    artifacts = reprotar.write_tarballs(
+        str(source),
+        {tgz: reprotar.gzip_compressor, xz: reprotar.xz_compressor},
+        clamp_mtime=CLAMP_MTIME,
+    )
+
+    # Assert
+    for artifact in artifacts:
+        data = Path(artifact.path).read_bytes()
+        assert artifact.size == len(data)
+        assert artifact.md5 == hashlib.md5(data).hexdigest()
+        assert artifact.sha256 == hashlib.sha256(data).hexdigest()
+
+    with tarfile.open(tgz) as gz_tar, tarfile.open(xz) as xz_tar:
+        gz_members = gz_tar.getmembers()
+        xz_members = xz_tar.getmembers()
+    assert [m.get_info() for m in gz_members] == [m.get_info() for m in xz_members]
+    assert [m.name for m in gz_members] == [
+        "Python-3.12.2",
+        "Python-3.12.2/Lib",
+        "Python-3.12.2/Lib/a.py",
+        "Python-3.12.2/Lib/b.py",
+        "Python-3.12.2/Lib/sub",
+        "Python-3.12.2/README.rst",
+        "Python-3.12.2/configure",
+    ]
+    members = {m.name: m for m in gz_members}
+    assert members["Python-3.12.2/Lib/b.py"].mtime == CLAMP_MTIME
+    assert members["Python-3.12.2/README.rst"].mtime == CLAMP_MTIME - 100
+    assert members["Python-3.12.2/configure"].mode == 0o755
+    assert members["Python-3.12.2/Lib/a.py"].mode == 0o644
+    for member in gz_members:
+        assert (member.uid, member.gid, member.uname, member.gname) == (0, 0, "", "")
+        assert "atime" not in member.pax_headers
+        assert "ctime" not in member.pax_headers
+
+
+def test_write_tarballs_reproducible(tmp_path: Path) -> None:
+    # Arrange
+    source = make_tree(tmp_path)
+    first = str(tmp_path / "first.tar.xz")
+    second = str(tmp_path / "second.tar.xz")
+
+    # Act
+    reprotar.write_tarballs(
+        str(source), {first: reprotar.xz_compressor}, clamp_mtime=CLAMP_MTIME
+    )
+    # Touching a file doesn't change the output.
+    os.utime(source / "Lib" / "a.py", None)
+    reprotar.write_tarballs(
+        str(source), {second: reprotar.xz_compressor}, clamp_mtime=CLAMP_MTIME
+    )
+
+    # Assert
+    assert Path(first).read_bytes() == Path(second).read_bytes()
+
+
+@pytest.mark.parametrize(
+    ["compressor", "decompress"],
+    [
+        (reprotar.ParallelGzipCompressor, gzip.decompress),
+        (reprotar.ParallelXzCompressor, lzma.decompress),
+    ],
+)
+@pytest.mark.parametrize("size", [0, 100, 300_000])
+def test_block_compressor(
+    monkeypatch: pytest.MonkeyPatch,
+    compressor: type[reprotar.ParallelGzipCompressor | reprotar.ParallelXzCompressor],
+    decompress: Callable[[bytes], bytes],
+    size: int,
+) -> None:
+    # Arrange
+    monkeypatch.setattr(compressor, "block_size", 64 * 1024)
+    data = random.Random(size).randbytes(size // 2) * 2
+    outputs = []
+
+    # Act
+    for jobs in (1, 4):
+        output = io.BytesIO()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            writer = compressor(reprotar.DigestWriter(output), executor, jobs)
+            for start in range(0, size, 10240):
+                writer.write(data[start : start + 10240])
+            writer.close()
+        outputs.append(output.getvalue())
+
+    # Assert
+    assert outputs[0] == outputs[1]
+    assert decompress(outputs[0]) == data
+
+
+def test_xz_compressor_blocks(monkeypatch: pytest.MonkeyPatch) -> None:
+    # Arrange
+    monkeypatch.setattr(reprotar.ParallelXzCompressor, "block_size", 1000)
+    output = io.BytesIO()
+
+    # Act
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        writer = reprotar.ParallelXzCompressor(
+            reprotar.DigestWriter(output), executor, 2
+        )
+        writer.write(b"x" * 2500)
+        writer.close()
+
+    # Assert
+    blocks, records = reprotar.split_xz_stream(output.getvalue())
+    assert [uncompressed for unpadded, uncompressed in records] == [1000, 1000, 500]
+
+
+def test_pending_blocks_shared(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    # Arrange
+    block_size = 4096
+    for compressor in (
+        reprotar.ParallelGzipCompressor,
+        reprotar.ParallelXzCompressor,
+        reprotar.ParallelZstdCompressor,
+    ):
+        monkeypatch.setattr(compressor, "block_size", block_size)
+    monkeypatch.setattr(reprotar, "XZ_BLOCK_SIZE", block_size)
+    source = make_tree(tmp_path)
+    (source / "Lib" / "big.py").write_bytes(random.Random(0).randbytes(256 * 1024))
+    factories = {"tgz": reprotar.gzip_compressor, "tar.xz": reprotar.xz_compressor}
+    if reprotar.zstd_available():
+        factories["tar.zst"] = reprotar.zstd_compressor
+    pending: list[int] = []
+    acquire = reprotar._PendingBlocks.acquire
+
+    def record(self: reprotar._PendingBlocks, size: int, force: bool = False) -> bool:
+        acquired = acquire(self, size, force)
+        pending.append(self.size)
+        return acquired
+
+    monkeypatch.setattr(reprotar._PendingBlocks, "acquire", record)
+
+    # Act
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for name in ("first", "second"):
+            reprotar.write_tarballs(
+                str(source),
+                {
+                    str(tmp_path / f"{name}.{suffix}"): f
+                    for suffix, f in factories.items()
+                },
+                CLAMP_MTIME,
+                jobs=2,
+                executor=executor,
+            )
+    reprotar.write_tarballs(
+        str(source),
+        {str(tmp_path / f"alone.{suffix}"): f for suffix, f in factories.items()},
+        CLAMP_MTIME,
+        jobs=2,
+    )
+
+    # Assert
+    # Two blocks per thread for all the compressors together, and one more
+    # for a compressor with none waiting.
+    assert max(pending) <= (2 * 2 + len(factories)) * block_size
+    for suffix in factories:
+        alone = (tmp_path / f"alone.{suffix}").read_bytes()
+        assert (tmp_path / f"second.{suffix}").read_bytes() == alone
+
+
+def test_write_tarballs_zstd(tmp_path: Path) -> None:
+    # Arrange
+    pytest.importorskip("zstandard")
+    source = make_tree(tmp_path)
+    xz = str(tmp_path / "Python-3.12.2.tar.xz")
+    zst = str(tmp_path / "Python-3.12.2.tar.zst")
+
+    # Act
+    reprotar.write_tarballs(
+        str(source),
+        {xz: reprotar.xz_compressor, zst: reprotar.zstd_compressor},
+        clamp_mtime=CLAMP_MTIME,
+    )
+
+    # Assert
+    with tarfile.open(xz) as xz_tar, reprotar.open_zstd_tarball(zst) as zst_tar:
+        assert [m.get_info() for m in xz_tar] == [m.get_info() for m in zst_tar]
+        member = zst_tar.extractfile("Python-3.12.2/Lib/a.py")
+        assert member is not None
+        assert member.read() == b"a = 1\n"
+
+
+@pytest.mark.parametrize(
+    ["suffix", "compression"],
+    [("tgz", "gzip"), ("tar.xz", "xz"), ("tar.zst", "zstd")],
+)
+def test_indexed_tarball(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, suffix: str, compression: str
+) -> None:
+    # Arrange
+    if suffix == "tar.zst":
+        pytest.importorskip("zstandard")
+    monkeypatch.setattr(reprotar.ParallelXzCompressor, "block_size", 4096)
+    monkeypatch.setattr(reprotar.ParallelZstdCompressor, "block_size", 4096)
+    source = make_tree(tmp_path)
+    # Spans several blocks.
+    (source / "Lib" / "big.py").write_bytes(random.Random(0).randbytes(10_000))
+    output = str(tmp_path / f"Python-3.12.2.{suffix}")
+    factory = {
+        "tgz": reprotar.gzip_compressor,
+        "tar.xz": reprotar.xz_compressor,
+        "tar.zst": reprotar.zstd_compressor,
+    }[suffix]
+    [artifact] = reprotar.write_tarballs(str(source), {output: factory}, CLAMP_MTIME)
+
+    # Act
+    index = reprotar.write_index(artifact)
+    first = Path(index).read_bytes()
+    reprotar.write_index(artifact)
+    tarball = reprotar.IndexedTarball(output)
+
+    # Assert
+    assert Path(index).read_bytes() == first
+    assert index == output + ".index.json"
+    assert tarball.compression == compression
+    # gzip blocks can't be decompressed on their own.
+    assert (len(tarball.blocks) > 1) == (compression != "gzip")
+    if compression == "zstd":
+        tar = reprotar.open_zstd_tarball(output)
+    else:
+        tar = tarfile.open(output)
+    with tarball, tar:
+        assert tarball.getnames() == tar.getnames()
+        for member in tar:
+            tarinfo = tarball.tarinfo(member.name)
+            assert tarinfo.get_info() == member.get_info()
+            if member.isfile():
+                fileobj = tar.extractfile(member)
+                assert fileobj is not None
+                assert tarball.read(member.name) == fileobj.read()
+        with pytest.raises(KeyError):
+            tarball.getmember("Python-3.12.2/missing")
+
+
+def test_indexed_tarball_stale_index(tmp_path: Path) -> None:
+    # Arrange
+    source = make_tree(tmp_path)
+    output = str(tmp_path / "Python-3.12.2.tar.xz")
+    [artifact] = reprotar.write_tarballs(
+        str(source), {output: reprotar.xz_compressor}, CLAMP_MTIME
+    )
+    reprotar.write_index(artifact)
+    with open(output, "ab") as f:
+        f.write(b"\0" * 4)
+
+    # Act / Assert
+    with pytest.raises(ValueError, match="doesn't match"):
+        reprotar.IndexedTarball(output)
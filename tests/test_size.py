@@ -14,6 +14,7 @@ import size
         ("file.msi", False),
         ("file.chm", False),
         ("file.dmg", False),
+        ("file.tar.zst", False),
         ("file.ext", True),
     ],
 )
@@ -32,6 +33,7 @@ def test_ignore(filename: str, expected: bool) -> None:
         ("file.msi", 5),
         ("file.chm", 6),
         ("file.dmg", 7),
+        ("file.tar.zst", 8),
         ("file.ext", 9999),
     ],
 )
@@ -0,0 +1,112 @@
+import gzip
+import io
+import lzma
+import tarfile
+from pathlib import Path
+
+import reprotar
+import tardiff
+
+CLAMP_MTIME = 1707250784
+
+
+def make_tarball(root: Path, name: str, files: dict[str, str]) -> str:
+    """A reproducible .tar.xz of a tree with the given files."""
+    source = root / name / "Python-3.12.2"
+    for path, content in files.items():
+        (source / path).parent.mkdir(parents=True, exist_ok=True)
+        (source / path).write_text(content)
+    output = str(root / name / "Python-3.12.2.tar.xz")
+    reprotar.write_tarballs(
+        str(source), {output: reprotar.xz_compressor}, clamp_mtime=CLAMP_MTIME
+    )
+    return output
+
+
+FILES = {"README.rst": "Python\n", "Lib/os.py": "import sys\n", "Lib/re.py": ""}
+
+
+def test_identical(tmp_path: Path) -> None:
+    # Arrange
+    a = make_tarball(tmp_path, "a", FILES)
+    b = make_tarball(tmp_path, "b", FILES)
+
+    # Act
+    report = tardiff.diff_tarballs(a, b)
+
+    # Assert
+    assert report.identical
+    assert report.entries == (5, 5)
+
+
+def test_differences(tmp_path: Path) -> None:
+    # Arrange
+    a = make_tarball(tmp_path, "a", FILES)
+    changed = {**FILES, "Lib/os.py": "import sys, stat\n"}
+    del changed["Lib/re.py"]
+    b = make_tarball(tmp_path, "b", changed)
+
+    # Act
+    report = tardiff.diff_tarballs(a, b)
+
+    # Assert
+    assert report.complete
+    assert report.differences[0] == "Python-3.12.2/Lib/os.py: size 11 != 17"
+    assert report.differences[1].startswith("Python-3.12.2/Lib/os.py: content ")
+    assert report.differences[-1] == "Python-3.12.2/Lib/re.py: only in tarball 1"
+
+
+def test_order(tmp_path: Path) -> None:
+    # Arrange
+    files = {f"Lib/m{i}.py": str(i) for i in range(5)}
+    a = str(tmp_path / "a.tar")
+    b = str(tmp_path / "b.tar")
+    swapped = ["Lib/m0.py", "Lib/m2.py", "Lib/m1.py", "Lib/m3.py", "Lib/m4.py"]
+    for path, names in ((a, sorted(files)), (b, swapped)):
+        with tarfile.open(path, "w", format=tarfile.PAX_FORMAT) as tar:
+            for name in names:
+                data = files[name].encode()
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    # Act
+    report = tardiff.diff_tarballs(a, b)
+
+    # Assert
+    assert report.differences == [
+        "Lib/m2.py: the entries are in another order, from entry 2 != 1"
+    ]
+
+
+def test_gzip_header(tmp_path: Path) -> None:
+    # Arrange
+    tar_bytes = lzma.decompress(Path(make_tarball(tmp_path, "a", FILES)).read_bytes())
+    paths = []
+    for mtime in (0, CLAMP_MTIME):
+        path = tmp_path / f"{mtime}.tgz"
+        with gzip.GzipFile(path, "wb", mtime=mtime) as f:
+            f.write(tar_bytes)
+        paths.append(str(path))
+
+    # Act
+    report = tardiff.diff_tarballs(paths[0], paths[1])
+
+    # Assert
+    assert report.differences == [
+        f"gzip header mtime 0 != {CLAMP_MTIME}",
+        f"gzip header name '0.tgz' != '{CLAMP_MTIME}.tgz'",
+    ]
+
+
+def test_max_differences(tmp_path: Path) -> None:
+    # Arrange
+    a = make_tarball(tmp_path, "a", {f"Lib/m{i}.py": "a" for i in range(10)})
+    b = make_tarball(tmp_path, "b", {f"Lib/m{i}.py": "b" for i in range(10)})
+
+    # Act
+    report = tardiff.diff_tarballs(a, b, max_differences=3)
+
+    # Assert
+    assert len(report.differences) == 3
+    assert not report.complete
@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+import taskgraph
+
+
+def test_resolve() -> None:
+    # Arrange
+    keys = ["check", "build", "check", "upload", "docs"]
+    after = [(), None, None, ("check",), ("build",)]
+
+    # Act
+    dependencies = taskgraph.resolve(keys, after)
+
+    # Assert
+    assert dependencies == [
+        frozenset(),
+        frozenset({0}),
+        frozenset({0, 1}),
+        # The last "check" before it.
+        frozenset({2}),
+        frozenset({1}),
+    ]
+
+
+def test_resolve_later_task() -> None:
+    # Act / Assert
+    with pytest.raises(taskgraph.CycleError):
+        taskgraph.resolve(["a", "b"], [("b",), ()])
+
+
+def test_run_concurrently() -> None:
+    # Arrange
+    # Three independent checks, then a task waiting for all of them.
+    dependencies = [(), (), (), (0, 1, 2)]
+    barrier = threading.Barrier(3, timeout=5)
+    done: list[int] = []
+
+    def execute(index: int) -> None:
+        if index < 3:
+            # Only passes if the three checks run at the same time.
+            barrier.wait()
+
+    # Act
+    taskgraph.run(execute, dependencies, on_done=done.append)
+
+    # Assert
+    assert sorted(done[:3]) == [0, 1, 2]
+    assert done[3] == 3
+
+
+def test_run_locks() -> None:
+    # Arrange
+    dependencies = [(), (), ()]
+    locks = [("prompt",), ("prompt",), ()]
+    running: set[int] = set()
+    overlaps: list[set[int]] = []
+
+    def execute(index: int) -> None:
+        if locks[index]:
+            overlaps.append(set(running))
+            running.add(index)
+            time.sleep(0.05)
+            running.discard(index)
+
+    # Act
+    taskgraph.run(execute, dependencies, locks)
+
+    # Assert
+    assert overlaps == [set(), set()]
+
+
+def test_run_resumes() -> None:
+    # Arrange
+    executed: list[int] = []
+
+    # Act
+    taskgraph.run(executed.append, [(), (0,), (1,)], completed={0, 1})
+
+    # Assert
+    assert executed == [2]
+
+
+def test_run_failure() -> None:
+    # Arrange
+    dependencies = [(), (), (0,)]
+    done: list[int] = []
+
+    def execute(index: int) -> None:
+        if index == 0:
+            raise RuntimeError("check failed")
+        time.sleep(0.05)
+
+    # Act
+    with pytest.raises(RuntimeError, match="check failed"):
+        taskgraph.run(execute, dependencies, on_done=done.append)
+
+    # Assert
+    # The task already running finished, the dependent one didn't start.
+    assert done == [1]
+
+
+def test_run_interrupted() -> None:
+    # Arrange
+    # Task 1 stands for a question at the terminal which never gets an answer.
+    question = threading.Event()
+    threads: dict[int, threading.Thread] = {}
+
+    def execute(index: int) -> None:
+        threads[index] = threading.current_thread()
+        if index == 1:
+            question.wait(5)
+
+    def on_done(index: int) -> None:
+        raise KeyboardInterrupt
+
+    # Act
+    start = time.perf_counter()
+    with pytest.raises(KeyboardInterrupt):
+        taskgraph.run(execute, [(), ()], [(), ("prompt",)], on_done=on_done)
+    seconds = time.perf_counter() - start
+
+    # Assert
+    assert seconds < 1
+    assert threads[1].is_alive()
+    assert threads[1].daemon
+    question.set()
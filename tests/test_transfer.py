@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+import transfer
+
+FAKE_SSH = """\
+#!/bin/sh
+# Run the command, the last argument, locally.
+for arg; do command=$arg; done
+exec sh -c "$command"
+"""
+
+# Run an sftp batch of "put" commands locally.  With FAKE_SFTP_FAIL set to
+# a marker file that doesn't exist yet, the first put stops halfway.
+FAKE_SFTP = f"""\
+#!{sys.executable}
+import os, shlex, shutil, sys
+
+for line in sys.stdin:
+    args = shlex.split(line)
+    resume = args[1] == "-a"
+    local, remote = args[-2:]
+    offset = os.path.getsize(remote) if resume and os.path.exists(remote) else 0
+    with open(local, "rb") as src, open(remote, "ab" if resume else "wb") as dst:
+        src.seek(offset)
+        marker = os.environ.get("FAKE_SFTP_FAIL")
+        if marker and not os.path.exists(marker):
+            open(marker, "w").close()
+            dst.write(src.read(os.path.getsize(local) // 2))
+            sys.exit(1)
+        shutil.copyfileobj(src, dst)
+"""
+
+
+@pytest.fixture
+def uploader(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> transfer.Uploader:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, script in (("ssh", FAKE_SSH), ("sftp", FAKE_SFTP)):
+        (bin_dir / name).write_text(script)
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr("transfer.time.sleep", lambda seconds: None)
+    return transfer.Uploader("rm@dinsdale.python.org", streams=2)
+
+
+def make_files(root: Path) -> None:
+    for name, size in (("a.tgz", 3000), ("b.tar.xz", 2000), ("sub/c.txt", 10)):
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_bytes(os.urandom(size))
+
+
+def test_remote_manifest_command(tmp_path: Path) -> None:
+    # Arrange
+    make_files(tmp_path)
+
+    # Act
+    output = subprocess.check_output(
+        ["sh", "-c", transfer.remote_manifest_command(str(tmp_path))], text=True
+    )
+    missing = subprocess.check_output(
+        ["sh", "-c", transfer.remote_manifest_command(str(tmp_path / "missing"))]
+    )
+
+    # Assert
+    manifest = transfer.parse_manifest(output)
+    assert manifest == {
+        name: transfer.FileState(
+            (tmp_path / name).stat().st_size,
+            transfer.sha256_file(str(tmp_path / name)),
+        )
+        for name in ("a.tgz", "b.tar.xz", "sub/c.txt")
+    }
+    assert missing == b""
+
+
+def test_plan(tmp_path: Path) -> None:
+    # Arrange
+    make_files(tmp_path)
+    data = (tmp_path / "a.tgz").read_bytes()
+    remote = {
+        # A partial upload.
+        "a.tgz": transfer.FileState(1000, hashlib.sha256(data[:1000]).hexdigest()),
+        # Unchanged.
+        "b.tar.xz": transfer.FileState(
+            2000, transfer.sha256_file(str(tmp_path / "b.tar.xz"))
+        ),
+        # Changed.
+        "sub/c.txt": transfer.FileState(10, "0" * 64),
+    }
+
+    # Act
+    with ThreadPoolExecutor() as executor:
+        transfers, skipped = transfer.plan(str(tmp_path), "/data", remote, executor)
+
+    # Assert
+    assert skipped == ["b.tar.xz"]
+    assert [(t.path, t.remote_path, t.resume) for t in transfers] == [
+        ("a.tgz", "/data/a.tgz", True),
+        ("sub/c.txt", "/data/sub/c.txt", False),
+    ]
+
+
+def test_assign_streams() -> None:
+    # Arrange
+    transfers = [
+        transfer.Transfer(name, name, name, size)
+        for name, size in (("a", 10), ("b", 60), ("c", 30), ("d", 40))
+    ]
+
+    # Act
+    streams = transfer.assign_streams(transfers, 2)
+
+    # Assert
+    assert [[t.path for t in stream] for stream in streams] == [["b", "a"], ["d", "c"]]
+
+
+def test_upload_dir(
+    tmp_path: Path, command_log: Path, uploader: transfer.Uploader
+) -> None:
+    # Arrange
+    local = tmp_path / "src"
+    remote = tmp_path / "remote"
+    make_files(local)
+
+    # Act
+    first = uploader.upload_dir(str(local), str(remote))
+    second = uploader.upload_dir(str(local), str(remote))
+
+    # Assert
+    for name in ("a.tgz", "b.tar.xz", "sub/c.txt"):
+        assert (remote / name).read_bytes() == (local / name).read_bytes()
+    assert sorted(first.uploaded) == ["a.tgz", "b.tar.xz", "sub/c.txt"]
+    assert first.bytes == 5010
+    assert second.uploaded == []
+    assert second.skipped == ["a.tgz", "b.tar.xz", "sub/c.txt"]
+    programs = {
+        record["command"][0]
+        for record in map(json.loads, command_log.read_text().splitlines())
+    }
+    assert programs == {"ssh", "sftp"}
+
+
+def test_upload_dir_resumes(
+    tmp_path: Path, uploader: transfer.Uploader, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # Arrange
+    local = tmp_path / "src"
+    remote = tmp_path / "remote"
+    make_files(local)
+    remote.mkdir()
+    # Left behind by an earlier upload.
+    (remote / "a.tgz").write_bytes((local / "a.tgz").read_bytes()[:1000])
+    (remote / "b.tar.xz").write_bytes(b"stale")
+    monkeypatch.setenv("FAKE_SFTP_FAIL", str(tmp_path / "failed"))
+    uploader.streams = 1
+
+    # Act
+    report = uploader.upload_dir(str(local), str(remote))
+
+    # Assert
+    assert (tmp_path / "failed").exists()
+    for name in ("a.tgz", "b.tar.xz", "sub/c.txt"):
+        assert (remote / name).read_bytes() == (local / name).read_bytes()
+    assert report.resumed == ["a.tgz"]
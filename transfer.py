@@ -0,0 +1,271 @@
+"""Upload directories over SSH in parallel, skipping what's already there.
+
+The remote side of a directory is described by one command, which prints
+the size and SHA-256 of every file under it (see remote_manifest_command).
+Files whose size and digest match are skipped.  A remote file which is a
+prefix of the local one is resumed.  Any other file is uploaded again.
+
+The files are spread over several "sftp" processes, largest first, each
+fed a batch of "put" commands.  A stream that fails is retried, resuming
+the file it was sending.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import os
+import shlex
+import subprocess
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Mapping, Sequence
+
+import cmdrunner
+
+STREAMS = 4
+RETRIES = 3
+SSH_OPTIONS = ("-o", "BatchMode=yes", "-o", "ServerAliveInterval=15")
+CHUNK_SIZE = 1024 * 1024
+
+# Prints "<size> <sha256>  ./<path>" for each file under the directory it
+# is run in.
+REMOTE_MANIFEST_SCRIPT = (
+    "find . -type f -exec sh -c "
+    '\'for f; do printf "%s " "$(wc -c < "$f")"; sha256sum "$f"; done\' '
+    "sh {} +"
+)
+
+
+class UploadError(Exception):
+    """An upload failed, even after retrying."""
+
+
+@dataclass(frozen=True)
+class FileState:
+    size: int
+    sha256: str
+
+
+@dataclass(frozen=True)
+class Transfer:
+    path: str
+    local_path: str
+    remote_path: str
+    size: int
+    resume: bool = False
+
+
+@dataclass
+class UploadReport:
+    uploaded: list[str] = field(default_factory=list)
+    resumed: list[str] = field(default_factory=list)
+    skipped: list[str] = field(default_factory=list)
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Uploaded {len(self.uploaded)} files ({len(self.resumed)} resumed), "
+            f"{self.bytes / 1024**2:.1f} MiB in {self.seconds:.1f}s "
+            f"({self.rate / 1024**2:.1f} MiB/s), "
+            f"skipped {len(self.skipped)} unchanged files"
+        )
+
+
+def remote_manifest_command(directory: str) -> str:
+    """A shell command printing the manifest of a remote directory.
+
+    A directory which doesn't exist has an empty manifest.
+    """
+    quoted = shlex.quote(directory)
+    return f"if cd {quoted} 2>/dev/null; then {REMOTE_MANIFEST_SCRIPT}; fi"
+
+
+def parse_manifest(output: str) -> dict[str, FileState]:
+    """Parse the output of remote_manifest_command into {path: state}."""
+    manifest = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        size, digest, path = line.split(maxsplit=2)
+        path = path.lstrip("*")
+        manifest[os.path.normpath(path)] = FileState(int(size), digest)
+    return manifest
+
+
+def sha256_file(path: str, size: int | None = None) -> str:
+    """The SHA-256 of a file, or of its first `size` bytes."""
+    digest = hashlib.sha256()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def local_files(directory: str) -> dict[str, str]:
+    """{path relative to the directory: local path} of the files under it."""
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, directory)] = path
+    return files
+
+
+def plan_file(
+    path: str, local_path: str, remote_dir: str, state: FileState | None
+) -> Transfer | None:
+    """How to upload a file, given the state of its remote copy, if any."""
+    size = os.path.getsize(local_path)
+    remote_path = f"{remote_dir.rstrip('/')}/{path}"
+    if state is None or state.size > size:
+        return Transfer(path, local_path, remote_path, size)
+    if sha256_file(local_path, state.size) != state.sha256:
+        return Transfer(path, local_path, remote_path, size)
+    if state.size == size:
+        return None
+    return Transfer(path, local_path, remote_path, size, resume=True)
+
+
+def plan(
+    local_dir: str,
+    remote_dir: str,
+    remote: Mapping[str, FileState],
+    executor: concurrent.futures.Executor,
+) -> tuple[list[Transfer], list[str]]:
+    """Decide what to upload: return the transfers and the skipped paths."""
+    files = local_files(local_dir)
+    decisions = executor.map(
+        lambda path: plan_file(path, files[path], remote_dir, remote.get(path)),
+        files,
+    )
+    transfers, skipped = [], []
+    for path, transfer in zip(files, decisions):
+        if transfer is None:
+            skipped.append(path)
+        else:
+            transfers.append(transfer)
+    return transfers, skipped
+
+
+def assign_streams(transfers: Iterable[Transfer], streams: int) -> list[list[Transfer]]:
+    """Spread transfers over streams, largest first, to even out the bytes."""
+    assigned: list[list[Transfer]] = [[] for _ in range(streams)]
+    loads = [0] * streams
+    for transfer in sorted(transfers, key=lambda t: (-t.size, t.path)):
+        stream = loads.index(min(loads))
+        assigned[stream].append(transfer)
+        loads[stream] += transfer.size
+    return [stream for stream in assigned if stream]
+
+
+def sftp_quote(path: str) -> str:
+    return '"' + path.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def sftp_batch(transfers: Iterable[Transfer]) -> str:
+    """An sftp batch uploading the transfers."""
+    lines = []
+    for transfer in transfers:
+        put = "put -a" if transfer.resume else "put"
+        lines.append(
+            f"{put} {sftp_quote(transfer.local_path)} "
+            f"{sftp_quote(transfer.remote_path)}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+class Uploader:
+    def __init__(
+        self,
+        host: str,
+        streams: int = STREAMS,
+        retries: int = RETRIES,
+        ssh_options: Sequence[str] = SSH_OPTIONS,
+    ) -> None:
+        self.host = host
+        self.streams = streams
+        self.retries = retries
+        self.ssh_options = list(ssh_options)
+
+    def ssh(self, command: str) -> str:
+        """Run a shell command on the host and return its output."""
+        try:
+            output = cmdrunner.check_output(
+                ["ssh", *self.ssh_options, self.host, command]
+            )
+        except subprocess.CalledProcessError as e:
+            raise UploadError(f"{command!r} failed on {self.host}") from e
+        return output.decode()
+
+    def remote_manifest(self, directory: str) -> dict[str, FileState]:
+        return parse_manifest(self.ssh(remote_manifest_command(directory)))
+
+    def sftp(self, batch: str) -> bool:
+        try:
+            cmdrunner.check_output(
+                ["sftp", *self.ssh_options, "-q", "-b", "-", self.host],
+                input=batch.encode(),
+            )
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def send(self, transfers: list[Transfer], remote_dir: str) -> None:
+        """Upload the transfers of one stream, retrying with resume."""
+        for attempt in range(self.retries + 1):
+            if not transfers or self.sftp(sftp_batch(transfers)):
+                return
+            if attempt == self.retries:
+                break
+            time.sleep(2**attempt)
+            # Look at what the failed attempt left behind: finished files
+            # are skipped, and the file it was sending is resumed.
+            remote = self.remote_manifest(remote_dir)
+            planned = [
+                plan_file(t.path, t.local_path, remote_dir, remote.get(t.path))
+                for t in transfers
+            ]
+            transfers = [t for t in planned if t is not None]
+        raise UploadError(
+            f"Couldn't upload {transfers[0].path} and others to {self.host}"
+        )
+
+    def upload_dir(self, local_dir: str, remote_dir: str) -> UploadReport:
+        """Make remote_dir on the host hold the files under local_dir."""
+        start = time.perf_counter()
+        report = UploadReport()
+        remote = self.remote_manifest(remote_dir)
+        with concurrent.futures.ThreadPoolExecutor(self.streams) as executor:
+            transfers, report.skipped = plan(local_dir, remote_dir, remote, executor)
+            if transfers:
+                directories = sorted(
+                    {os.path.dirname(t.remote_path) for t in transfers}
+                )
+                self.ssh("mkdir -p " + " ".join(map(shlex.quote, directories)))
+                futures = [
+                    executor.submit(self.send, stream, remote_dir)
+                    for stream in assign_streams(transfers, self.streams)
+                ]
+                for future in futures:
+                    future.result()
+        for transfer in transfers:
+            report.uploaded.append(transfer.path)
+            if transfer.resume:
+                report.resumed.append(transfer.path)
+                report.bytes += transfer.size - remote[transfer.path].size
+            else:
+                report.bytes += transfer.size
+        report.seconds = time.perf_counter() - start
+        return report